@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+
+import pytest
+import umapi_client
+
+from user_sync.connector.connector_umapi import ActionManager, Commands, UmapiConnector
+from user_sync.connector.umapi_groups import GroupCatalog
+from user_sync.error import AssertionException
+
+
+class SlowConnection(object):
+    """Answers each batch after a delay, failing the actions of users named in fail_users"""
+    throttle_actions = 10
+
+    def __init__(self, delay=0.02, fail_users=(), unavailable=False):
+        self.delay = delay
+        self.fail_users = fail_users
+        self.unavailable = unavailable
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.batches = []
+        self.sent = []
+
+    def execute_multiple(self, actions, immediate=True):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+            self.batches.append(len(actions))
+            self.sent.extend(action.wire_dict() for action in actions)
+        if self.unavailable:
+            raise umapi_client.UnavailableError(3, 10, None)
+        for action in actions:
+            if (action.frame.get('user') or action.frame.get('usergroup')) in self.fail_users:
+                action.report_command_error({'index': 0, 'step': 0, 'errorCode': 'error.test',
+                                             'message': 'test failure'})
+        return 0, len(actions), len(actions)
+
+
+def add_actions(action_manager, count, results):
+    for i in range(count):
+        action = umapi_client.UserAction(umapi_client.IdentityTypes.federatedID, 'user%d@example.com' % i,
+                                         requestID='test_%d' % i)
+        action.update(first_name='User')
+        action_manager.add_action(action, results.append)
+
+
+@pytest.mark.parametrize('max_concurrent_batches', [1, 4])
+def test_batches(max_concurrent_batches):
+    connection = SlowConnection(fail_users=['user3@example.com', 'user42@example.com'])
+    action_manager = ActionManager(connection, 'org@AdobeOrg', logging.getLogger(), max_concurrent_batches)
+    results = []
+    add_actions(action_manager, 95, results)
+    assert action_manager.has_work()
+    action_manager.flush()
+    assert not action_manager.has_work()
+    assert sorted(connection.batches) == [5] + [10] * 9
+    assert 1 < connection.max_in_flight <= 4 if max_concurrent_batches == 4 else connection.max_in_flight == 1
+    # callbacks are called for every action, in the order they were added
+    assert [r['action'].frame['requestID'] for r in results] == ['test_%d' % i for i in range(95)]
+    assert [r['action'].frame['user'] for r in results if not r['is_success']] == \
+        ['user3@example.com', 'user42@example.com']
+    assert action_manager.get_statistics() == (95, 2)
+
+
+def test_unavailable_server():
+    action_manager = ActionManager(SlowConnection(unavailable=True), 'org@AdobeOrg', logging.getLogger(), 2)
+    add_actions(action_manager, 15, [])
+    with pytest.raises(AssertionException):
+        action_manager.flush()
+
+
+def test_throughput():
+    # with a slow server, batches overlap up to the limit instead of waiting for each other
+    connection = SlowConnection()
+    action_manager = ActionManager(connection, 'org@AdobeOrg', logging.getLogger(), 8)
+    add_actions(action_manager, 400, [])
+    action_manager.flush()
+    assert connection.batches == [10] * 40
+    assert 1 < connection.max_in_flight <= 8
+
+
+def make_connector(connection, min_users, users_per_action):
+    connector = UmapiConnector.__new__(UmapiConnector)
+    connector.name = 'umapi'
+    connector.plan = None
+    connector.write_ahead_log = None
+    connector.snapshot = None
+    connector.group_catalog = GroupCatalog('org@AdobeOrg', logging.getLogger())
+    connector.action_manager = ActionManager(connection, 'org@AdobeOrg', logging.getLogger())
+    connector.action_manager.set_bulk_group_changes(min_users, users_per_action)
+    return connector
+
+
+def group_commands(email, add=(), remove=(), identity_type='federatedID'):
+    commands = Commands(identity_type, email, email, 'example.com')
+    commands.add_groups(set(add))
+    commands.remove_groups(set(remove))
+    return commands
+
+
+def test_bulk_group_changes():
+    connection = SlowConnection(delay=0, fail_users=['user1@example.com'])
+    connector = make_connector(connection, min_users=3, users_per_action=2)
+    results = []
+    for i in range(5):
+        connector.send_commands(group_commands('user%d@example.com' % i, add=['Group A'], remove=['Group C']
+                                               if i < 2 else []), results.append)
+    # not sent as group actions: an AdobeID user, and a user with other changes
+    connector.send_commands(group_commands('user5@example.com', add=['Group A'], identity_type='adobeID'))
+    commands = group_commands('user6@example.com', add=['Group A'])
+    commands.update_user({'firstname': 'Changed'})
+    connector.send_commands(commands)
+    connector.action_manager.flush()
+
+    group_actions = [a for a in connection.sent if 'usergroup' in a]
+    assert [(a['usergroup'], a['do']) for a in group_actions] == [
+        ('Group A', [{'add': {'user': ['user0@example.com', 'user1@example.com']}}]),
+        ('Group A', [{'add': {'user': ['user2@example.com', 'user3@example.com']}}]),
+        ('Group A', [{'add': {'user': ['user4@example.com']}}]),
+    ]
+    user_actions = sorted((a['user'], a['do']) for a in connection.sent if 'user' in a)
+    assert [user for user, _ in user_actions] == \
+        ['user0@example.com', 'user1@example.com', 'user5@example.com', 'user6@example.com']
+    assert user_actions[0][1] == [{'remove': {'group': ['Group C']}}]
+    # each user's callback is called for each action its changes were sent in
+    assert len(results) == 7
+    assert connector.action_manager.get_statistics() == (7, 1)
+
+
+def test_bulk_group_changes_off():
+    connection = SlowConnection(delay=0)
+    connector = make_connector(connection, min_users=0, users_per_action=10)
+    for i in range(5):
+        connector.send_commands(group_commands('user%d@example.com' % i, add=['Group A']))
+    connector.action_manager.flush()
+    assert len(connection.sent) == 5 and all('user' in a for a in connection.sent)
+
+
+def test_create_groups():
+    connection = SlowConnection(delay=0.01, fail_users=['Group 7'])
+    connector = make_connector(connection, min_users=0, users_per_action=10)
+    connector.action_manager = ActionManager(connection, 'org@AdobeOrg', logging.getLogger(), 4)
+    connector.group_catalog.get_groups(lambda: [{'groupName': 'Existing'}])
+    names = ['Group %d' % i for i in range(25)]
+    errors_by_name = connector.create_groups(names)
+    assert list(errors_by_name) == ['Group 7']
+    assert connection.batches == [10, 10, 5] and connection.max_in_flight == 3
+    assert all(connector.group_catalog.contains(name) for name in names if name != 'Group 7')
+    assert not connector.group_catalog.contains('Group 7') and connector.group_catalog.contains('existing')
@@ -0,0 +1,476 @@
+import os
+import re
+import threading
+
+import pytest
+from mock import MagicMock
+
+from user_sync.engine.common import AdditionalGroupMatcher, AdobeGroup, AdobeUserExclusions, UserKey
+from user_sync.engine.spill import SortedSpill, merge_join
+from user_sync.engine.umapi import RuleProcessor, UmapiConnectors, UmapiTargetInfo
+from user_sync.error import AssertionException
+from user_sync.helper import BackgroundIterator
+
+
+class FakeUmapiConnector(object):
+    """Serves a fixed list of umapi users and records the commands it is sent"""
+
+    def __init__(self, name, users, trusted=False):
+        self.name = 'umapi.' + name if name else 'umapi'
+        self.users = users
+        self.trusted = trusted
+        self.commands = []
+        self.thread_names = set()
+        self.users_read = 0
+        self.action_manager = MagicMock()
+        self.action_manager.has_work.return_value = False
+        self.action_manager.get_statistics.return_value = (0, 0)
+
+    def iter_users(self, in_group=None):
+        self.thread_names.add(threading.current_thread().name)
+        for user in self.users:
+            self.users_read += 1
+            yield dict(user)
+
+    def get_user_count(self):
+        return len(self.users)
+
+    def get_groups(self):
+        return []
+
+    def get_action_manager(self):
+        return self.action_manager
+
+    def send_commands(self, commands, callback=None):
+        if len(commands) > 0:
+            self.commands.append(commands)
+
+    def save_snapshot(self):
+        pass
+
+    def end_write_ahead_log(self):
+        pass
+
+
+def umapi_user(name, groups=(), id_type='federatedID'):
+    email = name + '@example.com'
+    return {'email': email, 'username': email, 'domain': 'example.com', 'type': id_type,
+            'firstname': name, 'lastname': 'User', 'country': 'US', 'groups': list(groups)}
+
+
+def directory_user(name, groups=()):
+    user = umapi_user(name)
+    user.update({'identity_type': 'federatedID', 'groups': list(groups),
+                 'member_groups': [], 'source_attributes': {}})
+    del user['type']
+    return user
+
+
+@pytest.fixture
+def directory_connector():
+    def _directory_connector(users):
+        connector = MagicMock()
+        connector.load_users_and_groups.return_value = users
+        return connector
+    return _directory_connector
+
+
+@pytest.fixture
+def secondary_names():
+    return ['secondary%d' % i for i in range(4)]
+
+
+@pytest.fixture
+def mappings(secondary_names):
+    AdobeGroup.index_map = {}
+    mappings = {'Staff': [AdobeGroup('Group A', None)]}
+    mappings['Staff'].extend(AdobeGroup('Group A', name) for name in secondary_names)
+    return mappings
+
+
+def make_processor(**options):
+    processor_options = {'exclude_unmapped_users': False, 'process_groups': True}
+    processor_options.update(options)
+    return RuleProcessor(processor_options)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_sync_secondary_umapis(workers, mappings, secondary_names, directory_connector):
+    directory_users = [directory_user('alice', ['Staff']), directory_user('bob', ['Staff'])]
+    primary = FakeUmapiConnector(None, [umapi_user('alice', ['group a']), umapi_user('bob', ['group a']),
+                                        umapi_user('carol')])
+    secondaries = {name: FakeUmapiConnector(name, [umapi_user('alice'), umapi_user('carol')], trusted=True)
+                   for name in secondary_names}
+    processor = make_processor(secondary_org_workers=workers, exclude_strays=True)
+    processor.run(mappings, directory_connector(directory_users), UmapiConnectors(primary, secondaries))
+
+    assert primary.commands == []
+    for secondary in secondaries.values():
+        # alice gets her group, bob is added to the org, carol is an excluded stray
+        assert sorted((c.username, c.do_list[-1][0]) for c in secondary.commands) == [
+            ('alice@example.com', 'add_to_groups'), ('bob@example.com', 'add_to_groups')]
+    assert processor.action_summary['excluded_user_count'] == 1 + len(secondary_names)
+    assert processor.action_summary['secondary_users_created'] == 1
+    threads = set().union(*(s.thread_names for s in secondaries.values()))
+    assert ('MainThread' in threads) == (workers == 1)
+
+
+def test_secondaries_copy_directory_users(mappings, secondary_names, directory_connector):
+    # bob's username isn't his email, so making the commands to add him to an org changes his record
+    bob = directory_user('bob', ['Staff'])
+    bob['username'] = 'robert@example.com'
+    primary_bob = umapi_user('bob', ['group a'])
+    primary_bob['username'] = 'robert@example.com'
+    primary = FakeUmapiConnector(None, [primary_bob])
+    secondaries = {name: FakeUmapiConnector(name, [], trusted=True) for name in secondary_names}
+    processor = make_processor(secondary_org_workers=3)
+    processor.run(mappings, directory_connector([bob]), UmapiConnectors(primary, secondaries))
+
+    for secondary in secondaries.values():
+        assert [(c.username, c.do_list[-1][0]) for c in secondary.commands] == [
+            ('bob@example.com', 'add_to_groups')]
+    # each secondary worked on its own copy
+    assert bob['username'] == 'robert@example.com'
+    assert processor.action_summary['secondary_users_created'] == 1
+
+
+def test_secondary_errors_are_raised(mappings, secondary_names):
+    def fail(umapi_name, umapi_connector):
+        if umapi_name == secondary_names[1]:
+            raise ValueError(umapi_name)
+
+    processor = make_processor(secondary_org_workers=2)
+    with pytest.raises(ValueError):
+        processor.for_each_secondary(fail, [(name, None) for name in secondary_names])
+
+
+def test_prefetch_umapi_users(mappings, secondary_names, directory_connector):
+    directory_users = [directory_user('alice', ['Staff'])]
+    primary = FakeUmapiConnector(None, [umapi_user('alice'), umapi_user('carol')])
+    secondaries = {name: FakeUmapiConnector(name, [umapi_user('alice')], trusted=True) for name in secondary_names}
+    processor = make_processor(prefetch_umapi_users=True)
+    processor.run(mappings, directory_connector(directory_users), UmapiConnectors(primary, secondaries))
+
+    for connector in [primary] + list(secondaries.values()):
+        assert connector.thread_names == {'prefetch-' + connector.name}
+        assert [(c.username, c.do_list) for c in connector.commands] == [
+            ('alice@example.com', [('add_to_groups', {'groups': {'group a'}})])]
+    assert [str(k) for k in processor.get_stray_keys()] == ['federatedID,carol@example.com,']
+    assert processor.prefetched_umapi_users == {}
+
+
+def test_prefetch_stopped_on_error(mappings):
+    def endless_users():
+        i = 0
+        while True:
+            yield umapi_user('user%d' % i)
+            i += 1
+
+    primary = FakeUmapiConnector(None, endless_users())
+    directory_connector = MagicMock()
+    directory_connector.load_users_and_groups.side_effect = AssertionException('directory read failed')
+    processor = make_processor(prefetch_umapi_users=True)
+    with pytest.raises(AssertionException):
+        processor.run(mappings, directory_connector, UmapiConnectors(primary, {}))
+    assert processor.prefetched_umapi_users == {}
+    for thread in threading.enumerate():
+        if thread.name == 'prefetch-umapi':
+            thread.join(5)
+            assert not thread.is_alive()
+
+
+def test_prefetch_errors_are_raised():
+    def failing_users():
+        yield umapi_user('alice')
+        raise ValueError('read failed')
+
+    umapi_users = BackgroundIterator(failing_users())
+    with pytest.raises(ValueError):
+        assert [u['email'] for u in umapi_users] == ['alice@example.com']
+
+
+def test_user_keys_are_interned():
+    processor = make_processor()
+    key = processor.get_directory_user_key(directory_user('Alice'))
+    assert key is processor.get_umapi_user_key(umapi_user('alice'))
+    assert key == UserKey('federatedID', 'alice@example.com', '')
+    assert str(key) == 'federatedID,alice@example.com,'
+    assert processor.get_username_from_user_key(key) == 'alice@example.com'
+    assert str(processor.get_user_key('enterpriseid', 'Bob', 'Example.com')) == 'enterpriseID,bob,example.com'
+    assert processor.get_user_key('federatedID', 'bob', '') is None
+
+
+def test_stray_list_round_trip(tmpdir):
+    stray_list = str(tmpdir.join('strays.csv'))
+    processor = make_processor(stray_list_output_path=stray_list)
+    processor.add_stray(None, None)
+    processor.add_stray(None, processor.get_user_key('federatedID', 'carol@example.com', ''))
+    processor.add_stray(None, processor.get_user_key('enterpriseID', 'dave', 'example.com'))
+    processor.write_stray_key_map()
+    with open(stray_list) as f:
+        assert f.read().splitlines() == ['type,username,domain', 'federatedID,carol@example.com,',
+                                         'enterpriseID,dave,example.com']
+    reader = make_processor(stray_list_input_path=stray_list)
+    assert reader.get_stray_keys() == processor.get_stray_keys()
+
+
+PER_USER_HOOK = """
+if source_attributes.get('bc'):
+    target_attributes['country'] = source_attributes['bc'][0:2]
+    target_groups.add('Group B')
+"""
+
+BATCH_HOOK = """
+hook_storage = (hook_storage or 0) + 1
+for user in users:
+    if user['source_attributes'].get('bc'):
+        user['target_attributes']['country'] = user['source_attributes']['bc'][0:2]
+        user['target_groups'].add('Group B')
+"""
+
+
+@pytest.mark.parametrize('hook_option,processes', [('after_mapping_hook', 1), ('after_mapping_hook', 2),
+                                                   ('batch_after_mapping_hook', 1)])
+def test_after_mapping_hooks(hook_option, processes, mappings, directory_connector):
+    AdobeGroup('Group B', None)
+    directory_users = [directory_user('user%d' % i, ['Staff']) for i in range(5)]
+    for user in directory_users[::2]:
+        user['source_attributes'] = {'bc': 'DEX'}
+    hook = compile(PER_USER_HOOK if hook_option == 'after_mapping_hook' else BATCH_HOOK, '<hook>', 'exec')
+    processor = make_processor(after_mapping_hook_batch_size=2, after_mapping_hook_processes=processes,
+                               **{hook_option: hook})
+    processor.read_desired_user_groups(mappings, directory_connector(directory_users))
+
+    umapi_info = processor.get_umapi_info(None)
+    for i, user in enumerate(directory_users):
+        key = processor.get_directory_user_key(user)
+        assert user['country'] == ('DE' if i % 2 == 0 else 'US')
+        assert umapi_info.get_desired_groups(key) == ({'group a', 'group b'} if i % 2 == 0 else {'group a'})
+    if hook_option == 'batch_after_mapping_hook':
+        assert processor.batch_after_mapping_hook_scope['hook_storage'] == 3
+
+
+def test_hook_pool_with_prefetch(mappings, secondary_names, directory_connector, monkeypatch):
+    directory_users = [directory_user('user%d' % i, ['Staff']) for i in range(5)]
+    for user in directory_users[::2]:
+        user['source_attributes'] = {'bc': 'DEX'}
+    primary = FakeUmapiConnector(None, [umapi_user('user%d' % i) for i in range(5)])
+    processor = make_processor(prefetch_umapi_users=True, after_mapping_hook_batch_size=2,
+                               after_mapping_hook_processes=2,
+                               after_mapping_hook=compile(PER_USER_HOOK, '<hook>', 'exec'))
+    # the workers must exist before the prefetch threads do
+    pools_at_prefetch = []
+    start_umapi_user_prefetch = processor.start_umapi_user_prefetch
+    monkeypatch.setattr(processor, 'start_umapi_user_prefetch', lambda umapi_connectors: (
+        pools_at_prefetch.append(processor.hook_pool), start_umapi_user_prefetch(umapi_connectors)))
+    processor.run(mappings, directory_connector(directory_users), UmapiConnectors(primary, {}))
+
+    assert len(pools_at_prefetch) == 1 and pools_at_prefetch[0] is not None
+    assert processor.hook_pool is None
+    assert primary.thread_names == {'prefetch-umapi'}
+    assert [user['country'] for user in directory_users] == ['DE', 'US', 'DE', 'US', 'DE']
+    assert len(primary.commands) == 5
+
+
+def test_hook_pool_closed_on_error(mappings, directory_connector):
+    def failing_users():
+        for i in range(5):
+            yield directory_user('user%d' % i, ['Staff'])
+        raise RuntimeError('directory read failed')
+
+    hook = compile(PER_USER_HOOK, '<hook>', 'exec')
+    processor = make_processor(after_mapping_hook=hook, after_mapping_hook_batch_size=2,
+                               after_mapping_hook_processes=2)
+    with pytest.raises(RuntimeError):
+        processor.read_desired_user_groups(mappings, directory_connector(failing_users()))
+    assert processor.hook_pool is None and not processor.pending_hook_chunks
+
+
+def additional_group_rules(*rules):
+    return [{'source': re.compile(source), 'target': AdobeGroup.create(target, index=False)}
+            for source, target in rules]
+
+
+def test_additional_group_matcher():
+    rules = additional_group_rules((r'ACL-(.+)', r'\1 Users'), (r'ACL-Admin-(.+)', r'secondary::\1 Admins'),
+                                   (r'(?i)acl-x', 'X'))
+    matcher = AdditionalGroupMatcher(rules)
+    # the inline flag applies to the whole pattern, so it can't be part of an alternation
+    assert matcher.prefilter is None
+    matcher = AdditionalGroupMatcher(rules[:2])
+    assert matcher.prefilter is not None
+    assert matcher.resolve('Staff') == []
+    assert matcher.resolve('ACL-Admin-Design') == [(None, 'Admin-Design Users'), ('secondary', 'Design Admins')]
+    backreference = additional_group_rules((r'(A)\1', 'Double A'), (r'B', 'B'))
+    assert AdditionalGroupMatcher(backreference).prefilter is None
+    assert AdditionalGroupMatcher(backreference).resolve('AA') == [(None, 'Double A')]
+
+
+def test_additional_groups(directory_connector):
+    AdobeGroup.index_map = {}
+    rules = additional_group_rules((r'ACL-(.+)', r'\1 Users'), (r'ACL-Design', 'Designers'))
+    directory_users = [directory_user('user%d' % i) for i in range(3)]
+    for user in directory_users:
+        user['member_groups'] = ['ACL-Design', 'Other']
+    processor = make_processor(additional_groups=rules)
+    processor.read_desired_user_groups({}, directory_connector(directory_users))
+
+    umapi_info = processor.get_umapi_info(None)
+    assert umapi_info.get_mapped_groups() == {'design users', 'designers'}
+    assert dict(umapi_info.get_additional_group_map()) == {'design users': ['ACL-Design'],
+                                                           'designers': ['ACL-Design']}
+    for user_key in umapi_info.get_desired_groups_by_user_key():
+        assert umapi_info.get_desired_groups(user_key) == {'design users', 'designers'}
+
+
+def test_adobe_user_exclusions():
+    patterns = [re.compile(r'\A' + p + r'\Z', re.UNICODE | re.IGNORECASE)
+                for p in [r'admin@example\.com', r'.*@Contractor\.example\.com', r'svc-\d+@.*', r'test.*']]
+    exclusions = AdobeUserExclusions(['adobeID'], {'excluded group'}, patterns)
+    assert exclusions.exact_usernames == {'admin@example.com': r'exclude_users: admin@example\.com'}
+    assert list(exclusions.suffixes) == ['@contractor.example.com']
+    assert exclusions.combined_pattern is not None
+
+    assert exclusions.match('adobeID', 'admin@example.com', set()) == 'type'
+    assert exclusions.match('federatedID', 'alice@example.com', {'excluded group', 'other'}) == 'group'
+    assert exclusions.match('federatedID', 'admin@example.com', set()) == 'name'
+    assert exclusions.match('federatedID', 'bob@contractor.example.com', set()) == 'name'
+    assert exclusions.match('federatedID', 'svc-12@example.com', set()) == 'name'
+    assert exclusions.match('federatedID', 'svc-x@example.com', set()) is None
+    assert exclusions.match('federatedID', 'tester@example.com', set()) == 'name'
+    assert exclusions.get_hit_counts() == [
+        ('exclude_identity_types: adobeID', 1),
+        ('exclude_adobe_groups: excluded group', 1),
+        (r'exclude_users: admin@example\.com', 1),
+        (r'exclude_users: .*@Contractor\.example\.com', 1),
+        (r'exclude_users: svc-\d+@.*', 1),
+        (r'exclude_users: test.*', 1),
+    ]
+
+
+def test_excluded_users_are_counted(mappings, directory_connector):
+    primary = FakeUmapiConnector(None, [umapi_user('alice'), umapi_user('admin'), umapi_user('carol')])
+    exclude_users = [re.compile(r'\Aadmin@.*\Z', re.UNICODE | re.IGNORECASE)]
+    processor = make_processor(exclude_users=exclude_users)
+    processor.run(mappings, directory_connector([directory_user('alice', ['Staff'])]), UmapiConnectors(primary, {}))
+    assert processor.action_summary['excluded_user_count'] == 1
+    assert processor.adobe_user_exclusions.get_hit_counts() == [(r'exclude_users: admin@.*', 1)]
+
+
+def test_sorted_spill_and_merge_join():
+    spill = SortedSpill(2, name='test')
+    for key in ['d', 'b', 'a', 'c', 'b']:
+        spill.add(key, key.upper())
+    assert len(spill.run_files) == 2
+    assert list(spill) == [('a', 'A'), ('b', 'B'), ('b', 'B'), ('c', 'C'), ('d', 'D')]
+    joined = list(merge_join(spill, [('b', 1), ('e', 2)]))
+    spill.close()
+    assert joined == [('a', ['A'], []), ('b', ['B', 'B'], [1]), ('c', ['C'], []), ('d', ['D'], []),
+                      ('e', [], [2])]
+
+
+@pytest.mark.parametrize('diff_engine', ['memory', 'merge'])
+def test_diff_engines(diff_engine, mappings, directory_connector):
+    directory_users = [directory_user('alice', ['Staff']), directory_user('bob', ['Staff']), directory_user('dave')]
+    primary = FakeUmapiConnector(None, [umapi_user('carol', ['group a']), umapi_user('alice'),
+                                        umapi_user('dave', ['group a']), umapi_user('alice')])
+    processor = make_processor(diff_engine=diff_engine, diff_run_size=2, stray_list_output_path=None,
+                               disentitle_strays=False, exclude_unmapped_users=True)
+    processor.run(mappings, directory_connector(directory_users), UmapiConnectors(primary, {}))
+
+    assert sorted((c.username, c.do_list[-1][0]) for c in primary.commands) == [
+        ('alice@example.com', 'add_to_groups'), ('bob@example.com', 'add_to_groups'),
+        ('carol@example.com', 'remove_from_groups'), ('dave@example.com', 'remove_from_groups')]
+    assert [str(k) for k in processor.get_stray_keys()] == ['federatedID,carol@example.com,']
+    assert processor.action_summary['directory_users_read'] == 3
+    assert processor.action_summary['primary_users_created'] == 1
+    assert processor.directory_spill is None
+
+
+def test_merge_diff_requires_primary_only(mappings, secondary_names, directory_connector):
+    secondaries = {name: FakeUmapiConnector(name, [], trusted=True) for name in secondary_names}
+    processor = make_processor(diff_engine='merge')
+    with pytest.raises(AssertionException):
+        processor.run(mappings, directory_connector([]), UmapiConnectors(FakeUmapiConnector(None, []), secondaries))
+
+
+def test_disk_user_stores(mappings, directory_connector, tmpdir):
+    directory_users = [directory_user('user%d' % i, ['Staff']) for i in range(6)]
+    primary = FakeUmapiConnector(None, [umapi_user('user%d' % i) for i in range(2, 8)])
+    processor = make_processor(user_store_max_memory_users=2, user_store_cache_size=1,
+                               user_store_directory=str(tmpdir), after_mapping_hook_batch_size=4,
+                               batch_after_mapping_hook=compile(BATCH_HOOK, '<hook>', 'exec'))
+    directory_users[0]['source_attributes'] = {'bc': 'DEX'}
+    processor.run(mappings, directory_connector(directory_users), UmapiConnectors(primary, {}))
+
+    assert processor.directory_user_by_user_key.is_on_disk()
+    assert processor.selected_directory_user_keys.is_on_disk()
+    assert processor.action_summary['directory_users_selected'] == 6
+    assert processor.get_umapi_info(None).umapi_user_by_user_key.is_on_disk()
+    # the hook's change to the first user was made after it went to disk
+    creates = {c.username: c.do_list[0][1] for c in primary.commands if c.do_list[0][0] == 'create'}
+    assert sorted(creates) == ['user0@example.com', 'user1@example.com']
+    assert creates['user0@example.com']['country'] == 'DE'
+    assert processor.action_summary['directory_users_read'] == 6
+    assert [str(k) for k in processor.get_stray_keys()] == ['federatedID,user6@example.com,',
+                                                            'federatedID,user7@example.com,']
+    assert os.listdir(str(tmpdir)) == []
+
+
+@pytest.mark.parametrize('diff_engine', ['memory', 'merge'])
+def test_disk_user_stores_removed_on_error(diff_engine, mappings, directory_connector, tmpdir):
+    def failing_users():
+        for i in range(4):
+            yield umapi_user('user%d' % i)
+        raise AssertionException('umapi read failed')
+
+    directory_users = [directory_user('user%d' % i, ['Staff']) for i in range(6)]
+    processor = make_processor(user_store_max_memory_users=2, user_store_cache_size=1, diff_run_size=2,
+                               user_store_directory=str(tmpdir), diff_engine=diff_engine)
+    with pytest.raises(AssertionException):
+        processor.run(mappings, directory_connector(directory_users),
+                      UmapiConnectors(FakeUmapiConnector(None, failing_users()), {}))
+    assert os.listdir(str(tmpdir)) == []
+
+
+@pytest.mark.parametrize('max_adobe_only_users,users_read', [(2, 3), ('20%', 2), ('50%', None)])
+def test_early_stray_limit(max_adobe_only_users, users_read, mappings, directory_connector):
+    directory_users = [directory_user('user%d' % i, ['Staff']) for i in range(5)]
+    # the Adobe-only users come first, as they might if the directory had lost users
+    primary = FakeUmapiConnector(None, [umapi_user('stray%d' % i) for i in range(3)] +
+                                 [umapi_user('user%d' % i) for i in range(5)])
+    processor = make_processor(max_adobe_only_users=max_adobe_only_users, remove_strays=True)
+    if users_read is None:
+        processor.run(mappings, directory_connector(directory_users), UmapiConnectors(primary, {}))
+        assert processor.action_summary['primary_strays_processed'] == 3
+        return
+    with pytest.raises(AssertionException):
+        processor.run(mappings, directory_connector(directory_users), UmapiConnectors(primary, {}))
+    assert primary.users_read == users_read
+
+
+def test_stray_limit_with_stray_list(mappings, directory_connector, tmpdir):
+    primary = FakeUmapiConnector(None, [umapi_user('stray%d' % i) for i in range(3)])
+    processor = make_processor(max_adobe_only_users=1, remove_strays=True,
+                               stray_list_output_path=str(tmpdir.join('strays.csv')))
+    processor.run(mappings, directory_connector([]), UmapiConnectors(primary, {}))
+    assert processor.action_summary['primary_strays_processed'] == 0
+    assert len(tmpdir.join('strays.csv').readlines()) == 4
+
+
+def test_group_bitsets():
+    umapi_info = UmapiTargetInfo(None)
+    umapi_info.add_mapped_group('Group A')
+    umapi_info.add_mapped_group('Group B')
+    key = UserKey('federatedID', 'alice@example.com', '')
+    umapi_info.add_desired_group_for(key, None)
+    assert umapi_info.get_desired_groups_by_user_key()[key] == 0
+    umapi_info.add_desired_group_for(key, 'GROUP B')
+    umapi_info.add_desired_group_for(key, 'Extra')
+    assert umapi_info.get_desired_groups(key) == {'group b', 'extra'}
+    assert umapi_info.get_mapped_group_bits() == 0b011
+    # groups that aren't indexed don't get bits
+    assert umapi_info.get_group_bits(['group a', 'other']) == 0b001
+    assert umapi_info.get_group_names(0b101) == {'group a', 'extra'}
+    assert umapi_info.pop_desired_groups(key) == 0b110
+    assert umapi_info.get_desired_groups(key) is None
@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+
+import pytest
+
+from user_sync.connector.umapi_groups import GroupCatalog
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return os.path.join(str(tmpdir), 'groups.json')
+
+
+class GroupReader(object):
+    def __init__(self, names):
+        self.names = names
+        self.read_count = 0
+
+    def __call__(self):
+        self.read_count += 1
+        return [{'groupName': name, 'memberCount': 0} for name in self.names]
+
+
+def make_catalog(cache_path=None, max_age_minutes=60):
+    catalog = GroupCatalog('org@AdobeOrg', logging.getLogger())
+    if cache_path:
+        catalog.set_cache(cache_path, max_age_minutes)
+    return catalog
+
+
+def test_index():
+    catalog = make_catalog()
+    read_groups = GroupReader(['Group A', 'group b'])
+    assert not catalog.is_loaded() and not catalog.contains('Group A')
+    assert len(catalog.get_groups(read_groups)) == 2
+    assert catalog.contains('group a') and catalog.contains(' Group B')
+    assert not catalog.contains('Group C')
+    catalog.get_groups(read_groups)
+    assert read_groups.read_count == 1
+    catalog.add_group('Group C')
+    assert catalog.contains('group c') and len(catalog.get_groups(read_groups)) == 3
+    catalog.invalidate()
+    assert not catalog.contains('Group C')
+    catalog.get_groups(read_groups)
+    assert read_groups.read_count == 2
+
+
+def test_cache(cache_path):
+    read_groups = GroupReader(['Group A'])
+    make_catalog(cache_path).get_groups(read_groups)
+    assert os.path.exists(cache_path)
+    # a later run uses the cache
+    catalog = make_catalog(cache_path)
+    assert catalog.get_groups(read_groups)[0]['groupName'] == 'Group A'
+    assert read_groups.read_count == 1
+    # creating a group makes the cache out of date
+    catalog.add_group('Group B')
+    assert not os.path.exists(cache_path)
+    assert make_catalog(cache_path).get_groups(read_groups) == read_groups()
+
+
+def test_cache_expires(cache_path):
+    read_groups = GroupReader(['Group A'])
+    make_catalog(cache_path).get_groups(read_groups)
+    with open(cache_path) as f:
+        content = json.load(f)
+    content['saved_at'] -= 3600
+    with open(cache_path, 'w') as f:
+        json.dump(content, f)
+    make_catalog(cache_path).get_groups(read_groups)
+    assert read_groups.read_count == 2
+    # a cache for another org is never used
+    other = GroupCatalog('other@AdobeOrg', logging.getLogger())
+    other.set_cache(cache_path, 60)
+    other.get_groups(read_groups)
+    assert read_groups.read_count == 3
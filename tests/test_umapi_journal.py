@@ -0,0 +1,47 @@
+import json
+import logging
+import os
+
+import umapi_client
+
+from user_sync.connector.connector_umapi import ActionManager
+from user_sync.connector.umapi_journal import ActionJournal
+
+
+class Connection(object):
+    throttle_actions = 10
+
+    def execute_multiple(self, actions, immediate=True):
+        for action in actions:
+            if action.frame['user'] == 'bad@example.com':
+                action.report_command_error({'index': 0, 'step': 0, 'errorCode': 'error.test', 'message': 'bad'})
+        return 0, len(actions), len(actions)
+
+
+def test_journal(tmpdir):
+    path = os.path.join(str(tmpdir), 'actions.jsonl')
+    journal = ActionJournal(path)
+    action_manager = ActionManager(Connection(), 'org@AdobeOrg', logging.getLogger())
+    action_manager.set_journal(journal)
+    for email in ('user@example.com', 'bad@example.com'):
+        action = umapi_client.UserAction(umapi_client.IdentityTypes.federatedID, email, requestID=email)
+        action.add_to_groups(groups=['Group A'])
+        action_manager.add_action(action)
+    action_manager.flush()
+    journal.close()
+
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+    assert [(e['org_id'], e['action']['user'], e['success']) for e in entries] == \
+        [('org@AdobeOrg', 'user@example.com', True), ('org@AdobeOrg', 'bad@example.com', False)]
+    assert entries[0]['action']['do'] == [{'add': {'group': ['Group A']}}]
+    assert 'errors' not in entries[0] and entries[1]['errors'][0]['errorCode'] == 'error.test'
+
+    # a later run adds to the same journal
+    journal = ActionJournal(path)
+    action_manager.set_journal(journal)
+    action_manager.add_action(umapi_client.UserAction(umapi_client.IdentityTypes.federatedID, 'user@example.com'))
+    action_manager.flush()
+    journal.close()
+    with open(path) as f:
+        assert len(f.readlines()) == 3
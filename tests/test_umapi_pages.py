@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from user_sync.connector.umapi_pages import PageSpool, ParallelUsersQuery
+
+
+class PagedConnection(object):
+    """Serves users a page at a time, slowly, like the UMAPI user query"""
+
+    def __init__(self, user_count, page_size=3, delay=0.01, reports_page_count=True):
+        self.users = [{'email': 'user%d@example.com' % i} for i in range(user_count)]
+        self.page_size = page_size
+        self.delay = delay
+        self.reports_page_count = reports_page_count
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.pages = []
+        self.on_page = None
+
+    def query_multiple(self, object_type, page=0, url_params=None, query_params=None):
+        assert object_type == 'user' and query_params == {'directOnly': True}
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.pages.append(page)
+        # later pages answer first, to check the ordering
+        time.sleep(self.delay / (page + 1))
+        if self.on_page:
+            self.on_page(page)
+        with self.lock:
+            self.in_flight -= 1
+            page_count = (len(self.users) + self.page_size - 1) // self.page_size
+            values = self.users[page * self.page_size:(page + 1) * self.page_size]
+            return (values, page >= page_count - 1, len(self.users), page_count if self.reports_page_count else 0,
+                    page + 1, self.page_size)
+
+
+def emails(users):
+    return [u['email'] for u in users]
+
+
+@pytest.mark.parametrize('max_concurrent_pages', [1, 4])
+def test_ordered(max_concurrent_pages):
+    connection = PagedConnection(20)
+    query = ParallelUsersQuery(connection, max_concurrent_pages=max_concurrent_pages)
+    assert emails(query) == emails(connection.users)
+    assert query.stats() == (20, 7, 3, 7)
+    assert connection.max_in_flight == max_concurrent_pages
+
+
+def test_unordered():
+    connection = PagedConnection(20)
+    users = ParallelUsersQuery(connection, max_concurrent_pages=4, ordered=False).all_results()
+    assert sorted(emails(users)) == sorted(emails(connection.users))
+    assert emails(users) != emails(connection.users)
+
+
+def test_single_page():
+    connection = PagedConnection(2)
+    assert len(ParallelUsersQuery(connection).all_results()) == 2
+    assert connection.pages == [0]
+
+
+@pytest.mark.parametrize('max_concurrent_pages', [1, 4])
+def test_unknown_page_count(max_concurrent_pages):
+    # without a page count, pages are read one at a time until the last
+    connection = PagedConnection(20, reports_page_count=False)
+    query = ParallelUsersQuery(connection, max_concurrent_pages=max_concurrent_pages)
+    assert emails(query) == emails(connection.users)
+    assert connection.pages == list(range(7))
+    assert connection.max_in_flight == 1
+
+
+def test_changes_during_read():
+    connection = PagedConnection(9)
+
+    def change_users(page):
+        # a user is added at the front while the last page is read, pushing a user
+        # already read onto the last page, and another onto a page nobody expected
+        if page == 2:
+            with connection.lock:
+                connection.users.insert(0, {'email': 'new@example.com'})
+
+    connection.on_page = change_users
+    users = ParallelUsersQuery(connection, max_concurrent_pages=4).all_results()
+    assert sorted(emails(users)) == sorted(emails(connection.users[1:]))
+    assert connection.pages == [0, 1, 2, 3]
+
+
+def test_error():
+    connection = PagedConnection(20)
+
+    def fail(page):
+        if page == 3:
+            raise RuntimeError('server error')
+
+    connection.on_page = fail
+    with pytest.raises(RuntimeError):
+        ParallelUsersQuery(connection, max_concurrent_pages=4).all_results()
+
+
+@pytest.fixture
+def spool_path(tmpdir):
+    return os.path.join(str(tmpdir), 'pages.jsonl')
+
+
+def make_spool(spool_path, max_age_minutes=60):
+    return PageSpool(spool_path, 'org@AdobeOrg', max_age_minutes, logging.getLogger())
+
+
+def fail_on(connection, failed_page):
+    def fail(page):
+        if page == failed_page:
+            raise RuntimeError('server error')
+
+    connection.on_page = fail
+
+
+@pytest.mark.parametrize('max_concurrent_pages', [1, 4])
+def test_spool_resume(spool_path, max_concurrent_pages):
+    connection = PagedConnection(20)
+    fail_on(connection, 4)
+    query = ParallelUsersQuery(connection, max_concurrent_pages=max_concurrent_pages, spool=make_spool(spool_path))
+    with pytest.raises(RuntimeError):
+        query.all_results()
+    assert os.path.exists(spool_path)
+    # the run died part way through writing a page
+    with open(spool_path, 'a') as f:
+        f.write('{"page": 5, "us')
+
+    connection.on_page = None
+    connection.pages = []
+    query = ParallelUsersQuery(connection, max_concurrent_pages=max_concurrent_pages, spool=make_spool(spool_path))
+    users = query.all_results()
+    assert sorted(emails(users)) == sorted(emails(connection.users))
+    assert 0 not in connection.pages and 4 in connection.pages
+    assert query.stats() == (20, 7, 3, 7)
+    assert not os.path.exists(spool_path)
+
+
+def test_spool_too_old(spool_path):
+    connection = PagedConnection(20)
+    fail_on(connection, 4)
+    with pytest.raises(RuntimeError):
+        ParallelUsersQuery(connection, spool=make_spool(spool_path)).all_results()
+    with open(spool_path) as f:
+        lines = f.readlines()
+    header = json.loads(lines[0])
+    header['started'] -= 3600
+    with open(spool_path, 'w') as f:
+        f.write(json.dumps(header) + '\n' + ''.join(lines[1:]))
+
+    connection.on_page = None
+    connection.pages = []
+    assert len(ParallelUsersQuery(connection, spool=make_spool(spool_path)).all_results()) == 20
+    assert connection.pages == list(range(7))
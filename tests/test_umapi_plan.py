@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+
+import pytest
+import umapi_client
+
+from user_sync.connector.connector_umapi import ActionManager, Commands, UmapiConnector
+from user_sync.connector.umapi_groups import GroupCatalog
+from user_sync.connector.umapi_plan import UmapiPlanWriter, apply_plan
+from user_sync.engine.umapi import UmapiConnectors
+from user_sync.error import AssertionException
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.sent = []
+
+    def execute_single(self, action, immediate=False):
+        return self.execute_multiple([action])
+
+    def execute_multiple(self, actions, immediate=True):
+        self.sent.extend(action.wire_dict() for action in actions)
+        return 0, len(actions), len(actions)
+
+
+def make_connectors(org_id='org@AdobeOrg', secondary_org_id=None):
+    connector = make_connector('umapi', org_id)
+    secondary_connectors = {}
+    if secondary_org_id:
+        secondary_connectors['secondary'] = make_connector('umapi.secondary', secondary_org_id, connector.connection)
+    return UmapiConnectors(connector, secondary_connectors)
+
+
+def make_connector(name, org_id, connection=None):
+    connector = UmapiConnector.__new__(UmapiConnector)
+    connector.name = name
+    connector.org_id = org_id
+    connector.logger = logging.getLogger()
+    connector.plan = None
+    connector.write_ahead_log = None
+    connector.snapshot = None
+    connector.group_catalog = GroupCatalog(org_id, logging.getLogger())
+    connector.connection = connection or FakeConnection()
+    connector.action_manager = ActionManager(connector.connection, org_id, logging.getLogger())
+    return connector
+
+
+@pytest.fixture
+def plan_path(tmpdir):
+    return os.path.join(str(tmpdir), 'plan.jsonl')
+
+
+def make_commands():
+    commands = Commands('federatedID', 'user@example.com', 'user@example.com', 'example.com')
+    commands.add_user({'email': 'user@example.com', 'firstname': 'Example', 'option': 'updateIfAlreadyExists'})
+    commands.add_groups({'Group B', 'Group A'})
+    return commands
+
+
+def test_commands_round_trip():
+    commands = make_commands()
+    restored = Commands.from_dict(json.loads(json.dumps(commands.to_dict())))
+    assert restored.username == 'user@example.com' and restored.identity_type == 'federatedID'
+    assert restored.do_list == [
+        ('create', {'email': 'user@example.com', 'first_name': 'Example',
+                    'on_conflict': umapi_client.IfAlreadyExistsOptions.updateIfAlreadyExists}),
+        ('add_to_groups', {'groups': ['Group A', 'Group B']}),
+    ]
+    with pytest.raises(ValueError):
+        Commands.from_dict({'username': 'user@example.com', 'do_list': [['__init__', {}]]})
+
+
+def test_write_and_apply(plan_path):
+    connectors = make_connectors()
+    connector = connectors.get_primary_connector()
+    plan = UmapiPlanWriter(plan_path, connectors.connectors)
+    connector.create_group('New Group')
+    connector.send_commands(make_commands())
+    connector.send_commands(Commands('federatedID', 'none@example.com', 'none@example.com', 'example.com'))
+    # nothing is sent, and the plan only appears once it's finished
+    assert connector.connection.sent == [] and not os.path.exists(plan_path)
+    plan.close()
+    assert plan.action_count == 1
+    with open(plan_path) as f:
+        assert len(f.readlines()) == 3
+
+    connectors = make_connectors()
+    assert apply_plan(plan_path, connectors, logging.getLogger()) == 1
+    sent = connectors.get_primary_connector().connection.sent
+    assert sent[0]['usergroup'] == 'New Group'
+    assert sent[1]['user'] == 'user@example.com'
+    assert [list(step) for step in sent[1]['do']] == [['createFederatedID'], ['add']]
+    assert connectors.get_primary_connector().get_action_manager().get_statistics() == (1, 0)
+
+
+def test_discarded_plan(plan_path):
+    plan = UmapiPlanWriter(plan_path, make_connectors().connectors)
+    plan.discard()
+    assert os.listdir(os.path.dirname(plan_path)) == []
+
+
+def test_plan_for_other_org(plan_path):
+    UmapiPlanWriter(plan_path, make_connectors().connectors).close()
+    with pytest.raises(AssertionException):
+        apply_plan(plan_path, make_connectors('other@AdobeOrg'), logging.getLogger())
+
+
+def test_apply_keeps_org_order(plan_path):
+    connectors = make_connectors(secondary_org_id='secondary@AdobeOrg')
+    primary = connectors.get_primary_connector()
+    secondary = connectors.get_secondary_connectors()['secondary']
+    plan = UmapiPlanWriter(plan_path, connectors.connectors)
+    for i in range(3):
+        commands = Commands('federatedID', 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+        commands.remove_from_org(False)
+        secondary.send_commands(commands)
+    for i in range(10):
+        commands = Commands('federatedID', 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+        commands.remove_from_org(True)
+        primary.send_commands(commands)
+    plan.close()
+
+    connectors = make_connectors(secondary_org_id='secondary@AdobeOrg')
+    assert apply_plan(plan_path, connectors, logging.getLogger()) == 13
+    # the secondary removals are all sent before any of the primary deletes
+    sent = connectors.get_primary_connector().connection.sent
+    assert [action['do'][0]['removeFromOrg']['deleteAccount'] for action in sent] == [False] * 3 + [True] * 10
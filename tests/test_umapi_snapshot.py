@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import time
+
+import pytest
+
+from user_sync.connector.connector_umapi import Commands
+from user_sync.connector.umapi_snapshot import UmapiSnapshot
+
+
+@pytest.fixture
+def snapshot_path(tmpdir):
+    return os.path.join(str(tmpdir), 'snapshot.json')
+
+
+def make_snapshot(path, refresh_runs=10, refresh_hours=24, read_only=False):
+    return UmapiSnapshot(path, 'org@AdobeOrg', refresh_runs, refresh_hours, read_only, logging.getLogger())
+
+
+def refreshed_snapshot(path, users, **kwargs):
+    snapshot = make_snapshot(path, **kwargs)
+    snapshot.start_refresh()
+    for user in users:
+        snapshot.add_user(user)
+    snapshot.finish_refresh()
+    return snapshot
+
+
+def test_save_and_load(snapshot_path, example_user):
+    refreshed_snapshot(snapshot_path, [example_user]).save()
+    snapshot = make_snapshot(snapshot_path)
+    snapshot.load()
+    assert snapshot.is_fresh()
+    assert [u['email'] for u in snapshot.iter_users()] == ['user@example.com']
+    # the file is out of date once loaded, until the run saves it again
+    assert not os.path.exists(snapshot_path)
+    snapshot.save()
+    with open(snapshot_path) as f:
+        assert json.load(f)['run_count'] == 1
+
+
+def test_refresh_policy(snapshot_path, example_user):
+    snapshot = refreshed_snapshot(snapshot_path, [example_user], refresh_runs=2)
+    assert snapshot.is_fresh()
+    snapshot.run_count = 2
+    assert not snapshot.is_fresh()
+    snapshot = refreshed_snapshot(snapshot_path, [example_user], refresh_hours=1)
+    snapshot.refreshed_at = time.time() - 3601
+    assert not snapshot.is_fresh()
+
+
+def test_incomplete_read_is_not_saved(snapshot_path, example_user):
+    snapshot = make_snapshot(snapshot_path)
+    snapshot.start_refresh()
+    snapshot.add_user(example_user)
+    snapshot.save()
+    assert not os.path.exists(snapshot_path)
+
+
+def test_test_mode_is_read_only(snapshot_path, example_user):
+    refreshed_snapshot(snapshot_path, [example_user]).save()
+    snapshot = make_snapshot(snapshot_path, read_only=True)
+    snapshot.load()
+    assert os.path.exists(snapshot_path)
+    assert snapshot.track(Commands(), None) is None
+
+
+def test_apply_commands(snapshot_path, example_user):
+    snapshot = refreshed_snapshot(snapshot_path, [example_user])
+
+    commands = Commands('federatedID', 'user@example.com', 'user@example.com', 'example.com')
+    commands.update_user({'firstname': 'Changed'})
+    commands.add_groups({'Group A', 'Group B'})
+    snapshot.track(commands)({'is_success': True})
+    commands = Commands('federatedID', 'user@example.com', 'user@example.com', 'example.com')
+    commands.remove_groups({'group a'})
+    snapshot.track(commands)({'is_success': True})
+    user = snapshot.user_by_email['user@example.com']
+    assert user['firstname'] == 'Changed'
+    assert user['groups'] == ['Group B']
+
+    commands = Commands('federatedID', 'new@example.com', 'new@example.com', 'example.com')
+    commands.add_user({'email': 'new@example.com', 'firstname': 'New', 'option': 'ignoreIfAlreadyExists'})
+    snapshot.track(commands)({'is_success': False})
+    assert 'new@example.com' not in snapshot.user_by_email
+    snapshot.track(commands)({'is_success': True})
+    assert snapshot.user_by_email['new@example.com']['firstname'] == 'New'
+
+    commands = Commands(username='user@example.com', domain='example.com')
+    commands.remove_from_org(False)
+    snapshot.track(commands)({'is_success': True})
+    assert list(snapshot.user_by_email) == ['new@example.com']
+
+
+def test_find_by_username(snapshot_path):
+    users = [{'email': 'user%d@example.com' % i, 'username': 'User%d' % i, 'domain': 'example.com',
+              'type': 'federatedID', 'groups': []} for i in range(3)]
+    users.append({'email': 'user1@other.com', 'username': 'user1', 'domain': 'other.com',
+                  'type': 'federatedID', 'groups': []})
+    refreshed_snapshot(snapshot_path, users).save()
+    snapshot = make_snapshot(snapshot_path)
+    snapshot.load()
+
+    # stray commands have no email, just the username and domain
+    commands = Commands(username='user1', domain='other.com')
+    assert snapshot.find_user(commands)['email'] == 'user1@other.com'
+    commands.remove_from_org(False)
+    snapshot.apply(commands)
+    assert 'user1@other.com' not in snapshot.user_by_email
+    assert snapshot.find_user(Commands(username='user1', domain='other.com')) is None
+    assert snapshot.find_user(Commands(username='user1', domain='example.com'))['email'] == 'user1@example.com'
+
+    commands = Commands('federatedID', 'user2@example.com', 'user2', 'example.com')
+    commands.update_user({'username': 'renamed'})
+    snapshot.apply(commands)
+    assert snapshot.find_user(Commands(username='user2', domain='example.com')) is None
+    assert snapshot.find_user(Commands(username='Renamed', domain='example.com'))['email'] == 'user2@example.com'
+
+    commands = Commands('federatedID', 'new@example.com', 'newuser', 'example.com')
+    commands.add_user({'email': 'new@example.com', 'option': 'ignoreIfAlreadyExists'})
+    snapshot.apply(commands)
+    assert snapshot.find_user(Commands(username='newuser', domain='example.com'))['email'] == 'new@example.com'
@@ -0,0 +1,135 @@
+import threading
+
+import pytest
+
+from user_sync.connector import umapi_throttle
+from user_sync.connector.umapi_throttle import UmapiThrottle, get_throttle
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_throttle(clock, max_rate=None):
+    return UmapiThrottle('org@AdobeOrg', max_rate, clock=clock, sleep=clock.sleep)
+
+
+def test_no_limit(clock):
+    throttle = make_throttle(clock)
+    for _ in range(100):
+        throttle.acquire()
+        throttle.record_response(200, None, 0.1)
+    assert clock.sleeps == [] and throttle.rate is None
+
+
+def test_rate_limit(clock):
+    throttle = make_throttle(clock, max_rate=2)
+    for _ in range(5):
+        throttle.acquire()
+    assert clock.sleeps == [0.5] * 4
+    assert throttle.request_count == 5
+
+
+def test_retry_after(clock):
+    throttle = make_throttle(clock, max_rate=4)
+    throttle.acquire()
+    throttle.record_response(429, '5', 0.1)
+    assert throttle.rate == 2
+    # the other threads wait for the time the server asked for
+    other = threading.Thread(target=throttle.acquire)
+    other.start()
+    other.join()
+    assert sum(clock.sleeps) >= 5
+    # good responses bring the rate back up to the limit...
+    for _ in range(30):
+        throttle.record_response(200, None, 0.1)
+    assert throttle.rate == 4
+    # ...but not while responses are slowing down
+    throttle.record_response(429, None, 0.1)
+    for _ in range(30):
+        throttle.record_response(200, None, 1.0)
+    assert throttle.rate == 2
+
+
+def test_retry_not_paused_twice(clock):
+    throttle = make_throttle(clock, max_rate=4)
+    throttle.acquire()
+    throttle.record_response(429, '5', 0.1)
+    # the client waits out Retry-After before it retries, so the retry isn't held back again
+    throttle.acquire()
+    assert clock.sleeps == [0.5]
+
+
+def test_throttled_without_limit(clock):
+    throttle = make_throttle(clock)
+    for _ in range(10):
+        throttle.acquire()
+        clock.now += 0.1
+    throttle.record_response(429, 'soon', 0.1)
+    # we were doing 10 requests per second, so now we do 5
+    assert throttle.rate == pytest.approx(5)
+    assert throttle.paused_until == clock.now
+
+
+def test_recovers_to_throttled_rate(clock):
+    throttle = make_throttle(clock)
+    for _ in range(10):
+        throttle.acquire()
+        clock.now += 0.1
+    throttle.record_response(429, None, 0.1)
+    # without a limit, the rate goes back up to the rate that was throttled, and no further
+    for _ in range(500):
+        throttle.record_response(200, None, 0.1)
+    assert throttle.rate == pytest.approx(10)
+
+
+def test_statistics(clock):
+    throttle = make_throttle(clock)
+    throttle.acquire()
+    throttle.add_actions(10)
+    clock.now += 2
+    throttle.record_response(200, None, 2)
+    assert throttle.describe() == \
+        '10 actions in 1 requests (5.0 actions per second), 0 throttled responses, no limit'
+
+
+def test_shared_by_org(monkeypatch):
+    monkeypatch.setattr(umapi_throttle, 'throttle_by_org_id', {})
+    throttle = get_throttle('org@AdobeOrg')
+    assert get_throttle('org@AdobeOrg', 10) is throttle and throttle.max_rate == 10
+    assert get_throttle('org@AdobeOrg', 20).max_rate == 10
+    assert get_throttle('other@AdobeOrg') is not throttle
+
+
+def test_install(clock):
+    class Response(object):
+        status_code = 429
+        headers = {'Retry-After': '3'}
+
+    class Session(object):
+        def request(self, method, url, **kwargs):
+            clock.now += 0.5
+            return Response()
+
+        def post(self, url, **kwargs):
+            return self.request('POST', url, **kwargs)
+
+    throttle = make_throttle(clock, max_rate=10)
+    session = Session()
+    throttle.install(session)
+    assert session.post('https://example.com', data='x').status_code == 429
+    assert throttle.throttled_count == 1 and throttle.paused_until == clock.now + 3
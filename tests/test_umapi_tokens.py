@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import time
+
+import pytest
+import requests
+import umapi_client.auth
+from Crypto.PublicKey import RSA
+
+from user_sync.config.common import DictConfig
+from user_sync.connector import umapi_util
+from user_sync.connector.umapi_tokens import TokenCache
+from user_sync.connector.umapi_util import make_auth, make_auth_dict
+from user_sync.encryption import encrypt
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return os.path.join(str(tmpdir), 'tokens.json')
+
+
+def test_round_trip(cache_path):
+    cache = TokenCache(cache_path, 60)
+    assert cache.get_token('org@AdobeOrg', 'tech@techacct.adobe.com', 'client', 'secret') is None
+    cache.add_token('org@AdobeOrg', 'tech@techacct.adobe.com', 'client', 'secret', 'token-1', time.time() + 86400)
+    cache.add_token('other@AdobeOrg', 'tech@techacct.adobe.com', 'client', 'secret2', 'token-2', time.time() + 86400)
+    cache = TokenCache(cache_path, 60)
+    assert cache.get_token('org@AdobeOrg', 'tech@techacct.adobe.com', 'client', 'secret') == 'token-1'
+    assert cache.get_token('other@AdobeOrg', 'tech@techacct.adobe.com', 'client', 'secret2') == 'token-2'
+    # the tokens aren't readable without the client secret
+    with open(cache_path) as f:
+        assert 'token-1' not in f.read()
+    assert cache.get_token('org@AdobeOrg', 'tech@techacct.adobe.com', 'client', 'wrong') is None
+    assert cache.get_token('org@AdobeOrg', 'other@techacct.adobe.com', 'client', 'secret') is None
+
+
+def test_expiry(cache_path):
+    cache = TokenCache(cache_path, 60)
+    cache.add_token('org@AdobeOrg', 'tech', 'client', 'secret', 'old', time.time() - 1)
+    cache.add_token('org@AdobeOrg', 'tech2', 'client', 'secret', 'soon', time.time() + 1800)
+    assert cache.get_token('org@AdobeOrg', 'tech2', 'client', 'secret') is None
+    assert TokenCache(cache_path, 10).get_token('org@AdobeOrg', 'tech2', 'client', 'secret') == 'soon'
+    # expired tokens are dropped when the cache is written
+    with open(cache_path) as f:
+        assert len(json.load(f)['tokens']) == 1
+
+
+def test_damaged_cache(cache_path):
+    with open(cache_path, 'w') as f:
+        f.write('{"version": 1, "tok')
+    cache = TokenCache(cache_path, 60)
+    assert cache.get_token('org@AdobeOrg', 'tech', 'client', 'secret') is None
+    cache.add_token('org@AdobeOrg', 'tech', 'client', 'secret', 'token', time.time() + 86400)
+    assert cache.get_token('org@AdobeOrg', 'tech', 'client', 'secret') == 'token'
+
+
+def test_cached_token_skips_key(cache_path, monkeypatch):
+    cache = TokenCache(cache_path, 60)
+    cache.add_token('org@AdobeOrg', 'tech', 'client', 'secret', 'token', time.time() + 86400)
+    config = DictConfig('enterprise', {'client_id': 'client', 'client_secret': 'secret',
+                                       'priv_key_data': 'encrypted key', 'priv_key_pass': 'pass'})
+    monkeypatch.setattr(umapi_util, 'decrypt', pytest.fail)
+    auth_dict = make_auth_dict('umapi', config, 'org@AdobeOrg', 'tech', logging.getLogger(), cache)
+    assert auth_dict['access_token'] == 'token' and 'private_key_data' not in auth_dict
+    # the key settings are still used, so they aren't reported as unused
+    assert list(config.iter_unused_keys()) == []
+    auth = make_auth(auth_dict, 'ims-na1.adobelogin.com', '/ims/exchange/jwt', True, cache)
+    assert auth.access_token == 'token' and auth.api_key == 'client'
+
+
+def test_expiring_token_is_replaced(cache_path, monkeypatch):
+    def access_request(self):
+        self.set_expiry(86400 * 1000)
+        return 'new-token'
+
+    monkeypatch.setattr(umapi_client.auth.AccessRequest, '__call__', access_request)
+    private_key = RSA.generate(2048).export_key().decode('ascii')
+    cache = TokenCache(cache_path, 60)
+    cache.add_token('org@AdobeOrg', 'tech', 'client', 'secret', 'token', time.time() + 7200)
+    config = DictConfig('enterprise', {'client_id': 'client', 'client_secret': 'secret',
+                                       'priv_key_data': encrypt('pass', private_key), 'priv_key_pass': 'pass'})
+    auth_dict = make_auth_dict('umapi', config, 'org@AdobeOrg', 'tech', logging.getLogger(), cache)
+    auth = make_auth(auth_dict, 'ims-na1.adobelogin.com', '/ims/exchange/jwt', True, cache)
+    request = requests.Request('GET', 'https://usermanagement.adobe.io/')
+    assert auth(request).headers['Authorization'] == 'Bearer token'
+    # the run has gone on until the token is about to expire
+    auth.clock = lambda: time.time() + 7000
+    assert auth(request).headers['Authorization'] == 'Bearer new-token'
+    assert auth_dict['private_key_data'] == private_key
+    assert cache.get_token('org@AdobeOrg', 'tech', 'client', 'secret') == 'new-token'
+
+
+def test_new_token_is_cached(cache_path, monkeypatch):
+    def access_request(self):
+        assert self.jwt_token and self.endpoint == 'https://ims-na1.adobelogin.com/ims/exchange/jwt'
+        self.set_expiry(86400 * 1000)
+        return 'new-token'
+
+    monkeypatch.setattr(umapi_client.auth.AccessRequest, '__call__', access_request)
+    cache = TokenCache(cache_path, 60)
+    config = DictConfig('enterprise', {'client_id': 'client', 'client_secret': 'secret',
+                                       'priv_key_data': RSA.generate(2048).export_key().decode('ascii')})
+    auth_dict = make_auth_dict('umapi', config, 'org@AdobeOrg', 'tech', logging.getLogger(), cache)
+    assert 'access_token' not in auth_dict
+    assert make_auth(auth_dict, 'ims-na1.adobelogin.com', '/ims/exchange/jwt', True, cache).access_token == 'new-token'
+    assert cache.get_token('org@AdobeOrg', 'tech', 'client', 'secret') == 'new-token'
@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+
+import pytest
+
+from user_sync.connector.connector_umapi import ActionManager, Commands, UmapiConnector
+from user_sync.connector.umapi_groups import GroupCatalog
+from user_sync.connector.umapi_wal import WriteAheadLog, resume_actions
+from user_sync.engine.umapi import UmapiConnectors
+from user_sync.error import AssertionException
+
+
+class FakeConnection(object):
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    def execute_single(self, action, immediate=False):
+        return self.execute_multiple([action])
+
+    def execute_multiple(self, actions, immediate=True):
+        if self.fail:
+            raise RuntimeError('connection lost')
+        self.sent.extend(action.wire_dict() for action in actions)
+        return 0, len(actions), len(actions)
+
+
+@pytest.fixture
+def wal_path(tmpdir):
+    return os.path.join(str(tmpdir), 'actions.wal')
+
+
+def make_connector(wal_path, connection=None):
+    connector = UmapiConnector.__new__(UmapiConnector)
+    connector.name = 'umapi'
+    connector.org_id = 'org@AdobeOrg'
+    connector.logger = logging.getLogger()
+    connector.plan = None
+    connector.snapshot = None
+    connector.group_catalog = GroupCatalog('org@AdobeOrg', logging.getLogger())
+    connector.connection = connection or FakeConnection()
+    connector.write_ahead_log = WriteAheadLog(wal_path, connector.org_id, logging.getLogger())
+    connector.action_manager = ActionManager(connector.connection, connector.org_id, logging.getLogger())
+    connector.action_manager.set_write_ahead_log(connector.write_ahead_log)
+    return connector
+
+
+def make_commands(i):
+    commands = Commands('federatedID', 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+    commands.add_groups({'Group A'})
+    return commands
+
+
+def read_log(wal_path):
+    with open(wal_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_actions_are_logged_and_answered(wal_path):
+    connector = make_connector(wal_path)
+    connector.start_write_ahead_log()
+    for i in range(3):
+        connector.send_commands(make_commands(i))
+    connector.create_group('Group A')
+    UmapiConnectors(connector, {}).execute_actions()
+    connector.write_ahead_log.sync()
+    lines = read_log(wal_path)
+    assert lines[0] == {'version': 1, 'org_id': 'org@AdobeOrg'}
+    assert [line['seq'] for line in lines if 'seq' in line] == [1, 2, 3, 4]
+    assert lines.index({'sent': [1, 2, 3]}) < lines.index({'ack': 1, 'success': True})
+    assert {'ack': 4, 'success': True} in lines
+    assert {'complete': True} in lines
+    connector.close_write_ahead_log()
+    assert not os.path.exists(wal_path)
+
+
+def test_log_is_kept_when_not_complete(wal_path):
+    connector = make_connector(wal_path, FakeConnection(fail=True))
+    connector.start_write_ahead_log()
+    connector.send_commands(make_commands(1))
+    with pytest.raises(RuntimeError):
+        connector.get_action_manager().flush()
+    connector.close_write_ahead_log()
+    pending, complete = WriteAheadLog(wal_path, 'org@AdobeOrg', logging.getLogger()).read_pending()
+    assert not complete
+    assert [entry['username'] for entry in pending] == ['user1@example.com']
+
+
+def test_truncated_last_line(wal_path):
+    connector = make_connector(wal_path)
+    connector.start_write_ahead_log()
+    connector.send_commands(make_commands(1))
+    connector.write_ahead_log.sync()
+    with open(wal_path, 'a') as f:
+        f.write('{"seq": 2, "us')
+    pending, complete = WriteAheadLog(wal_path, 'org@AdobeOrg', logging.getLogger()).read_pending()
+    assert len(pending) == 1 and not complete
+    with open(wal_path, 'a') as f:
+        f.write('\n{}\n')
+    with pytest.raises(AssertionException):
+        WriteAheadLog(wal_path, 'org@AdobeOrg', logging.getLogger()).read_pending()
+
+
+def test_wrong_org(wal_path):
+    make_connector(wal_path).start_write_ahead_log()
+    with pytest.raises(AssertionException):
+        WriteAheadLog(wal_path, 'other@AdobeOrg', logging.getLogger()).read_pending()
+
+
+def test_resume(wal_path):
+    # a run that planned everything, but died with two users unanswered
+    connector = make_connector(wal_path)
+    log = connector.write_ahead_log
+    log.open()
+    for i in range(3):
+        log.add_commands(make_commands(i))
+    log.mark_sent([1, 2])
+    log.ack(1, True)
+    log.mark_complete()
+    log.file.close()
+
+    connector = make_connector(wal_path)
+    umapi_connectors = UmapiConnectors(connector, {})
+    assert resume_actions(umapi_connectors, logging.getLogger())
+    assert [action['user'] for action in connector.connection.sent] == ['user1@example.com', 'user2@example.com']
+    umapi_connectors.execute_actions()
+    connector.close_write_ahead_log()
+    assert not os.path.exists(wal_path)
+
+
+def test_resume_needs_log(wal_path):
+    connector = make_connector(wal_path)
+    connector.write_ahead_log = None
+    with pytest.raises(AssertionException):
+        resume_actions(UmapiConnectors(connector, {}), logging.getLogger())
+    # with no log from the last run, a full sync is needed
+    connector = make_connector(wal_path)
+    assert not resume_actions(UmapiConnectors(connector, {}), logging.getLogger())
+
+
+def write_unfinished_log(connector, commands_list):
+    log = connector.write_ahead_log
+    log.open()
+    for commands in commands_list:
+        log.add_commands(commands)
+    log.mark_complete()
+    log.file.close()
+
+
+def test_resume_secondary_first(tmpdir):
+    connection = FakeConnection()
+    primary = make_connector(os.path.join(str(tmpdir), 'primary.wal'), connection)
+    secondary = make_connector(os.path.join(str(tmpdir), 'secondary.wal'), connection)
+    secondary.name = 'umapi.secondary'
+    deletes = []
+    for i in range(12):
+        commands = Commands('federatedID', 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+        commands.remove_from_org(True)
+        deletes.append(commands)
+    removals = []
+    for i in range(3):
+        commands = Commands('federatedID', 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+        commands.remove_from_org(False)
+        removals.append(commands)
+    write_unfinished_log(primary, deletes)
+    write_unfinished_log(secondary, removals)
+
+    primary = make_connector(primary.write_ahead_log.path, connection)
+    secondary = make_connector(secondary.write_ahead_log.path, connection)
+    assert resume_actions(UmapiConnectors(primary, {'secondary': secondary}), logging.getLogger())
+    # all the secondary removals are sent before any of the primary deletes
+    removed = [action['do'][0]['removeFromOrg']['deleteAccount'] for action in connection.sent]
+    assert removed == [False] * 3 + [True] * 12
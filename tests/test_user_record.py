@@ -0,0 +1,156 @@
+import copy
+import pickle
+import tracemalloc
+
+import pytest
+
+from user_sync.connector import user_record
+from user_sync.connector.helper import create_blank_user
+from user_sync.connector.user_record import DirectoryUser, UmapiUser, normalized_value
+from user_sync.helper import normalize_string
+
+
+def test_dict_behavior(example_user):
+    user = create_blank_user()
+    assert 'uid' not in user and user.get('uid') is None
+    with pytest.raises(KeyError):
+        user['uid']
+    user['email'] = 'user@example.com'
+    user['sign_group'] = {'group': 'Sign Users'}
+    assert user['sign_group'] == {'group': 'Sign Users'}
+    assert 'sign_group' in user and 'uid' not in user
+    user.update({'firstname': 'Example', 'uid': '1234'})
+    assert user == dict(user)
+    assert user['firstname'] == 'Example' and user['uid'] == '1234'
+    assert list(user)[-1] == 'sign_group'
+    del user['uid']
+    del user['sign_group']
+    assert 'uid' not in user and 'sign_group' not in user
+    with pytest.raises(KeyError):
+        del user['uid']
+
+    example_user['groups'] = ['Group A']
+    user = UmapiUser(example_user)
+    assert user == example_user
+    assert dict(user.items()) == example_user
+    assert len(user) == len(example_user)
+
+
+def test_copies_are_independent():
+    user = UmapiUser(email='user@example.com', groups=['Group A'], adminRoles=['org'])
+    user_copy = user.copy()
+    user_copy['groups'].append('Group B')
+    user_copy['email'] = 'other@example.com'
+    assert user['groups'] == ['Group A'] and user['email'] == 'user@example.com'
+    for restored in (pickle.loads(pickle.dumps(user)), copy.deepcopy(user)):
+        assert type(restored) is UmapiUser
+        assert restored == user
+
+
+def make_umapi_dict(i, full=False):
+    user = {
+        'email': 'user%d@example.com' % i,
+        'status': 'active',
+        'username': 'user%d@example.com' % i,
+        'domain': 'example.com',
+        'firstname': 'First%d' % i,
+        'lastname': 'Last%d' % i,
+        'country': 'US',
+        'type': 'federatedID',
+        'groups': ['Group %d' % (i % 10), 'All Users'],
+    }
+    if full:
+        # some of the other fields the server sends
+        user.update({
+            'id': '%032X@AdobeID' % i,
+            'adminRoles': ['productAdmin'],
+            'userGroupAdminGroups': [],
+            'businessAccount': True,
+        })
+    return user
+
+
+def measure(make_user, count=5000, full=False):
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        # decode the values like a JSON parser would, so repeated values aren't already shared
+        users = [make_user({k: copy.copy(v) if not isinstance(v, str) else ''.join(list(v))
+                            for k, v in make_umapi_dict(i, full).items()}) for i in range(count)]
+        used = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    assert len(users) == count
+    return used
+
+
+def test_memory_benchmark():
+    dict_bytes = measure(dict)
+    record_bytes = measure(UmapiUser)
+    assert record_bytes < 0.7 * dict_bytes
+    directory_bytes = measure(DirectoryUser)
+    assert directory_bytes < dict_bytes
+
+
+def test_lean_records():
+    user = UmapiUser.create_lean(make_umapi_dict(1, full=True))
+    assert sorted(user) == sorted(UmapiUser.lean_fields)
+    assert user['groups'] == ['Group 1', 'All Users']
+    full_bytes = measure(UmapiUser, full=True)
+    lean_bytes = measure(UmapiUser.create_lean, full=True)
+    assert lean_bytes < 0.7 * full_bytes
+
+
+def test_normalized_values():
+    user = UmapiUser(email=' User@Example.com', username='user@example.com', domain='Example.com',
+                     groups=['Group A', ' group b'])
+    assert normalized_value(user, 'email') == 'user@example.com'
+    assert normalized_value(user, 'username') is user['username']
+    assert normalized_value(user, 'groups') == frozenset(['group a', 'group b'])
+    # the normalized values are kept until a field they depend on changes
+    assert normalized_value(user, 'domain') is normalized_value(user, 'domain')
+    user['firstname'] = 'Other'
+    assert normalized_value(user, 'domain') is normalized_value(user, 'domain')
+    user['email'] = 'OTHER@example.com'
+    assert normalized_value(user, 'email') == 'other@example.com'
+    user['groups'] = ['Group C']
+    assert normalized_value(user, 'groups') == frozenset(['group c'])
+    del user['groups']
+    assert normalized_value(user, 'groups') == frozenset()
+    # copies don't share the cache, and plain dicts are normalized every time
+    assert normalized_value(pickle.loads(pickle.dumps(user)), 'email') == 'other@example.com'
+    assert normalized_value(dict(user), 'email') == 'other@example.com'
+    directory_user = DirectoryUser(email='User@Example.com', username=None, domain=None)
+    assert normalized_value(directory_user, 'email') == 'user@example.com'
+    assert normalized_value(directory_user, 'username') is None
+
+
+def diff_users(pairs):
+    # the comparisons the engine makes for each user it matches
+    differences = 0
+    for directory_user, umapi_user in pairs:
+        for key in ('email', 'username', 'domain'):
+            differences += normalized_value(directory_user, key) != normalized_value(umapi_user, key)
+        differences += len(normalized_value(umapi_user, 'groups'))
+    return differences
+
+
+def test_diff_normalizes_once(monkeypatch):
+    calls = []
+
+    def counting_normalize_string(value):
+        calls.append(value)
+        return normalize_string(value)
+
+    monkeypatch.setattr(user_record, 'normalize_string', counting_normalize_string)
+    call_counts = []
+    for make_directory_user, make_umapi_user in [(dict, dict), (DirectoryUser, UmapiUser)]:
+        pairs = [(make_directory_user(make_umapi_dict(i)), make_umapi_user(make_umapi_dict(i))) for i in range(100)]
+        # the engine makes its user keys when users are read, so the cost of the first pass is paid then
+        diff_users(pairs)
+        del calls[:]
+        for _ in range(3):
+            assert diff_users(pairs) == 200
+        call_counts.append(len(calls))
+    # dicts are normalized on every comparison, records never again
+    assert call_counts == [3 * 100 * 8, 0]
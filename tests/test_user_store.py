@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from user_sync.connector.user_record import DirectoryUser
+from user_sync.engine.common import UserKey
+from user_sync.engine.store import UserStoreFactory
+
+
+@pytest.fixture
+def user_stores(tmpdir):
+    stores = UserStoreFactory(max_memory_users=3, cache_size=2, directory=str(tmpdir))
+    yield stores
+    stores.close()
+
+
+def user_key(i):
+    return UserKey('federatedID', 'user%d@example.com' % i, '')
+
+
+def make_user(i):
+    return DirectoryUser(email='user%d@example.com' % i, firstname='User', lastname=str(i), groups=['Staff'])
+
+
+def test_moves_to_disk(user_stores, tmpdir):
+    store = user_stores.create('users')
+    for i in range(3):
+        store[user_key(i)] = make_user(i)
+    assert not store.is_on_disk()
+    store[user_key(3)] = make_user(3)
+    assert store.is_on_disk()
+    assert len(os.listdir(str(tmpdir))) == 1
+
+    for i in range(4, 10):
+        store[user_key(i)] = make_user(i)
+    assert len(store) == 10
+    assert list(store) == [user_key(i) for i in range(10)]
+    assert store[user_key(0)]['lastname'] == '0'
+    assert store.get(user_key(10)) is None
+    assert user_key(9) in store and user_key(10) not in store
+    del store[user_key(0)]
+    assert user_key(0) not in store and len(store) == 9
+    with pytest.raises(KeyError):
+        del store[user_key(0)]
+
+    user_stores.close()
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_changes_are_written_back(user_stores):
+    store = user_stores.create('users')
+    for i in range(10):
+        store[user_key(i)] = make_user(i)
+    # change users in place while reading through the store, as the engine does
+    for key, user in store.items():
+        user['groups'].append('Changed')
+    assert all(user['groups'] == ['Staff', 'Changed'] for user in store.values())
+    # reading values without changing them doesn't write them again
+    writes = store.disk_writes
+    for key in list(store):
+        store.get(key)
+    assert store.disk_writes == writes
+
+
+def test_email_keys(user_stores):
+    store = user_stores.create('overrides')
+    for i in range(5):
+        store['user%d@example.com' % i] = 'other%d@example.com' % i
+    assert store.is_on_disk()
+    assert sorted(store.items())[0] == ('user0@example.com', 'other0@example.com')
+
+
+def test_in_memory_by_default():
+    assert type(UserStoreFactory().create('users')) is dict
+
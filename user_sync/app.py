@@ -51,6 +51,10 @@ from user_sync.config import user_sync as config
 from user_sync.config import sign_sync as sign_config
 from user_sync.config.common import OptionsBuilder
 from user_sync.connector.connector_umapi import UmapiConnector
+from user_sync.connector.umapi_journal import close_action_journal, open_action_journal
+from user_sync.connector.umapi_plan import UmapiPlanWriter, apply_plan
+from user_sync.connector.umapi_throttle import log_throttle_statistics
+from user_sync.connector.umapi_wal import resume_actions
 from user_sync.engine.common import PRIMARY_TARGET_NAME
 from user_sync.engine.sign import SignSyncEngine
 from user_sync.error import AssertionException
@@ -143,10 +147,20 @@ def main():
               metavar='ldap|okta|csv|adobe_console [path-to-file.csv]')
 @click.option('--exclude-unmapped-users/--include-unmapped-users', default=None,
               help='Exclude users that is not part of a mapped group from being created on Adobe side')
+@click.option('--plan-out',
+              help='write the changes to a plan file, to be sent later with the "apply" command, '
+                   'instead of sending them to the Adobe side.',
+              type=str,
+              nargs=1,
+              metavar='path-to-file.jsonl')
 @click.option('--process-groups/--no-process-groups', default=None,
               help='if membership in mapped groups differs between the enterprise directory and Adobe sides, '
                    'the group membership is updated on the Adobe side so that the memberships in mapped '
                    'groups match those on the enterprise directory side.')
+@click.option('--resume', is_flag=True, default=None,
+              help='first send the actions that an unfinished earlier run logged in its write-ahead logs but '
+                   'never saw answered.  If that run had planned all its actions, nothing else is done; '
+                   'otherwise a full sync follows.')
 @click.option('--strategy',
               help="whether to fetch and sync the Adobe directory against the customer directory "
                    "or just to push each customer user to the Adobe side.  Default is to fetch and sync.",
@@ -178,6 +192,26 @@ def sync(**kwargs):
     run_sync(config.UMAPIConfigLoader(kwargs), begin_work_umapi)
 
 
+@main.command()
+@click.help_option('-h', '--help')
+@click.argument('plan-path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--config-file-encoding', 'encoding_name',
+              help="encoding of your configuration files",
+              type=str,
+              nargs=1,
+              metavar='encoding-name')
+@click.option('-c', '--config-filename',
+              help="path to your main configuration file",
+              type=str,
+              nargs=1,
+              metavar='path-to-file')
+@click.option('-t/-T', '--test-mode/--no-test-mode', default=None,
+              help='enable test mode (API calls do not execute changes on the Adobe side).')
+def apply(plan_path, **kwargs):
+    """Send the changes in a plan written by sync --plan-out"""
+    run_sync(config.UMAPIConfigLoader(kwargs), lambda config_loader: begin_work_apply(config_loader, plan_path))
+
+
 @main.command()
 @click.help_option('-h', '--help')
 @click.option('-c', '--config-filename',
@@ -251,6 +285,55 @@ def begin_work_umapi(config_loader):
             raise AssertionException(
                 "Failed to enable dynamic group mappings. 'dynamic_group_member_attribute' is not defined in config")
 
+    umapi_connectors = create_umapi_connectors(primary_umapi_config, secondary_umapi_configs)
+
+    plan = None
+    plan_path = umapi_engine_config['plan_out']
+    if plan_path:
+        if umapi_engine_config['resume']:
+            raise AssertionException('You cannot both resume a run and write a plan')
+        plan = UmapiPlanWriter(plan_path, umapi_connectors.connectors)
+    elif umapi_engine_config['resume']:
+        if resume_actions(umapi_connectors, logger):
+            umapi_connectors.execute_actions()
+            umapi_connectors.save_snapshots()
+            finish_umapi_work(umapi_connectors)
+            return
+    else:
+        for connector in umapi_connectors.connectors:
+            connector.start_write_ahead_log()
+
+    rule_processor = user_sync.engine.umapi.RuleProcessor(umapi_engine_config)
+    if len(directory_groups) == 0 and rule_processor.will_process_groups():
+        logger.warning('No group mapping specified in configuration but --process-groups requested on command line')
+    try:
+        rule_processor.run(directory_groups, directory_connector, umapi_connectors)
+    except:
+        if plan is not None:
+            plan.discard()
+        raise
+    finish_umapi_work(umapi_connectors)
+    if plan is not None:
+        plan.close()
+        logger.info('Wrote %d actions to plan: %s', plan.action_count, plan_path)
+
+
+def finish_umapi_work(umapi_connectors):
+    """
+    Wrap up the connectors once all their actions have been sent.
+    :type umapi_connectors: user_sync.engine.umapi.UmapiConnectors
+    """
+    for connector in umapi_connectors.connectors:
+        connector.close_write_ahead_log()
+    log_throttle_statistics(logger)
+
+
+def create_umapi_connectors(primary_umapi_config, secondary_umapi_configs):
+    """
+    :type primary_umapi_config: dict
+    :type secondary_umapi_configs: dict
+    :rtype: user_sync.engine.umapi.UmapiConnectors
+    """
     primary_name = '.primary' if secondary_umapi_configs else ''
     umapi_primary_connector = UmapiConnector(primary_name, primary_umapi_config)
     umapi_other_connectors = {}
@@ -258,12 +341,24 @@ def begin_work_umapi(config_loader):
         umapi_secondary_conector = UmapiConnector(".secondary.%s" % secondary_umapi_name,
                                                   secondary_config)
         umapi_other_connectors[secondary_umapi_name] = umapi_secondary_conector
-    umapi_connectors = user_sync.engine.umapi.UmapiConnectors(umapi_primary_connector, umapi_other_connectors)
+    return user_sync.engine.umapi.UmapiConnectors(umapi_primary_connector, umapi_other_connectors)
 
-    rule_processor = user_sync.engine.umapi.RuleProcessor(umapi_engine_config)
-    if len(directory_groups) == 0 and rule_processor.will_process_groups():
-        logger.warning('No group mapping specified in configuration but --process-groups requested on command line')
-    rule_processor.run(directory_groups, directory_connector, umapi_connectors)
+
+def begin_work_apply(config_loader, plan_path):
+    """
+    :type config_loader: config.UMAPIConfigLoader
+    :type plan_path: str
+    """
+    umapi_connectors = create_umapi_connectors(*config_loader.get_target_options())
+    for connector in umapi_connectors.connectors:
+        connector.start_write_ahead_log()
+    action_count = apply_plan(plan_path, umapi_connectors, logger)
+    umapi_connectors.save_snapshots()
+    finish_umapi_work(umapi_connectors)
+    for connector in umapi_connectors.connectors:
+        sent, errors = connector.get_action_manager().get_statistics()
+        logger.info('%s: %d actions sent (%d succeeded, %d failed)', connector.name, sent, sent - errors, errors)
+    logger.info('Applied %d actions from plan: %s', action_count, plan_path)
 
 
 def load_directory_config(config_loader, new_account_type=None):
@@ -327,6 +422,10 @@ def run_sync(config_loader, begin_work):
             pass
 
     finally:
+        try:
+            close_action_journal()
+        except AssertionException as e:
+            logger.critical("%s", e)
         if run_stats is not None:
             run_stats.log_end(logger)
 
@@ -462,6 +561,8 @@ def init_log(logging_config):
     builder.set_string_value('file_log_level', 'info')
     builder.set_string_value('console_log_level', 'info')
     builder.set_bool_value('log_progress', True)
+    builder.set_bool_value('action_journal', False)
+    builder.set_string_value('action_journal_name_format', '{:%Y-%m-%d}-actions.jsonl')
     options = builder.get_options()
 
     level_lookup = {
@@ -497,6 +598,13 @@ def init_log(logging_config):
         if unknown_file_log_level:
             logger.log(logging.WARNING, 'Unknown file log level: %s setting to info' % options['file_log_level'])
 
+    if options['action_journal']:
+        file_log_directory = options['file_log_directory']
+        if not os.path.exists(file_log_directory):
+            os.makedirs(file_log_directory)
+        open_action_journal(os.path.join(file_log_directory,
+                                         options['action_journal_name_format'].format(datetime.now())))
+
 def log_parameters(argv, config_loader):
     """
     Log the invocation parameters to make it easier to diagnose problem with customers
@@ -46,12 +46,18 @@ class UMAPIConfigLoader(ConfigLoader):
     ROOT_CONFIG_PATH_KEYS = {'/adobe_users/connectors/umapi': (True, True, None),
                              '/directory_users/connectors/*': (True, False, None),
                              '/directory_users/extension': (True, False, None),
+                             '/directory_users/user_store/directory': (False, False, None),
                              '/logging/file_log_directory': (False, False, "logs"),
                              }
 
     # like ROOT_CONFIG_PATH_KEYS, but for non-root configuration files
     SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None),
-                            '/integration/priv_key_path': (True, False, None)}
+                            '/integration/priv_key_path': (True, False, None),
+                            '/group_cache/path': (False, False, None),
+                            '/page_spool/path': (False, False, None),
+                            '/snapshot/path': (False, False, None),
+                            '/token_cache/path': (False, False, None),
+                            '/write_ahead_log/path': (False, False, None)}
 
     # default values for reading configuration files
     # these are in alphabetical order!  Always add new ones that way!
@@ -70,7 +76,9 @@ class UMAPIConfigLoader(ConfigLoader):
         'connector': ['ldap'],
         'encoding_name': 'utf8',
         'exclude_unmapped_users': False,
+        'plan_out': None,
         'process_groups': False,
+        'resume': False,
         'strategy': 'sync',
         'test_mode': False,
         'update_user_info': False,
@@ -379,9 +387,13 @@ class UMAPIConfigLoader(ConfigLoader):
             if sources:
                 options = DictConfig('extension', self.get_dict_from_sources(sources))
                 if options:
-                    after_mapping_hook_text = options.get_string('after_mapping_hook', True)
-                    if after_mapping_hook_text is None:
+                    hook_count = sum(1 for key in ('after_mapping_hook', 'batch_after_mapping_hook')
+                                     if options.get_string(key, True) is not None)
+                    if hook_count == 0:
                         raise AssertionError("No after_mapping_hook found in extension configuration")
+                    if hook_count > 1:
+                        raise AssertionException("Extension configuration can't have both an after_mapping_hook "
+                                                 "and a batch_after_mapping_hook")
         return options
 
 
@@ -463,6 +475,29 @@ class UMAPIConfigLoader(ConfigLoader):
         except Exception as e:
             raise AssertionException("Additional group rule error: {}".format(str(e)))
         options['additional_groups'] = additional_groups
+        diff_engine = directory_config.get_string('diff_engine', True)
+        if diff_engine is not None:
+            if diff_engine not in ('memory', 'merge'):
+                raise AssertionException("diff_engine must be 'memory' or 'merge'")
+            options['diff_engine'] = diff_engine
+        diff_run_size = directory_config.get_int('diff_run_size', True)
+        if diff_run_size is not None:
+            if diff_run_size < 1:
+                raise AssertionException("diff_run_size must be at least 1")
+            options['diff_run_size'] = diff_run_size
+        user_store_config = directory_config.get_dict_config('user_store', True)
+        if user_store_config:
+            max_memory_users = user_store_config.get_int('max_memory_users', True)
+            if max_memory_users is not None:
+                if max_memory_users < 1:
+                    raise AssertionException("user_store max_memory_users must be at least 1")
+                options['user_store_max_memory_users'] = max_memory_users
+            cache_size = user_store_config.get_int('cache_size', True)
+            if cache_size is not None:
+                if cache_size < 1:
+                    raise AssertionException("user_store cache_size must be at least 1")
+                options['user_store_cache_size'] = cache_size
+            options['user_store_directory'] = user_store_config.get_string('directory', True)
         sync_options = directory_config.get_dict_config('group_sync_options', True)
         if sync_options:
             options['auto_create'] = sync_options.get_bool('auto_create', True)
@@ -507,6 +542,14 @@ class UMAPIConfigLoader(ConfigLoader):
                     raise AssertionException(validation_message)
                 exclude_groups.append(group.get_group_name())
             options['exclude_groups'] = exclude_groups
+        prefetch_users = adobe_config.get_bool('prefetch_users', True)
+        if prefetch_users is not None:
+            options['prefetch_umapi_users'] = prefetch_users
+        secondary_org_workers = adobe_config.get_int('secondary_org_workers', True)
+        if secondary_org_workers is not None:
+            if secondary_org_workers < 1:
+                raise AssertionException("secondary_org_workers must be at least 1")
+            options['secondary_org_workers'] = secondary_org_workers
 
         # get the limits
         limits_config = self.main_config.get_dict_config('limits')
@@ -530,8 +573,23 @@ class UMAPIConfigLoader(ConfigLoader):
         if extension_config and not options['extension_enabled']:
             self.logger.warning('Extension config functionality is disabled - skipping after-map hook')
         elif extension_config:
-            after_mapping_hook_text = extension_config.get_string('after_mapping_hook')
-            options['after_mapping_hook'] = compile(after_mapping_hook_text, '<per-user after-mapping-hook>', 'exec')
+            after_mapping_hook_text = extension_config.get_string('after_mapping_hook', True)
+            if after_mapping_hook_text is not None:
+                options['after_mapping_hook'] = compile(after_mapping_hook_text, '<per-user after-mapping-hook>',
+                                                        'exec')
+            batch_hook_text = extension_config.get_string('batch_after_mapping_hook', True)
+            if batch_hook_text is not None:
+                options['batch_after_mapping_hook'] = compile(batch_hook_text, '<batch after-mapping-hook>', 'exec')
+            batch_size = extension_config.get_int('batch_size', True)
+            if batch_size is not None:
+                if batch_size < 1:
+                    raise AssertionException("Extension batch_size must be at least 1")
+                options['after_mapping_hook_batch_size'] = batch_size
+            hook_processes = extension_config.get_int('hook_processes', True)
+            if hook_processes is not None:
+                if hook_processes < 1:
+                    raise AssertionException("Extension hook_processes must be at least 1")
+                options['after_mapping_hook_processes'] = hook_processes
             options['extended_attributes'].update(extension_config.get_list('extended_attributes', True))
             # declaration of extended adobe groups: this is needed for two reasons:
             # 1. it allows validation of group names, and matching them to adobe groups
@@ -18,7 +18,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import json
+import collections
+import concurrent.futures
+import itertools
 import logging
 # import helper
 import math
@@ -33,7 +35,15 @@ import user_sync.identity_type
 from user_sync.config import user_sync as config
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
-from user_sync.connector.umapi_util import make_auth_dict
+from user_sync.connector.umapi_util import make_auth, make_auth_dict
+from user_sync.connector.umapi_groups import get_group_catalog
+from user_sync.connector.umapi_journal import get_action_journal
+from user_sync.connector.umapi_pages import PageSpool, ParallelUsersQuery
+from user_sync.connector.umapi_snapshot import UmapiSnapshot
+from user_sync.connector.umapi_throttle import get_throttle
+from user_sync.connector.umapi_tokens import get_token_cache
+from user_sync.connector.umapi_wal import WriteAheadLog
+from user_sync.connector.user_record import UmapiUser
 from user_sync.config import common as config_common
 
 try:
@@ -55,6 +65,7 @@ class UmapiConnector(object):
         if self.trusted is None:
             self.trusted = False
         builder = config_common.OptionsBuilder(caller_config)
+        builder.set_bool_value('lean_users', False)
         builder.set_string_value('logger_name', self.name)
         builder.set_bool_value('test_mode', False)
         options = builder.get_options()
@@ -68,6 +79,10 @@ class UmapiConnector(object):
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
         server_builder.set_bool_value('ssl_verify', True)
+        server_builder.set_int_value('max_concurrent_batches', 1)
+        server_builder.set_int_value('max_concurrent_pages', 1)
+        server_builder.set_value('max_requests_per_second', (int, float), None)
+        server_builder.set_bool_value('ordered_pages', True)
         options['server'] = server_options = server_builder.get_options()
 
         enterprise_config = caller_config.get_dict_config('enterprise')
@@ -76,23 +91,106 @@ class UmapiConnector(object):
         tech_field = 'tech_acct_id' if 'tech_acct_id' in enterprise_config else 'tech_acct'
         enterprise_builder.require_string_value(tech_field)
         options['enterprise'] = enterprise_options = enterprise_builder.get_options()
+
+        snapshot_config = caller_config.get_dict_config('snapshot', True)
+        snapshot_builder = config_common.OptionsBuilder(snapshot_config)
+        snapshot_builder.set_string_value('path', None)
+        snapshot_builder.set_int_value('refresh_runs', 10)
+        snapshot_builder.set_int_value('refresh_hours', 24)
+        options['snapshot'] = snapshot_options = snapshot_builder.get_options()
+
+        token_cache_config = caller_config.get_dict_config('token_cache', True)
+        token_cache_builder = config_common.OptionsBuilder(token_cache_config)
+        token_cache_builder.set_string_value('path', None)
+        token_cache_builder.set_int_value('min_remaining_minutes', 60)
+        options['token_cache'] = token_cache_options = token_cache_builder.get_options()
+
+        group_cache_config = caller_config.get_dict_config('group_cache', True)
+        group_cache_builder = config_common.OptionsBuilder(group_cache_config)
+        group_cache_builder.set_string_value('path', None)
+        group_cache_builder.set_int_value('max_age_minutes', 60)
+        options['group_cache'] = group_cache_options = group_cache_builder.get_options()
+
+        spool_config = caller_config.get_dict_config('page_spool', True)
+        spool_builder = config_common.OptionsBuilder(spool_config)
+        spool_builder.set_string_value('path', None)
+        spool_builder.set_int_value('max_age_minutes', 60)
+        options['page_spool'] = spool_options = spool_builder.get_options()
+
+        wal_config = caller_config.get_dict_config('write_ahead_log', True)
+        wal_builder = config_common.OptionsBuilder(wal_config)
+        wal_builder.set_string_value('path', None)
+        options['write_ahead_log'] = wal_options = wal_builder.get_options()
+
+        bulk_config = caller_config.get_dict_config('bulk_group_changes', True)
+        bulk_builder = config_common.OptionsBuilder(bulk_config)
+        bulk_builder.set_int_value('min_users', 0)
+        bulk_builder.set_int_value('users_per_action', 10)
+        options['bulk_group_changes'] = bulk_options = bulk_builder.get_options()
         self.options = options
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         if server_config:
             server_config.report_unused_values(logger)
+        if snapshot_config:
+            snapshot_config.report_unused_values(logger)
+        if bulk_config:
+            bulk_config.report_unused_values(logger)
+        if wal_config:
+            wal_config.report_unused_values(logger)
+        if spool_config:
+            spool_config.report_unused_values(logger)
+        if group_cache_config:
+            group_cache_config.report_unused_values(logger)
+        if token_cache_config:
+            token_cache_config.report_unused_values(logger)
+        if bulk_options['min_users'] < 0 or bulk_options['users_per_action'] < 1:
+            raise AssertionException("%s: bulk_group_changes min_users must be at least 0, "
+                                     "and users_per_action at least 1" % self.name)
         logger.debug('UMAPI initialized with options: %s', options)
 
         ims_host = server_options['ims_host']
         self.org_id = org_id = enterprise_options['org_id']
-        auth_dict = make_auth_dict(self.name, enterprise_config, org_id, enterprise_options[tech_field], logger)
+        self.snapshot = None
+        # whether to keep only the fields of each user that the engine reads
+        self.lean_users = options['lean_users']
+        # the number of users in the org (or group), as reported by the last user query
+        self.user_count = None
+        # where to record our actions instead of sending them, if anywhere
+        self.plan = None
+        # where to log our actions before we send them, if anywhere (once it's started)
+        self.write_ahead_log = None
+        if wal_options['path']:
+            self.write_ahead_log = WriteAheadLog(wal_options['path'], org_id, logger)
+        # the groups of the org, shared with any other connectors to it
+        self.group_catalog = get_group_catalog(org_id, logger)
+        if group_cache_options['path']:
+            self.group_catalog.set_cache(group_cache_options['path'], group_cache_options['max_age_minutes'])
+        # where to keep the pages of a full user read until it finishes, if anywhere
+        self.page_spool = None
+        if spool_options['path']:
+            self.page_spool = PageSpool(spool_options['path'], org_id, spool_options['max_age_minutes'], logger)
+        if snapshot_options['path']:
+            self.snapshot = UmapiSnapshot(snapshot_options['path'], org_id, snapshot_options['refresh_runs'],
+                                          snapshot_options['refresh_hours'], options['test_mode'], logger)
+            self.snapshot.load()
+        token_cache = None
+        if token_cache_options['path']:
+            token_cache = get_token_cache(token_cache_options['path'], token_cache_options['min_remaining_minutes'])
+        auth_dict = make_auth_dict(self.name, enterprise_config, org_id, enterprise_options[tech_field], logger,
+                                   token_cache)
         # this check must come after we fetch all the settings
         enterprise_config.report_unused_values(logger)
         # open the connection
         um_endpoint = "https://" + server_options['host'] + server_options['endpoint']
         logger.debug('%s: creating connection for org %s at endpoint %s', self.name, org_id, um_endpoint)
         try:
+            auth = None
+            if token_cache is not None:
+                auth = make_auth(auth_dict, ims_host, server_options['ims_endpoint_jwt'], server_options['ssl_verify'],
+                                 token_cache)
             self.connection = connection = umapi_client.Connection(
                 org_id=org_id,
+                auth=auth,
                 auth_dict=auth_dict,
                 ims_host=ims_host,
                 ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
@@ -107,36 +205,102 @@ class UmapiConnector(object):
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
+        # pace our requests to the org, sharing the pace with any other connectors to it
+        max_requests_per_second = server_options['max_requests_per_second']
+        if max_requests_per_second is not None and max_requests_per_second <= 0:
+            raise AssertionException("%s: max_requests_per_second must be more than 0" % self.name)
+        self.throttle = get_throttle(org_id, max_requests_per_second)
+        self.throttle.install(connection.session)
+        if server_options['max_concurrent_pages'] < 1:
+            raise AssertionException("%s: max_concurrent_pages must be at least 1" % self.name)
+        self.max_concurrent_pages = server_options['max_concurrent_pages']
+        self.ordered_pages = server_options['ordered_pages']
         # wrap the connection in an action manager
-        self.action_manager = ActionManager(connection, org_id, logger)
+        if server_options['max_concurrent_batches'] < 1:
+            raise AssertionException("%s: max_concurrent_batches must be at least 1" % self.name)
+        self.action_manager = ActionManager(connection, org_id, logger, server_options['max_concurrent_batches'],
+                                            self.throttle)
+        self.action_manager.set_bulk_group_changes(bulk_options['min_users'], bulk_options['users_per_action'])
+        self.action_manager.set_journal(get_action_journal())
+        if self.write_ahead_log is not None:
+            self.action_manager.set_write_ahead_log(self.write_ahead_log)
 
     def get_users(self):
         return list(self.iter_users())
 
     def iter_users(self, in_group=None):
-        users = {}
+        snapshot = self.snapshot if in_group is None else None
+        if snapshot is not None and snapshot.is_fresh():
+            self.logger.info('Using UMAPI snapshot (%s)', snapshot.describe())
+            self.user_count = len(snapshot.user_by_email)
+            for u in snapshot.iter_users():
+                yield u
+            return
+        if snapshot is not None:
+            snapshot.start_refresh()
         total_count = 0
         page_count = 0
         page_size = 0
         page_number = 0
         try:
-            u_query = umapi_client.UsersQuery(self.connection, in_group=in_group)
+            u_query = self.create_users_query(in_group)
+            # a parallel query only yields each user once, so we needn't keep a set of them too
+            users = None if isinstance(u_query, ParallelUsersQuery) else set()
+            user_count = 0
             for i, u in enumerate(u_query):
                 total_count, page_count, page_size, page_number = u_query.stats()
+                self.user_count = total_count
                 email = u['email']
-                if not (email in users):
-                    users[email] = u
+                if users is None or email not in users:
+                    if users is not None:
+                        users.add(email)
+                    user_count += 1
+                    u = UmapiUser.create_lean(u) if self.lean_users else UmapiUser(u)
+                    if snapshot is not None:
+                        snapshot.add_user(u)
                     yield u
 
                 if (i + 1) % page_size == 0:
-                    self.logger.progress(len(users), total_count)
+                    self.logger.progress(user_count, total_count)
             self.logger.progress(total_count, total_count)
+            if snapshot is not None:
+                snapshot.finish_refresh()
 
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def create_users_query(self, in_group=None):
+        """
+        :type in_group: str
+        :rtype: umapi_client.UsersQuery | ParallelUsersQuery
+        """
+        # only reads of the whole org are spooled
+        spool = self.page_spool if in_group is None else None
+        if self.max_concurrent_pages > 1 or spool is not None:
+            return ParallelUsersQuery(self.connection, in_group, self.max_concurrent_pages, self.ordered_pages,
+                                      spool)
+        return umapi_client.UsersQuery(self.connection, in_group=in_group)
+
     def get_groups(self):
-        return list(self.iter_groups())
+        return self.group_catalog.get_groups(self.read_groups)
+
+    def get_group_catalog(self):
+        """
+        The catalog of the org's groups, with the groups read
+        :rtype: user_sync.connector.umapi_groups.GroupCatalog
+        """
+        self.get_groups()
+        return self.group_catalog
+
+    def read_groups(self):
+        if self.snapshot is not None and self.snapshot.is_fresh():
+            groups = self.snapshot.get_groups()
+            if groups is not None:
+                return groups
+        groups = list(self.iter_groups())
+        if self.snapshot is not None:
+            self.snapshot.set_groups(groups)
+        return groups
 
     def iter_groups(self):
         try:
@@ -156,24 +320,153 @@ class UmapiConnector(object):
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
     def create_group(self, name):
-        if name:
+        if name and self.plan is not None:
+            self.plan.add_group(self.name, name)
+        elif name:
+            seq = None
+            if self.is_logging_actions():
+                seq = self.write_ahead_log.add_group(name)
+                self.write_ahead_log.mark_sent([seq])
             group = umapi_client.UserGroupAction(group_name=name)
             group.create(description="Automatically created by User Sync Tool")
-            return self.connection.execute_single(group)
+            result = self.connection.execute_single(group, immediate=True)
+            if seq is not None:
+                self.write_ahead_log.ack(seq, True)
+            self.add_created_group(name)
+            return result
+
+    def create_groups(self, names):
+        """
+        Create several groups, sending the creations in batches like other actions (so with as many
+        batches at once as max_concurrent_batches allows), and wait for them all to be answered.
+        :type names: list(str)
+        :rtype: dict(str, list) the errors for each group that couldn't be created
+        """
+        errors_by_name = {}
+        if self.plan is not None:
+            for name in names:
+                self.create_group(name)
+            return errors_by_name
+        action_manager = self.get_action_manager()
+        for name in names:
+            seq = None
+            if self.is_logging_actions():
+                seq = self.write_ahead_log.add_group(name)
+            group = umapi_client.UserGroupAction(group_name=name)
+            group.create(description="Automatically created by User Sync Tool")
+            callback = self.make_group_creation_callback(name, errors_by_name)
+            if seq is not None:
+                callback = self.write_ahead_log.track(seq, callback)
+            action_manager.add_action(group, callback, [seq] if seq is not None else None)
+        action_manager.flush()
+        return errors_by_name
+
+    def make_group_creation_callback(self, name, errors_by_name):
+        def group_created(result):
+            if result['is_success']:
+                self.add_created_group(name)
+            else:
+                errors_by_name[name] = result['errors']
+
+        return group_created
+
+    def add_created_group(self, name):
+        self.group_catalog.add_group(name)
+        if self.snapshot is not None:
+            self.snapshot.add_group(name)
+
+    def get_user_count(self):
+        """
+        The number of users that the current (or last) user query reported it would return,
+        or None if there hasn't been one.
+        :rtype: int
+        """
+        return self.user_count
 
     def get_action_manager(self):
         return self.action_manager
 
+    def set_plan(self, plan):
+        """
+        Record the commands and group creations for this org in a plan, rather than sending them.
+        :type plan: user_sync.connector.umapi_plan.UmapiPlanWriter
+        """
+        self.plan = plan
+
     def send_commands(self, commands, callback=None):
         """
         :type commands: Commands
         :type callback: callable(dict)
         """
-        if len(commands) > 0:
+        if len(commands) > 0 and self.plan is not None:
+            self.plan.add_commands(self.name, commands)
+        elif len(commands) > 0:
+            seq = None
+            if self.is_logging_actions():
+                seq = self.write_ahead_log.add_commands(commands)
             action_manager = self.get_action_manager()
+            track = self.make_tracker(callback, seq)
+            if action_manager.is_bulk_group_change(commands):
+                action_manager.add_group_change(commands, track, seq)
+                return
             action = action_manager.create_action(commands)
             if action is not None:
-                action_manager.add_action(action, callback)
+                action_manager.add_action(action, track(commands), [seq] if seq is not None else None)
+            elif seq is not None:
+                self.write_ahead_log.ack(seq, False)
+
+    def send_plan_entry(self, content):
+        """
+        Send an entry of a plan or write-ahead log: a group to create, or the commands for a user.
+        :type content: dict
+        :rtype: bool whether the entry was for a user
+        """
+        if 'create_group' in content:
+            self.logger.info("Creating group '%s'", content['create_group'])
+            self.create_group(content['create_group'])
+            return False
+        self.send_commands(Commands.from_dict(content))
+        return True
+
+    def make_tracker(self, callback, seq=None):
+        """
+        A function that makes the callback for some of a user's commands, which keeps any snapshot
+        and write-ahead log current
+        :type callback: callable(dict)
+        :type seq: int the sequence number of the commands in the write-ahead log, if they're in it
+        :rtype: callable(Commands)
+        """
+        def track(commands):
+            part_callback = callback
+            if self.snapshot is not None:
+                part_callback = self.snapshot.track(commands, part_callback)
+            if seq is not None:
+                part_callback = self.write_ahead_log.track(seq, part_callback)
+            return part_callback
+
+        return track
+
+    def is_logging_actions(self):
+        return self.write_ahead_log is not None and self.write_ahead_log.is_open()
+
+    def start_write_ahead_log(self):
+        if self.write_ahead_log is not None and not self.write_ahead_log.is_open():
+            self.write_ahead_log.open()
+
+    def end_write_ahead_log(self):
+        """
+        Note that every action of this run has been sent to us.
+        """
+        if self.is_logging_actions():
+            self.write_ahead_log.mark_complete()
+
+    def close_write_ahead_log(self):
+        if self.write_ahead_log is not None:
+            self.write_ahead_log.close()
+
+    def save_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot.save()
 
 
 class Commands(object):
@@ -252,6 +545,45 @@ class Commands(object):
     def __len__(self):
         return len(self.do_list)
 
+    # the commands that can be read back from a plan
+    command_names = frozenset(['create', 'update', 'add_to_groups', 'remove_from_groups', 'remove_from_organization'])
+
+    def to_dict(self):
+        """
+        The commands in a form that can be written as JSON, and read back by from_dict.
+        :rtype: dict
+        """
+        do_list = []
+        for command_name, params in self.do_list:
+            params = dict(params)
+            if 'groups' in params:
+                params['groups'] = sorted(params['groups'])
+            if 'on_conflict' in params:
+                params['on_conflict'] = params['on_conflict'].name
+            do_list.append([command_name, params])
+        return {
+            'identity_type': self.identity_type,
+            'email': self.email,
+            'username': self.username,
+            'domain': self.domain,
+            'do_list': do_list,
+        }
+
+    @classmethod
+    def from_dict(cls, content):
+        """
+        :type content: dict as returned by to_dict
+        :rtype: Commands
+        """
+        commands = cls(content.get('identity_type'), content.get('email'), content['username'], content.get('domain'))
+        for command_name, params in content['do_list']:
+            if command_name not in cls.command_names or not isinstance(params, dict):
+                raise ValueError('unknown command %s' % command_name)
+            if 'on_conflict' in params:
+                params['on_conflict'] = umapi_client.IfAlreadyExistsOptions[params['on_conflict']]
+            commands.do_list.append((command_name, params))
+        return commands
+
     def convert_user_attributes_to_params(self, attributes):
         params = {}
         for key, value in six.iteritems(attributes):
@@ -264,29 +596,66 @@ class Commands(object):
 
 
 class ActionManager(object):
-    next_request_id = 1
+    # shared by all action managers, which may be used from different threads
+    next_request_id = itertools.count(1)
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, max_concurrent_batches=1, throttle=None):
         """
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type max_concurrent_batches: int how many batches may be waiting for the server at once
+        :type throttle: user_sync.connector.umapi_throttle.UmapiThrottle that counts the actions we send
         """
         self.action_count = 0
         self.error_count = 0
-        self.items = []
+        # items waiting to be sent, and (items, future) for each batch that has been sent
+        self.items = collections.deque()
+        self.batches = collections.deque()
         self.connection = connection
         self.org_id = org_id
         self.logger = logger.getChild('action')
+        self.batch_size = getattr(connection, 'throttle_actions', 10)
+        self.max_concurrent_batches = max_concurrent_batches
+        self.throttle = throttle
+        # group-only changes held back until flush, so that ones shared by many users can be sent
+        # as user group actions; there are none unless bulk group changes are turned on
+        self.group_changes = []
+        self.bulk_min_users = 0
+        self.bulk_users_per_action = 10
+        self.journal = None
+        self.write_ahead_log = None
+        self.executor = None
+        if max_concurrent_batches > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_concurrent_batches)
+
+    def set_bulk_group_changes(self, min_users, users_per_action):
+        """
+        :type min_users: int how many users must have the same group change for it to be sent as group actions
+            (0 to never do so)
+        :type users_per_action: int
+        """
+        self.bulk_min_users = min_users
+        self.bulk_users_per_action = users_per_action
+
+    def set_write_ahead_log(self, write_ahead_log):
+        """
+        :type write_ahead_log: user_sync.connector.umapi_wal.WriteAheadLog to mark batches as sent in
+        """
+        self.write_ahead_log = write_ahead_log
+
+    def set_journal(self, journal):
+        """
+        :type journal: user_sync.connector.umapi_journal.ActionJournal to record each action and its result in
+        """
+        self.journal = journal
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
         return self.action_count, self.error_count
 
     def get_next_request_id(self):
-        request_id = 'action_%d' % ActionManager.next_request_id
-        ActionManager.next_request_id += 1
-        return request_id
+        return 'action_%d' % next(ActionManager.next_request_id)
 
     def create_action(self, commands):
         identity_type = commands.identity_type
@@ -316,64 +685,195 @@ class ActionManager(object):
             command_function(**command_param)
         return action
 
-    def add_action(self, action, callback=None):
+    def add_action(self, action, callback=None, seqs=None):
         """
         :type action: umapi_client.UserAction
         :type callback: callable(umapi_client.UserAction, bool, dict)
+        :type seqs: list(int) the write-ahead log entries of the commands in the action
         """
         item = {
             'action': action,
-            'callback': callback
+            'callback': callback,
+            'seqs': seqs,
         }
         self.items.append(item)
         self.action_count += 1
-        self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
-        self._execute_action(action)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # the full action is in the action journal, if there is one, so just identify it
+            self.logger.debug('Added action: %s for %s', action.frame.get('requestID'),
+                              action.frame.get('user') or action.frame.get('usergroup'))
+        if len(self.items) >= self.batch_size:
+            self.send_batch()
 
     def has_work(self):
-        return len(self.items) > 0
+        return len(self.items) > 0 or len(self.batches) > 0 or len(self.group_changes) > 0
 
-    def _execute_action(self, action):
+    def is_bulk_group_change(self, commands):
         """
-        :type action: umapi_client.UserAction
+        Whether the commands only change groups, for a user that group actions can name.  Group actions
+        name users by email, and prefer non-AdobeID users, so the user must not be an AdobeID and must be
+        known to UMAPI by its email.
+        :type commands: Commands
+        """
+        if not self.bulk_min_users or commands.identity_type in (None, user_sync.identity_type.ADOBEID_IDENTITY_TYPE):
+            return False
+        email = user_sync.helper.normalize_string(commands.email)
+        if not email or email != user_sync.helper.normalize_string(commands.username):
+            return False
+        return all(command_name in ('add_to_groups', 'remove_from_groups') and 'groups' in params
+                   for command_name, params in commands.do_list)
+
+    def add_group_change(self, commands, track, seq=None):
+        """
+        Hold the group changes for a user until flush.
+        :type commands: Commands for which is_bulk_group_change is true
+        :type track: callable(Commands) that returns the callback for some of these commands
+        :type seq: int the write-ahead log entry of the commands
+        """
+        self.group_changes.append((commands, track, seq))
+
+    def send_group_changes(self):
+        """
+        Send the held group changes.  Each change (an add to or removal from a group) made for at least
+        bulk_min_users users is sent as user group actions, naming up to bulk_users_per_action users each.
+        Users' other changes are sent as user actions, as usual.
+        """
+        group_changes, self.group_changes = self.group_changes, []
+        # the indexes of the users that have each change, by (command name, normalized group name)
+        users_by_change = collections.OrderedDict()
+        group_name_by_change = {}
+        for i, (commands, _, _) in enumerate(group_changes):
+            for command_name, params in commands.do_list:
+                for group in params['groups']:
+                    change = (command_name, user_sync.helper.normalize_string(group))
+                    group_name_by_change.setdefault(change, group)
+                    users_by_change.setdefault(change, []).append(i)
+        bulk_changes = set(change for change, users in six.iteritems(users_by_change)
+                           if len(users) >= self.bulk_min_users)
+        # every action's callback is made before any action is added (and so perhaps answered),
+        # since the callbacks for a user's commands keep track of how many parts they were sent in
+        actions = []
+        for change, users in six.iteritems(users_by_change):
+            if change not in bulk_changes:
+                continue
+            command_name, _ = change
+            group = group_name_by_change[change]
+            self.logger.info("Sending %s '%s' for %d users as user group actions",
+                             'additions to' if command_name == 'add_to_groups' else 'removals from', group, len(users))
+            for start in range(0, len(users), self.bulk_users_per_action):
+                emails, callbacks, seqs = [], [], []
+                for i in users[start:start + self.bulk_users_per_action]:
+                    commands, track, seq = group_changes[i]
+                    user_commands = Commands(commands.identity_type, commands.email, commands.username,
+                                             commands.domain)
+                    user_commands.do_list.append((command_name, {'groups': [group]}))
+                    emails.append(commands.email)
+                    callbacks.append(track(user_commands))
+                    if seq is not None:
+                        seqs.append(seq)
+                action = umapi_client.UserGroupAction(group, requestID=self.get_next_request_id())
+                if command_name == 'add_to_groups':
+                    action.add_users(emails)
+                else:
+                    action.remove_users(emails)
+                actions.append((action, self.make_group_callback(callbacks), seqs))
+        for commands, track, seq in group_changes:
+            user_commands = Commands(commands.identity_type, commands.email, commands.username, commands.domain)
+            for command_name, params in commands.do_list:
+                groups = [group for group in params['groups']
+                          if (command_name, user_sync.helper.normalize_string(group)) not in bulk_changes]
+                if groups:
+                    user_commands.do_list.append((command_name, {'groups': groups}))
+            if len(user_commands) > 0:
+                action = self.create_action(user_commands)
+                if action is not None:
+                    actions.append((action, track(user_commands), [seq] if seq is not None else None))
+        for action, callback, seqs in actions:
+            self.add_action(action, callback, seqs)
+
+    @staticmethod
+    def make_group_callback(callbacks):
+        """
+        The callback for a user group action, which calls the callback of each user it names
+        :type callbacks: list(callable(dict))
+        """
+        def call_all(result):
+            for callback in callbacks:
+                if callable(callback):
+                    callback(result)
+
+        return call_all
+
+    def send_batch(self):
+        """
+        Send the next batch of waiting items.  With more than one concurrent batch allowed, the
+        batch is sent in the background, once there is room for it; otherwise it's sent right away.
+        """
+        batch = [self.items.popleft() for _ in range(min(self.batch_size, len(self.items)))]
+        actions = [item['action'] for item in batch]
+        if self.write_ahead_log is not None and self.write_ahead_log.is_open():
+            self.write_ahead_log.mark_sent([seq for item in batch for seq in item['seqs'] or ()])
+        if self.executor is None:
+            try:
+                batch_error = self.execute_batch(actions)
+            except umapi_client.UnavailableError as e:
+                raise AssertionException("Error contacting UMAPI server: %s" % e)
+            self.process_batch(batch, batch_error)
+            return
+        while len(self.batches) >= self.max_concurrent_batches:
+            self.finish_batch()
+        self.batches.append((batch, self.executor.submit(self.execute_batch, actions)))
+
+    def execute_batch(self, actions):
+        """
+        Send actions to the server, and return the batch-level error, if there was one.
+        This runs on the executor's threads, so it mustn't touch our state.
+        :type actions: list(umapi_client.UserAction)
+        :rtype: umapi_client.BatchError
         """
         try:
-            _, sent, _ = self.connection.execute_single(action)
+            self.connection.execute_multiple(actions, immediate=True)
         except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
-        except umapi_client.UnavailableError as e:
-            raise AssertionException("Error contacting UMAPI server: %s" % e)
-        else:
-            self.process_sent_items(sent)
+            return e
+        return None
 
-    def flush(self):
+    def finish_batch(self):
+        """
+        Wait for the oldest batch in flight, and process its results.  Batches are always finished
+        in the order they were sent, so callbacks are called in the order actions were added.
+        """
+        batch, future = self.batches.popleft()
         try:
-            _, sent, _ = self.connection.execute_queued()
-        except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
+            batch_error = future.result()
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
-        else:
-            self.process_sent_items(sent)
+        self.process_batch(batch, batch_error)
 
-    def process_sent_items(self, total_sent, batch_error=None):
+    def flush(self):
+        if self.group_changes:
+            self.send_group_changes()
+        while self.items:
+            self.send_batch()
+        while self.batches:
+            self.finish_batch()
+
+    def process_batch(self, batch, batch_error=None):
         """
-        Note items as sent, log any processing errors, and invoke any callbacks
-        :param total_sent: number of sent items from queue, must be >= 0
+        Log any processing errors for a batch of items that has been sent, and invoke any callbacks
+        :param batch: the items that were sent
         :param batch_error: exception for a batch-level error that affected all items, if there was one
-        :return: 
+        :return:
         """
-        # update queue
-        sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
-
+        if self.throttle is not None:
+            self.throttle.add_actions(len(batch))
         # collect sent actions, their errors, their callbacks
-        details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
+        details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in batch]
 
         # log errors
         if batch_error:
             request_ids = str([action.frame.get("requestID") for action, _, _ in details])
             self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
+            self.error_count += len(batch)
         else:
             for action, errors, _ in details:
                 if errors:
@@ -383,6 +883,10 @@ class ActionManager(object):
                                           action.frame.get("requestID"),
                                           error.get("target", "<Unknown>"), error.get("command", "<Unknown>"),
                                           error.get('errorCode', "<None>"), error.get('message', "<None>"))
+        if self.journal is not None:
+            for action, errors, _ in details:
+                self.journal.add(self.org_id, action, not batch_error and not errors,
+                                 [batch_error] if batch_error else errors)
         # invoke callbacks
         for action, errors, callback in details:
             if callable(callback):
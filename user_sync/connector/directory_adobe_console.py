@@ -25,7 +25,10 @@ import user_sync.helper
 import user_sync.identity_type
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
-from user_sync.connector.umapi_util import make_auth_dict
+from user_sync.connector.umapi_groups import get_group_catalog
+from user_sync.connector.umapi_pages import ParallelUsersQuery
+from user_sync.connector.umapi_tokens import get_token_cache
+from user_sync.connector.umapi_util import make_auth, make_auth_dict
 from user_sync.helper import normalize_string
 from user_sync.identity_type import parse_identity_type
 from user_sync.config import user_sync as config
@@ -86,8 +89,17 @@ class AdobeConsoleConnector(object):
         server_builder.set_string_value('ims_endpoint_jwt', '/ims/exchange/jwt')
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
+        server_builder.set_int_value('max_concurrent_pages', 1)
         options['server'] = server_options = server_builder.get_options()
 
+        token_cache_config = caller_config.get_dict_config('token_cache', True)
+        token_cache_builder = config_common.OptionsBuilder(token_cache_config)
+        token_cache_builder.set_string_value('path', None)
+        token_cache_builder.set_int_value('min_remaining_minutes', 60)
+        options['token_cache'] = token_cache_options = token_cache_builder.get_options()
+        if server_options['max_concurrent_pages'] < 1:
+            raise AssertionException("%s: max_concurrent_pages must be at least 1" % self.name)
+
         enterprise_config = caller_config.get_dict_config('integration')
         integration_builder = config_common.OptionsBuilder(enterprise_config)
         integration_builder.require_string_value('org_id')
@@ -102,7 +114,11 @@ class AdobeConsoleConnector(object):
 
         ims_host = server_options['ims_host']
         self.org_id = org_id = integration_options['org_id']
-        auth_dict = make_auth_dict(self.name, enterprise_config, org_id, integration_options[tech_field], logger)
+        token_cache = None
+        if token_cache_options['path']:
+            token_cache = get_token_cache(token_cache_options['path'], token_cache_options['min_remaining_minutes'])
+        auth_dict = make_auth_dict(self.name, enterprise_config, org_id, integration_options[tech_field], logger,
+                                   token_cache)
 
         # this check must come after we fetch all the settings
         caller_config.report_unused_values(logger)
@@ -111,8 +127,12 @@ class AdobeConsoleConnector(object):
         logger.debug('%s: creating connection for org %s at endpoint %s', self.name, org_id, um_endpoint)
 
         try:
+            auth = None
+            if token_cache is not None:
+                auth = make_auth(auth_dict, ims_host, server_options['ims_endpoint_jwt'], True, token_cache)
             self.connection = umapi_client.Connection(
                 org_id=org_id,
+                auth=auth,
                 auth_dict=auth_dict,
                 ims_host=ims_host,
                 ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
@@ -142,7 +162,7 @@ class AdobeConsoleConnector(object):
 
         # Loading all the groups because UMAPI doesn't support group query. DOH!
         self.logger.info('Loading groups...')
-        umapi_groups = list(self.iter_umapi_groups())
+        umapi_groups = set(self.iter_umapi_groups())
         self.logger.info('Loading users...')
 
         # Loading all umapi users based on ID Type first before doing group filtering
@@ -206,10 +226,13 @@ class AdobeConsoleConnector(object):
         return user
 
     def iter_umapi_groups(self):
+        # the groups are shared with any UMAPI connector to the same org, so they are only read once
+        for group in get_group_catalog(self.org_id, self.logger).get_groups(self.read_umapi_groups):
+            yield group['groupName']
+
+    def read_umapi_groups(self):
         try:
-            groups = umapi_client.GroupsQuery(self.connection)
-            for group in groups:
-                yield group['groupName']
+            return list(umapi_client.GroupsQuery(self.connection))
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error to query groups from Adobe Console: %s" % e)
 
@@ -222,7 +245,12 @@ class AdobeConsoleConnector(object):
 
     def load_umapi_users(self, identity_type):
         try:
-            u_query = umapi_client.UsersQuery(self.connection)
+            max_concurrent_pages = self.options['server']['max_concurrent_pages']
+            if max_concurrent_pages > 1:
+                # the order of the users doesn't matter here
+                u_query = ParallelUsersQuery(self.connection, max_concurrent_pages=max_concurrent_pages, ordered=False)
+            else:
+                u_query = umapi_client.UsersQuery(self.connection)
             umapi_users = u_query.all_results()
 
             if not identity_type == 'all':
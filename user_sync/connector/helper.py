@@ -20,6 +20,8 @@
 
 import logging
 
+from user_sync.connector.user_record import DirectoryUser
+
 
 def create_logger(options):
     """
@@ -33,17 +35,16 @@ def create_logger(options):
 
 def create_blank_user():
     """
-    :rtype dict
+    :rtype DirectoryUser
     """
-    user = {
-        "identity_type": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
+    user = DirectoryUser()
+    user.identity_type = None
+    user.username = None
+    user.domain = None
+    user.firstname = None
+    user.lastname = None
+    user.email = None
+    user.groups = []
+    user.country = None
     return user
 
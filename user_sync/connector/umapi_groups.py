@@ -0,0 +1,168 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import threading
+import time
+
+from user_sync.error import AssertionException
+from user_sync.helper import normalize_string
+
+CATALOG_VERSION = 1
+
+
+class GroupCatalog(object):
+    """
+    The user groups of an organization, indexed by normalized name.  All the connectors to an
+    organization share one catalog (see get_group_catalog), so its groups are read at most once
+    per run.  If given a cache path, the groups are also kept on disk, and runs that start within
+    max_age_minutes of the read use them instead of reading them again.  Groups that we create
+    are added to the catalog, and make any cache on disk out of date, so it is removed.
+    """
+
+    def __init__(self, org_id, logger):
+        """
+        :type org_id: str
+        :type logger: logging.Logger
+        """
+        self.org_id = org_id
+        self.logger = logger
+        self.cache_path = None
+        self.max_age_minutes = 0
+        self.groups = None
+        self.names = set()
+        self.lock = threading.RLock()
+
+    def set_cache(self, path, max_age_minutes):
+        """
+        :type path: str
+        :type max_age_minutes: int
+        """
+        with self.lock:
+            self.cache_path = path
+            self.max_age_minutes = max_age_minutes
+
+    def is_loaded(self):
+        return self.groups is not None
+
+    def get_groups(self, read_groups):
+        """
+        The groups of the org, read with read_groups if they aren't known yet.
+        :type read_groups: callable() -> iterable(dict)
+        :rtype: list(dict)
+        """
+        with self.lock:
+            if self.groups is None:
+                groups = self.load_cache()
+                if groups is None:
+                    groups = list(read_groups())
+                    self.save_cache(groups)
+                self.groups = groups
+                self.names = {normalize_string(g['groupName']) for g in groups}
+            return list(self.groups)
+
+    def contains(self, group_name):
+        """
+        Whether the org has a group with this name (ignoring case), if the groups are known.
+        :type group_name: str
+        :rtype: bool
+        """
+        return normalize_string(group_name) in self.names
+
+    def add_group(self, group_name):
+        """
+        Note a group that we created.
+        :type group_name: str
+        """
+        with self.lock:
+            if self.groups is not None and not self.contains(group_name):
+                self.groups.append({'groupName': group_name})
+                self.names.add(normalize_string(group_name))
+            self.remove_cache()
+
+    def invalidate(self):
+        """
+        Forget the groups, so they are read again when next needed.
+        """
+        with self.lock:
+            self.groups = None
+            self.names = set()
+            self.remove_cache()
+
+    def load_cache(self):
+        """
+        :rtype: list(dict) the cached groups, or None if there's no fresh cache
+        """
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, 'r') as f:
+                content = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning("Ignoring unreadable group cache '%s': %s", self.cache_path, e)
+            return None
+        if content.get('version') != CATALOG_VERSION or content.get('org_id') != self.org_id:
+            return None
+        age_minutes = (time.time() - content.get('saved_at', 0)) / 60
+        if age_minutes >= self.max_age_minutes:
+            return None
+        self.logger.info('Using the %d groups cached %.0f minutes ago in: %s', len(content['groups']),
+                         age_minutes, self.cache_path)
+        return content['groups']
+
+    def save_cache(self, groups):
+        if not self.cache_path:
+            return
+        content = {
+            'version': CATALOG_VERSION,
+            'org_id': self.org_id,
+            'saved_at': time.time(),
+            'groups': groups,
+        }
+        temp_path = self.cache_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(content, f)
+            os.replace(temp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            raise AssertionException("Unable to write group cache '%s': %s" % (self.cache_path, e))
+
+    def remove_cache(self):
+        if self.cache_path and os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+
+catalog_by_org_id = {}
+catalog_lock = threading.Lock()
+
+
+def get_group_catalog(org_id, logger):
+    """
+    The group catalog for an organization, which all its connectors share.
+    :type org_id: str
+    :type logger: logging.Logger
+    :rtype: GroupCatalog
+    """
+    with catalog_lock:
+        catalog = catalog_by_org_id.get(org_id)
+        if catalog is None:
+            catalog = catalog_by_org_id[org_id] = GroupCatalog(org_id, logger)
+        return catalog
@@ -0,0 +1,118 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import threading
+import time
+
+from six.moves import queue
+
+from user_sync.error import AssertionException
+
+
+class ActionJournal(object):
+    """
+    An audit trail of the actions sent to UMAPI: one compact JSON line per action, with its result.
+    Action managers hand over their actions as they are processed, and a background thread does
+    the serializing and (buffered) writing, so the threads sending actions never wait for it.
+    """
+
+    def __init__(self, path):
+        """
+        :type path: str the file to append to
+        """
+        self.path = path
+        try:
+            self.file = open(path, 'a', buffering=1 << 16)
+        except (IOError, OSError) as e:
+            raise AssertionException("Unable to open action journal '%s': %s" % (path, e))
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.write_entries, name='action-journal')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, org_id, action, is_success, errors):
+        """
+        :type org_id: str
+        :type action: umapi_client.Action that has been sent (and won't change again)
+        :type is_success: bool
+        :type errors: list of error dicts, or exceptions
+        """
+        self.queue.put((time.time(), org_id, action, is_success, errors))
+
+    def write_entries(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            try:
+                self.file.write(self.format_entry(*entry))
+                if self.queue.empty():
+                    self.file.flush()
+            except (IOError, OSError) as e:
+                # report it when the journal is closed, rather than on some other thread
+                self.error = self.error or e
+        self.file.close()
+
+    @staticmethod
+    def format_entry(timestamp, org_id, action, is_success, errors):
+        entry = {
+            'time': round(timestamp, 3),
+            'org_id': org_id,
+            'action': action.wire_dict(),
+            'success': is_success,
+        }
+        if errors:
+            entry['errors'] = [error if isinstance(error, dict) else str(error) for error in errors]
+        return json.dumps(entry, separators=(',', ':'), default=str) + '\n'
+
+    def close(self):
+        """
+        Write everything added so far, and close the file.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise AssertionException("Unable to write action journal '%s': %s" % (self.path, self.error))
+
+
+# the journal for this run, if there is one
+action_journal = None
+
+
+def open_action_journal(path):
+    global action_journal
+    close_action_journal()
+    action_journal = ActionJournal(path)
+
+
+def get_action_journal():
+    """
+    :rtype: ActionJournal
+    """
+    return action_journal
+
+
+def close_action_journal():
+    global action_journal
+    journal, action_journal = action_journal, None
+    if journal is not None:
+        journal.close()
@@ -0,0 +1,269 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import concurrent.futures
+import json
+import os
+import time
+
+import umapi_client
+
+from user_sync.error import AssertionException
+
+SPOOL_VERSION = 1
+
+
+class ParallelUsersQuery(object):
+    """
+    A query for the users of an org (or of a group in it) that reads the pages of the result
+    several at a time.  The first page tells us how many pages there are, so the rest are
+    fetched by a pool of at most max_concurrent_pages threads, while the users are yielded
+    either in page order, or as each page arrives if ordered is False.
+
+    Pages are fetched by number, so a user added or removed during the read can shift another
+    user from one page to the next: a user may then appear on two pages, and is only yielded
+    once.  If the last expected page isn't the last page by the time it's read (or the server
+    gave no page count), the pages after it are read one at a time until the server says there
+    are no more.
+
+    If given a PageSpool, each page is written to it as it arrives, and pages already in it
+    (from an earlier read that failed) are used rather than read again.  Those come first.
+
+    Like umapi_client.UsersQuery, this can be iterated, and has stats() and all_results().
+    """
+
+    def __init__(self, connection, in_group=None, max_concurrent_pages=4, ordered=True, spool=None):
+        """
+        :type connection: umapi_client.Connection
+        :type in_group: str
+        :type max_concurrent_pages: int
+        :type ordered: bool
+        :type spool: PageSpool
+        """
+        # let the client build the query, so we query just as it would
+        query = umapi_client.UsersQuery(connection, in_group=in_group)
+        self.connection = connection
+        self.object_type = query.object_type
+        self.url_params = query.url_params
+        self.query_params = query.query_params
+        self.max_concurrent_pages = max(max_concurrent_pages, 1)
+        self.ordered = ordered
+        self.spool = spool
+        self.total_count = 0
+        self.page_count = 0
+        self.page_size = 0
+        self.pages_read = 0
+
+    def fetch_page(self, page):
+        """
+        :type page: int
+        :rtype: (list(dict), bool, int, int) the users on the page, whether it's the last page,
+            and the total user and page counts the server gave with it
+        """
+        users, last_page, total_count, page_count, _, page_size = \
+            self.connection.query_multiple(self.object_type, page, self.url_params, self.query_params)
+        if page_size:
+            self.page_size = page_size
+        return users, last_page or not users, total_count, page_count
+
+    def read_page(self, page, content, spooled=False):
+        """
+        Note a page that has arrived, and spool it if it isn't already.
+        :type page: int
+        :type content: (list(dict), bool, int, int) as returned by fetch_page
+        :type spooled: bool
+        :rtype: list(dict) the users on the page
+        """
+        users, last_page, self.total_count, page_count = content
+        if page == 0:
+            self.page_count = page_count
+            if not self.page_size:
+                # a spooled first page is a full one, unless it's the only one
+                self.page_size = max(len(users), 1)
+        if not last_page and page >= self.page_count - 1:
+            # the org grew while we were reading it, or the server gave no page count:
+            # either way there is at least one more page, so read on until the last
+            self.page_count = page + 2
+        self.pages_read += 1
+        if self.spool is not None and not spooled:
+            self.spool.add_page(page, content)
+        return users
+
+    def iter_pages(self):
+        spooled = self.spool.load() if self.spool is not None else {}
+        if 0 in spooled:
+            for page in sorted(spooled):
+                yield self.read_page(page, spooled[page], spooled=True)
+        else:
+            spooled = {}
+            yield self.read_page(0, self.fetch_page(0))
+        next_page = 1
+        with concurrent.futures.ThreadPoolExecutor(self.max_concurrent_pages) as executor:
+            # keep no more pages in memory than we have threads to read them
+            in_flight = collections.OrderedDict()
+            try:
+                while True:
+                    while next_page in spooled:
+                        next_page += 1
+                    while next_page < self.page_count and len(in_flight) < self.max_concurrent_pages:
+                        in_flight[next_page] = executor.submit(self.fetch_page, next_page)
+                        next_page += 1
+                        while next_page in spooled:
+                            next_page += 1
+                    if not in_flight:
+                        break
+                    if self.ordered:
+                        page, future = next(iter(in_flight.items()))
+                    else:
+                        done, _ = concurrent.futures.wait(in_flight.values(),
+                                                          return_when=concurrent.futures.FIRST_COMPLETED)
+                        page = next(page for page, future in in_flight.items() if future in done)
+                        future = in_flight[page]
+                    del in_flight[page]
+                    yield self.read_page(page, future.result())
+            finally:
+                for future in in_flight.values():
+                    future.cancel()
+        if self.spool is not None:
+            self.spool.finish()
+
+    def __iter__(self):
+        seen = set()
+        for users in self.iter_pages():
+            for user in users:
+                email = user.get('email')
+                if email in seen:
+                    continue
+                seen.add(email)
+                yield user
+
+    def all_results(self):
+        return list(self)
+
+    def stats(self):
+        """
+        :rtype: (int, int, int, int) the total user count, the page count, the page size, and the number
+            of pages read so far, as umapi_client.UsersQuery.stats() gives them
+        """
+        return self.total_count, self.page_count, self.page_size, self.pages_read
+
+
+class PageSpool(object):
+    """
+    A file holding the pages of a user read as they arrive, so that a read that fails part
+    way through (for instance, when the server stays unavailable past our retries) can be
+    continued by the next read that starts within max_age_minutes of it, instead of starting
+    again from the first page.
+
+    The spool has a header line, then one JSON line per page with the page number, the users
+    on it, and the counts the server gave with it.  It is removed when a read finishes.
+    """
+
+    def __init__(self, path, org_id, max_age_minutes, logger):
+        """
+        :type path: str
+        :type org_id: str
+        :type max_age_minutes: int
+        :type logger: logging.Logger
+        """
+        self.path = path
+        self.org_id = org_id
+        self.max_age_minutes = max_age_minutes
+        self.logger = logger
+        self.file = None
+
+    def load(self):
+        """
+        Read the pages of an earlier read, if it's fresh enough, and get ready to spool more.
+        :rtype: dict(int, (list(dict), bool, int, int)) the pages of the earlier read, by page number
+        """
+        self.close()
+        pages = {}
+        good_length = 0
+        try:
+            if os.path.isfile(self.path):
+                with open(self.path, 'rb') as f:
+                    header = None
+                    for line in f:
+                        try:
+                            content = json.loads(line.decode('utf-8'))
+                        except ValueError:
+                            # the read that wrote it died part way through the line
+                            break
+                        if header is None:
+                            header = content
+                            if not self.is_usable(header):
+                                break
+                        else:
+                            pages[content['page']] = (content['users'], content['last'],
+                                                      content['total_count'], content['page_count'])
+                        good_length += len(line)
+            if pages:
+                self.logger.info('Continuing the user read from %s (%d pages already read)', self.path, len(pages))
+                self.file = open(self.path, 'r+b')
+                self.file.truncate(good_length)
+                self.file.seek(good_length)
+            else:
+                self.file = open(self.path, 'wb')
+                self.write({'version': SPOOL_VERSION, 'org_id': self.org_id, 'started': time.time()})
+        except (IOError, OSError, KeyError, TypeError) as e:
+            raise AssertionException("Unable to use user read spool '%s': %s" % (self.path, e))
+        return pages
+
+    def is_usable(self, header):
+        """
+        :type header: dict
+        :rtype: bool whether a spool with this header can be continued
+        """
+        if header.get('version') != SPOOL_VERSION or header.get('org_id') != self.org_id:
+            return False
+        started = header.get('started', 0)
+        return time.time() - started < self.max_age_minutes * 60
+
+    def write(self, content):
+        self.file.write(json.dumps(content, separators=(',', ':')).encode('utf-8'))
+        self.file.write(b'\n')
+        self.file.flush()
+
+    def add_page(self, page, content):
+        """
+        :type page: int
+        :type content: (list(dict), bool, int, int) the users on the page, whether it's the last page,
+            and the total user and page counts the server gave with it
+        """
+        if self.file is None:
+            return
+        users, last_page, total_count, page_count = content
+        self.write({'page': page, 'users': users, 'last': last_page,
+                    'total_count': total_count, 'page_count': page_count})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def finish(self):
+        """
+        The read is done, so the pages won't be needed again.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
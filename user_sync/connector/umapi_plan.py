@@ -0,0 +1,153 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import threading
+
+from user_sync.error import AssertionException
+
+PLAN_VERSION = 1
+
+
+class UmapiPlanWriter(object):
+    """
+    Records the actions that a sync would send to the UMAPI connectors, instead of sending them,
+    so they can be reviewed and then sent later by the apply command (see apply_plan).
+
+    The plan is a file with one JSON object per line.  The first line names the organization
+    of each connector; each line after that is a group to create or the commands for one user.
+    The plan is written under a temporary name and only given its own name when the sync
+    finishes, so a sync that fails never leaves a partial plan behind.
+    """
+
+    def __init__(self, path, connectors):
+        """
+        :type path: str
+        :type connectors: list(user_sync.connector.connector_umapi.UmapiConnector)
+        """
+        self.path = path
+        self.temp_path = path + '.tmp'
+        self.action_count = 0
+        # connectors of secondary organizations may be synced on other threads
+        self.lock = threading.Lock()
+        try:
+            self.file = open(self.temp_path, 'w')
+        except (IOError, OSError) as e:
+            raise AssertionException("Unable to write plan '%s': %s" % (path, e))
+        self.write({
+            'version': PLAN_VERSION,
+            'org_id_by_connector': {connector.name: connector.org_id for connector in connectors},
+        })
+        for connector in connectors:
+            connector.set_plan(self)
+
+    def write(self, content):
+        self.file.write(json.dumps(content, sort_keys=True))
+        self.file.write('\n')
+
+    def add_group(self, connector_name, group_name):
+        """
+        :type connector_name: str
+        :type group_name: str
+        """
+        with self.lock:
+            self.write({'connector': connector_name, 'create_group': group_name})
+
+    def add_commands(self, connector_name, commands):
+        """
+        :type connector_name: str
+        :type commands: user_sync.connector.connector_umapi.Commands
+        """
+        content = commands.to_dict()
+        content['connector'] = connector_name
+        with self.lock:
+            self.write(content)
+            self.action_count += 1
+
+    def close(self):
+        """
+        Finish the plan, replacing any earlier plan with the same name.
+        """
+        self.file.close()
+        try:
+            os.replace(self.temp_path, self.path)
+        except OSError as e:
+            raise AssertionException("Unable to write plan '%s': %s" % (self.path, e))
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def apply_plan(path, umapi_connectors, logger):
+    """
+    Send the actions in a plan written by UmapiPlanWriter to the connectors it was written for.
+    The plan is read a line at a time, so its size doesn't matter.  The actions for one connector
+    are all sent before those for the next connector in the plan, in the order the sync made them.
+    :type path: str
+    :type umapi_connectors: user_sync.engine.umapi.UmapiConnectors
+    :type logger: logging.Logger
+    :rtype: int the number of user actions in the plan
+    """
+    connector_by_name = {connector.name: connector for connector in umapi_connectors.connectors}
+    action_count = 0
+    try:
+        with open(path, 'r') as f:
+            header = read_plan_line(path, 1, f.readline())
+            if header.get('version') != PLAN_VERSION:
+                raise AssertionException("Plan '%s' was written by a different version of User Sync" % path)
+            for name, org_id in sorted(header.get('org_id_by_connector', {}).items()):
+                connector = connector_by_name.get(name)
+                if connector is None or connector.org_id != org_id:
+                    raise AssertionException("Plan '%s' was written for org %s (connector %s), which is not "
+                                             "in the current configuration" % (path, org_id, name))
+            logger.info('Applying plan: %s', path)
+            last_connector = None
+            for line_number, line in enumerate(f, 2):
+                content = read_plan_line(path, line_number, line)
+                connector = connector_by_name.get(content.pop('connector', None))
+                if connector is None or connector.name not in header['org_id_by_connector']:
+                    raise AssertionException("Line %d of plan '%s' has an unknown connector" % (line_number, path))
+                if last_connector is not None and connector is not last_connector:
+                    # the sync sent all of one org's actions before moving on to the next (it removes users
+                    # from the secondary orgs before deleting them from the primary), so we do too
+                    last_connector.get_action_manager().flush()
+                last_connector = connector
+                try:
+                    if connector.send_plan_entry(content):
+                        action_count += 1
+                except (KeyError, TypeError, ValueError) as e:
+                    raise AssertionException("Line %d of plan '%s' has bad commands: %s" % (line_number, path, e))
+    except (IOError, OSError) as e:
+        raise AssertionException("Unable to read plan '%s': %s" % (path, e))
+    umapi_connectors.execute_actions()
+    return action_count
+
+
+def read_plan_line(path, line_number, line):
+    try:
+        content = json.loads(line)
+    except ValueError as e:
+        raise AssertionException("Line %d of plan '%s' is not valid: %s" % (line_number, path, e))
+    if not isinstance(content, dict):
+        raise AssertionException("Line %d of plan '%s' is not valid" % (line_number, path))
+    return content
@@ -0,0 +1,277 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import time
+
+import six
+
+from user_sync.connector.user_record import UmapiUser
+from user_sync.error import AssertionException
+from user_sync.helper import normalize_string
+
+SNAPSHOT_VERSION = 1
+
+
+class UmapiSnapshot(object):
+    """
+    On-disk copy of the users and groups last read from a UMAPI organization.
+
+    A snapshot is refreshed by a full read of the organization.  Between refreshes it is
+    trusted as the state of the organization, and every action that we successfully apply
+    to the organization is also applied to the snapshot so that it stays current.
+    The file is removed as soon as it is loaded and only written back at the end of a
+    successful run, so a run that dies halfway through forces a full read next time.
+    """
+
+    def __init__(self, path, org_id, refresh_runs, refresh_hours, read_only, logger):
+        """
+        :type path: str
+        :type org_id: str
+        :type refresh_runs: int
+        :type refresh_hours: int
+        :type read_only: bool
+        :type logger: logging.Logger
+        """
+        self.path = path
+        self.org_id = org_id
+        self.refresh_runs = refresh_runs
+        self.refresh_hours = refresh_hours
+        self.read_only = read_only
+        self.logger = logger
+        # state of the organization as we know it: None means "unknown"
+        self.user_by_email = None
+        # the same users, by normalized username, for finding users whose commands give no email
+        self.users_by_username = None
+        self.groups = None
+        self.refreshed_at = 0
+        self.run_count = 0
+        # a full read in progress, and whether one completed during this run
+        self.pending_user_by_email = None
+        self.refreshed = False
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            self.logger.debug('No UMAPI snapshot found at: %s', self.path)
+            return
+        try:
+            with open(self.path, 'r') as f:
+                content = json.load(f)
+        except (IOError, ValueError) as e:
+            self.logger.warning('Ignoring unreadable UMAPI snapshot %s: %s', self.path, e)
+            return
+        if content.get('version') != SNAPSHOT_VERSION or content.get('org_id') != self.org_id:
+            self.logger.warning('Ignoring UMAPI snapshot %s: it was written for a different org or version',
+                                self.path)
+            return
+        self.user_by_email = {normalize_string(u['email']): UmapiUser(u) for u in content.get('users', [])}
+        self.index_usernames()
+        self.groups = content.get('groups')
+        self.refreshed_at = content.get('refreshed_at', 0)
+        self.run_count = content.get('run_count', 0)
+        self.logger.debug('Loaded UMAPI snapshot of %d users from: %s', len(self.user_by_email), self.path)
+        if not self.read_only:
+            # we are going to change the org, so the file on disk is out of date until we save
+            os.remove(self.path)
+
+    def is_fresh(self):
+        if self.user_by_email is None:
+            return False
+        if self.refresh_runs > 0 and self.run_count >= self.refresh_runs:
+            return False
+        if self.refresh_hours > 0 and time.time() - self.refreshed_at >= self.refresh_hours * 3600:
+            return False
+        return True
+
+    def describe(self):
+        age_hours = (time.time() - self.refreshed_at) / 3600
+        return '%d users, %d runs and %.1f hours since last full read' % (len(self.user_by_email),
+                                                                          self.run_count, age_hours)
+
+    def iter_users(self):
+        """
+        Yield copies of the snapshot users, so callers can't alter the snapshot by accident
+        (copying a UmapiUser also copies its group list)
+        """
+        for user in six.itervalues(self.user_by_email):
+            yield user.copy()
+
+    def start_refresh(self):
+        self.pending_user_by_email = {}
+
+    def add_user(self, user):
+        if self.pending_user_by_email is not None:
+            user = UmapiUser(user)
+            self.pending_user_by_email[normalize_string(user['email'])] = user
+
+    def finish_refresh(self):
+        if self.pending_user_by_email is None:
+            return
+        self.user_by_email, self.pending_user_by_email = self.pending_user_by_email, None
+        self.index_usernames()
+        self.refreshed_at = time.time()
+        self.run_count = 0
+        self.refreshed = True
+
+    def index_usernames(self):
+        self.users_by_username = {}
+        for user in six.itervalues(self.user_by_email):
+            self.index_user(user)
+
+    def index_user(self, user):
+        self.users_by_username.setdefault(normalize_string(user.get('username')), []).append(user)
+
+    def unindex_user(self, user, username=None):
+        """
+        :type user: UmapiUser
+        :type username: str the normalized username the user was indexed under, if it has changed since
+        """
+        username = username if username is not None else normalize_string(user.get('username'))
+        users = self.users_by_username.get(username)
+        if users is not None:
+            users[:] = [u for u in users if u is not user]
+            if not users:
+                del self.users_by_username[username]
+
+    def get_groups(self):
+        return list(self.groups) if self.groups is not None else None
+
+    def set_groups(self, groups):
+        self.groups = list(groups)
+
+    def add_group(self, group_name):
+        if self.groups is not None and not self.read_only:
+            self.groups.append({'groupName': group_name})
+
+    def track(self, commands, callback=None):
+        """
+        Wrap an action callback so the commands are applied to the snapshot once UMAPI accepts them.
+        :type commands: user_sync.connector.connector_umapi.Commands
+        :type callback: callable(dict)
+        :rtype: callable(dict)
+        """
+        if self.read_only:
+            return callback
+
+        def apply_and_call(result):
+            if result['is_success']:
+                self.apply(commands)
+            if callable(callback):
+                callback(result)
+
+        return apply_and_call
+
+    def apply(self, commands):
+        """
+        Apply the commands of an action that UMAPI accepted to the snapshot users.
+        :type commands: user_sync.connector.connector_umapi.Commands
+        """
+        if self.user_by_email is None:
+            return
+        user = self.find_user(commands)
+        for command_name, params in commands.do_list:
+            if command_name == 'create':
+                if user is None:
+                    email = params.get('email') or commands.email
+                    user = UmapiUser(email=email, username=commands.username or email,
+                                     domain=commands.domain or email[email.find('@') + 1:],
+                                     type=commands.identity_type, groups=[])
+                    self.user_by_email[normalize_string(email)] = user
+                    self.index_user(user)
+                elif 'on_conflict' not in params or params['on_conflict'].name != 'updateIfAlreadyExists':
+                    continue
+                self.update_user(user, params)
+            elif user is None:
+                self.logger.debug('Action target not found in UMAPI snapshot: %s', commands.username)
+                break
+            elif command_name == 'update':
+                self.update_user(user, params)
+            elif command_name == 'add_to_groups':
+                groups = list(user.get('groups') or [])
+                groups.extend(g for g in params['groups'] if g not in groups)
+                user['groups'] = groups
+            elif command_name == 'remove_from_groups':
+                if params.get('all_groups'):
+                    user['groups'] = []
+                else:
+                    removed = self.normalize_groups(params['groups'])
+                    user['groups'] = [g for g in user.get('groups') or []
+                                      if normalize_string(g) not in removed]
+            elif command_name == 'remove_from_organization':
+                del self.user_by_email[normalize_string(user['email'])]
+                self.unindex_user(user)
+                user = None
+
+    def find_user(self, commands):
+        if commands.email:
+            user = self.user_by_email.get(normalize_string(commands.email))
+            if user is not None:
+                return user
+        username = normalize_string(commands.username)
+        if username and '@' in username and username in self.user_by_email:
+            return self.user_by_email[username]
+        domain = normalize_string(commands.domain)
+        for user in self.users_by_username.get(username, ()):
+            if not domain or normalize_string(user.get('domain')) == domain:
+                return user
+        return None
+
+    def update_user(self, user, params):
+        old_email_key = normalize_string(user['email'])
+        old_username = normalize_string(user.get('username'))
+        for key, value in six.iteritems(params):
+            if key == 'first_name':
+                user['firstname'] = value
+            elif key == 'last_name':
+                user['lastname'] = value
+            elif key in ('email', 'username', 'country'):
+                user[key] = value
+        new_email_key = normalize_string(user['email'])
+        if new_email_key != old_email_key:
+            self.user_by_email.pop(old_email_key, None)
+            self.user_by_email[new_email_key] = user
+        if normalize_string(user.get('username')) != old_username:
+            self.unindex_user(user, old_username)
+            self.index_user(user)
+
+    @staticmethod
+    def normalize_groups(groups):
+        return {normalize_string(g) for g in groups or []}
+
+    def save(self):
+        if self.read_only or self.user_by_email is None:
+            return
+        content = {
+            'version': SNAPSHOT_VERSION,
+            'org_id': self.org_id,
+            'refreshed_at': self.refreshed_at,
+            'run_count': self.run_count if self.refreshed else self.run_count + 1,
+            'users': [dict(u) for u in six.itervalues(self.user_by_email)],
+            'groups': self.groups,
+        }
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(content, f)
+            os.replace(temp_path, self.path)
+        except (IOError, OSError) as e:
+            raise AssertionException("Unable to write UMAPI snapshot '%s': %s" % (self.path, e))
+        self.logger.info('Saved UMAPI snapshot of %d users to: %s', len(self.user_by_email), self.path)
@@ -0,0 +1,198 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+
+# how much to change the request rate after a throttled response, and after each good one
+THROTTLED_RATE_FACTOR = 0.5
+INCREASE_RATE_FACTOR = 1.05
+# the slowest we'll go, in requests per second
+MIN_RATE = 0.2
+# how much slower than the fastest we've seen responses must get before we stop speeding up
+SLOW_LATENCY_FACTOR = 2.0
+# weight of each new response time in the running average
+LATENCY_WEIGHT = 0.2
+
+
+class UmapiThrottle(object):
+    """
+    A token bucket that paces the requests made to one UMAPI organization, shared by every
+    connector (and every thread) that talks to that organization.
+
+    The bucket starts at max_rate requests per second (or no limit at all).  When the server
+    throttles a request, the rate is cut, and every other request waits for the time the server
+    asks for (in Retry-After); the throttled request itself is retried by umapi_client, which
+    already waits that long.  Each good response then raises the rate a little again, up to
+    max_rate and never past the rate that was throttled, unless responses are getting slower than
+    the fastest we've seen, which is a sign the server is near its limit.
+    """
+
+    def __init__(self, org_id, max_rate=None, clock=time.time, sleep=time.sleep):
+        """
+        :type org_id: str
+        :type max_rate: float requests per second (None for no limit until the server throttles us)
+        """
+        self.org_id = org_id
+        self.max_rate = max_rate
+        self.rate = max_rate
+        # the rate we were going when the server last throttled us, which we don't go past again
+        self.ceiling = None
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        # the end of the pause caused by a throttled response to this thread's last request
+        self.local = threading.local()
+        self.tokens = 1.0
+        self.updated_at = clock()
+        self.paused_until = 0
+        self.latency = None
+        self.min_latency = None
+        self.request_count = 0
+        self.throttled_count = 0
+        self.action_count = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def acquire(self):
+        """
+        Wait until a request may be sent.
+        """
+        own_pause_until = getattr(self.local, 'paused_until', 0)
+        self.local.paused_until = 0
+        while True:
+            with self.lock:
+                now = self.clock()
+                # a retry of a throttled request has already waited out its pause in the client
+                wait = self.paused_until - now if self.paused_until > own_pause_until else 0
+                if wait <= 0 and self.rate is None:
+                    break
+                if wait <= 0:
+                    self.tokens = min(1.0, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        break
+                    wait = (1.0 - self.tokens) / self.rate
+            self.sleep(wait)
+        with self.lock:
+            self.request_count += 1
+            if self.started_at is None:
+                self.started_at = now
+
+    def record_response(self, status_code, retry_after, latency):
+        """
+        Adjust the rate after a response.
+        :type status_code: int
+        :type retry_after: str the Retry-After header, if there was one
+        :type latency: float seconds
+        """
+        with self.lock:
+            now = self.clock()
+            self.finished_at = now
+            if status_code in (429, 502, 503, 504):
+                self.throttled_count += 1
+                self.local.paused_until = now + self.parse_retry_after(retry_after)
+                self.paused_until = max(self.paused_until, self.local.paused_until)
+                # go at half the rate we were going, or were getting if there was no limit
+                rate = self.rate if self.rate is not None else self.get_request_rate()
+                self.ceiling = rate
+                self.rate = max(MIN_RATE, rate * THROTTLED_RATE_FACTOR)
+                self.tokens = 0.0
+                self.updated_at = now
+                return
+            self.latency = latency if self.latency is None else \
+                LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * self.latency
+            self.min_latency = self.latency if self.min_latency is None else min(self.min_latency, self.latency)
+            if self.rate is None or self.latency > SLOW_LATENCY_FACTOR * self.min_latency:
+                return
+            self.rate *= INCREASE_RATE_FACTOR
+            for limit in (self.max_rate, self.ceiling):
+                if limit is not None:
+                    self.rate = min(self.rate, limit)
+
+    @staticmethod
+    def parse_retry_after(retry_after):
+        # the server sends a number of seconds; we don't expect, and don't honor, an HTTP date
+        try:
+            return max(0.0, float(retry_after))
+        except (TypeError, ValueError):
+            return 0.0
+
+    def add_actions(self, count):
+        with self.lock:
+            self.action_count += count
+
+    def get_request_rate(self):
+        elapsed = self.clock() - self.started_at if self.started_at is not None else 0
+        return self.request_count / elapsed if elapsed > 0 else 1 / MIN_RATE
+
+    def describe(self):
+        elapsed = (self.finished_at or 0) - (self.started_at or 0)
+        actions_per_second = self.action_count / elapsed if elapsed > 0 else 0.0
+        limit = 'no limit' if self.rate is None else 'limit %.1f requests per second' % self.rate
+        return '%d actions in %d requests (%.1f actions per second), %d throttled responses, %s' % (
+            self.action_count, self.request_count, actions_per_second, self.throttled_count, limit)
+
+    def install(self, session):
+        """
+        Pace the requests made by a session, and learn from their responses.
+        :type session: requests.Session
+        """
+        request = session.request
+
+        def throttled_request(method, url, *args, **kwargs):
+            self.acquire()
+            start = self.clock()
+            response = request(method, url, *args, **kwargs)
+            self.record_response(response.status_code, response.headers.get('Retry-After'), self.clock() - start)
+            return response
+
+        session.request = throttled_request
+
+
+# the throttles for the organizations in this run, by org id
+throttle_by_org_id = {}
+throttle_lock = threading.Lock()
+
+
+def get_throttle(org_id, max_rate=None):
+    """
+    The throttle for an organization, which all its connectors share.
+    :type org_id: str
+    :type max_rate: float
+    :rtype: UmapiThrottle
+    """
+    with throttle_lock:
+        throttle = throttle_by_org_id.get(org_id)
+        if throttle is None:
+            throttle = throttle_by_org_id[org_id] = UmapiThrottle(org_id, max_rate)
+        elif max_rate is not None and (throttle.max_rate is None or max_rate < throttle.max_rate):
+            # connectors for the same org may be configured differently: use the lowest limit
+            throttle.max_rate = throttle.rate = max_rate
+        return throttle
+
+
+def log_throttle_statistics(logger):
+    with throttle_lock:
+        throttles = list(throttle_by_org_id.values())
+    for throttle in throttles:
+        if throttle.request_count:
+            logger.info('UMAPI org %s: %s', throttle.org_id, throttle.describe())
@@ -0,0 +1,165 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import base64
+import json
+import os
+import threading
+import time
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+
+from user_sync.error import AssertionException
+
+TOKEN_CACHE_VERSION = 1
+
+
+class TokenCache(object):
+    """
+    A file of IMS access tokens, kept from run to run so that a run can reuse an unexpired token
+    rather than decrypting its private key and exchanging a JWT for a new token.
+
+    Each token is stored under its org and technical account, encrypted with AES-GCM under a key
+    derived from the client secret of the integration it was issued to, so the file is of no use
+    to anyone who doesn't already have the credentials.  A token is only reused if it has at
+    least min_remaining_minutes left, so it rarely expires during a run; if it does, the
+    connection exchanges the key for a new one (see umapi_util.RefreshingAuth).
+    """
+
+    def __init__(self, path, min_remaining_minutes):
+        """
+        :type path: str
+        :type min_remaining_minutes: int
+        """
+        self.path = path
+        self.min_remaining_minutes = min_remaining_minutes
+        # connectors to several orgs may share the file
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_entry_name(org_id, tech_acct, api_key):
+        return '%s/%s/%s' % (org_id, tech_acct, api_key)
+
+    @staticmethod
+    def make_key(client_secret, salt):
+        return HKDF(client_secret.encode('utf-8'), 32, salt, SHA256)
+
+    def read_entries(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                content = json.load(f)
+        except (IOError, OSError, ValueError):
+            # a damaged cache only costs us a token exchange
+            return {}
+        if content.get('version') != TOKEN_CACHE_VERSION:
+            return {}
+        return content.get('tokens', {})
+
+    def get_token(self, org_id, tech_acct, api_key, client_secret):
+        """
+        :type org_id: str
+        :type tech_acct: str
+        :type api_key: str
+        :type client_secret: str
+        :rtype: str an access token with enough time left, or None if there isn't one
+        """
+        return self.get_token_and_expiry(org_id, tech_acct, api_key, client_secret)[0]
+
+    def get_token_and_expiry(self, org_id, tech_acct, api_key, client_secret):
+        """
+        :type org_id: str
+        :type tech_acct: str
+        :type api_key: str
+        :type client_secret: str
+        :rtype: (str, float) an access token with enough time left and when it expires, or (None, None)
+        """
+        name = self.make_entry_name(org_id, tech_acct, api_key)
+        with self.lock:
+            entry = self.read_entries().get(name)
+        if entry is None or entry.get('expires_at', 0) - time.time() < self.min_remaining_minutes * 60:
+            return None, None
+        try:
+            data = base64.b64decode(entry['data'])
+            salt, nonce, tag, ciphertext = data[:16], data[16:32], data[32:48], data[48:]
+            cipher = AES.new(self.make_key(client_secret, salt), AES.MODE_GCM, nonce=nonce)
+            cipher.update(name.encode('utf-8'))
+            return cipher.decrypt_and_verify(ciphertext, tag).decode('utf-8'), entry['expires_at']
+        except (KeyError, TypeError, ValueError):
+            # written with another secret, or damaged
+            return None, None
+
+    def add_token(self, org_id, tech_acct, api_key, client_secret, access_token, expires_at):
+        """
+        :type org_id: str
+        :type tech_acct: str
+        :type api_key: str
+        :type client_secret: str
+        :type access_token: str
+        :type expires_at: float when the token expires (seconds since the epoch)
+        """
+        name = self.make_entry_name(org_id, tech_acct, api_key)
+        salt = get_random_bytes(16)
+        cipher = AES.new(self.make_key(client_secret, salt), AES.MODE_GCM, nonce=get_random_bytes(16))
+        cipher.update(name.encode('utf-8'))
+        ciphertext, tag = cipher.encrypt_and_digest(access_token.encode('utf-8'))
+        entry = {
+            'expires_at': expires_at,
+            'data': base64.b64encode(salt + cipher.nonce + tag + ciphertext).decode('ascii'),
+        }
+        with self.lock:
+            entries = self.read_entries()
+            now = time.time()
+            entries = {k: v for k, v in entries.items() if v.get('expires_at', 0) > now}
+            entries[name] = entry
+            temp_path = self.path + '.tmp'
+            try:
+                # the tokens are encrypted, but there's no need for anyone else to read them
+                fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'version': TOKEN_CACHE_VERSION, 'tokens': entries}, f)
+                os.replace(temp_path, self.path)
+            except (IOError, OSError) as e:
+                raise AssertionException("Unable to write token cache '%s': %s" % (self.path, e))
+
+
+token_cache_by_path = {}
+token_cache_lock = threading.Lock()
+
+
+def get_token_cache(path, min_remaining_minutes):
+    """
+    The token cache kept in a file, which all the connectors that use the file share.
+    :type path: str
+    :type min_remaining_minutes: int
+    :rtype: TokenCache
+    """
+    path = os.path.abspath(path)
+    with token_cache_lock:
+        token_cache = token_cache_by_path.get(path)
+        if token_cache is None:
+            token_cache = token_cache_by_path[path] = TokenCache(path, min_remaining_minutes)
+        else:
+            token_cache.min_remaining_minutes = max(token_cache.min_remaining_minutes, min_remaining_minutes)
+        return token_cache
@@ -1,8 +1,21 @@
+import io
+import threading
+import time
+
+import umapi_client.auth
+
 from user_sync.error import AssertionException
 from user_sync.encryption import decrypt
 
 
-def make_auth_dict(name, config, org_id, tech_acct, logger):
+def make_auth_dict(name, config, org_id, tech_acct, logger, token_cache=None):
+    """
+    The credentials to authorize with.  If the token cache has an access token for them, it is
+    given as access_token (with its expires_at) instead of the private key, which is then only
+    decrypted if the token has to be replaced during the run.
+    :type token_cache: user_sync.connector.umapi_tokens.TokenCache
+    :rtype: dict
+    """
     api_field = 'client_id' if 'client_id' in config or 'secure_client_id_key' in config else "api_key"
     if "api_key" in config and "client_id" in config:
         #word to be the same thing--take out api key--
@@ -15,7 +28,27 @@ def make_auth_dict(name, config, org_id, tech_acct, logger):
         'api_key': config.get_credential(api_field, org_id),
         'client_secret': config.get_credential('client_secret', org_id),
     }
-    # get the private key
+    # read the key settings now, so they're all used, but only decrypt the key when it's needed
+    load_private_key = make_private_key_loader(name, config, org_id, logger)
+    if token_cache is not None:
+        access_token, expires_at = token_cache.get_token_and_expiry(org_id, tech_acct, auth_dict['api_key'],
+                                                                     auth_dict['client_secret'])
+        if access_token is not None:
+            logger.debug('%s: using cached access token', name)
+            auth_dict['access_token'] = access_token
+            auth_dict['expires_at'] = expires_at
+            # in case the run outlasts the token
+            auth_dict['load_private_key'] = load_private_key
+            return auth_dict
+    auth_dict['private_key_data'] = load_private_key()
+    return auth_dict
+
+
+def make_private_key_loader(name, config, org_id, logger):
+    """
+    Read the private key settings, and return a function that gives the (decrypted) key data.
+    :rtype: callable() -> str
+    """
     key_path = config.get_string('priv_key_path', True)
     if key_path:
         data_setting = config.has_credential('priv_key_data')
@@ -31,13 +64,82 @@ def make_auth_dict(name, config, org_id, tech_acct, logger):
                                      (config.get_full_scope(), key_path, e))
     else:
         key_data = config.get_credential('priv_key_data', org_id)
-    # decrypt the private key, if needed
     passphrase = config.get_credential('priv_key_pass', org_id, True)
-    if passphrase:
+    scope = config.get_full_scope()
+
+    def load_private_key():
+        # decrypt the private key, if needed
+        if not passphrase:
+            return key_data
         try:
-            key_data = decrypt(passphrase, key_data)
+            return decrypt(passphrase, key_data)
         except (ValueError, IndexError, TypeError, AssertionException) as e:
             raise AssertionException('%s: Error decrypting private key, either the password is wrong or: %s' %
-                                     (config.get_full_scope(), e))
-    auth_dict['private_key_data'] = key_data
-    return auth_dict
+                                     (scope, e))
+
+    return load_private_key
+
+
+def make_auth(auth_dict, ims_host, ims_endpoint_jwt, ssl_verify, token_cache):
+    """
+    Authorize with the credentials made by make_auth_dict: with the cached access token, if there
+    is one, or else by exchanging a JWT for a new access token, which is then cached.  Either way,
+    a new token is exchanged for (and cached) when the token is about to expire.
+    :type auth_dict: dict
+    :type ims_host: str
+    :type ims_endpoint_jwt: str
+    :type ssl_verify: bool
+    :type token_cache: user_sync.connector.umapi_tokens.TokenCache
+    :rtype: umapi_client.auth.Auth
+    """
+    api_key = auth_dict['api_key']
+
+    def exchange_token():
+        private_key_data = auth_dict.get('private_key_data')
+        if private_key_data is None:
+            private_key_data = auth_dict['private_key_data'] = auth_dict['load_private_key']()
+        jwt = umapi_client.auth.JWT(auth_dict['org_id'], auth_dict['tech_acct_id'], ims_host, api_key,
+                                    io.StringIO(private_key_data))
+        access_request = umapi_client.auth.AccessRequest('https://' + ims_host + ims_endpoint_jwt, api_key,
+                                                         auth_dict['client_secret'], jwt(), ssl_verify)
+        access_token = access_request()
+        expires_at = access_request.expiry.timestamp()
+        token_cache.add_token(auth_dict['org_id'], auth_dict['tech_acct_id'], api_key, auth_dict['client_secret'],
+                              access_token, expires_at)
+        return access_token, expires_at
+
+    if 'access_token' in auth_dict:
+        access_token, expires_at = auth_dict['access_token'], auth_dict['expires_at']
+    else:
+        access_token, expires_at = exchange_token()
+    return RefreshingAuth(api_key, access_token, expires_at, exchange_token)
+
+
+class RefreshingAuth(umapi_client.auth.Auth):
+    """
+    An Auth whose access token is exchanged for a new one shortly before it expires, so a run
+    that outlasts its token (a cached one, in particular) doesn't start failing with 401s.
+    """
+
+    # how long before the token expires to get a new one, in seconds
+    refresh_margin = 300
+
+    def __init__(self, api_key, access_token, expires_at, exchange_token, clock=time.time):
+        """
+        :type api_key: str
+        :type access_token: str
+        :type expires_at: float when the token expires (seconds since the epoch)
+        :type exchange_token: callable() -> (str, float) gets a new token and its expiry
+        """
+        super(RefreshingAuth, self).__init__(api_key, access_token)
+        self.expires_at = expires_at
+        self.exchange_token = exchange_token
+        self.clock = clock
+        # the connection's requests may be made from several threads
+        self.lock = threading.Lock()
+
+    def __call__(self, r):
+        with self.lock:
+            if self.clock() >= self.expires_at - self.refresh_margin:
+                self.access_token, self.expires_at = self.exchange_token()
+        return super(RefreshingAuth, self).__call__(r)
@@ -0,0 +1,251 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import threading
+
+from user_sync.error import AssertionException
+
+WAL_VERSION = 1
+
+
+class WriteAheadLog(object):
+    """
+    A crash-safe log of the actions a run sends to one UMAPI organization, so that a run that dies
+    part way through can be finished by the next one (see resume_actions).
+
+    After a header, the log has one JSON object per line:
+    - {"seq": n, ...} is an action we are going to send: a group to create, or the commands for a user
+      (in the form of a plan entry);
+    - {"sent": [n, ...]} says that a batch with those actions is about to be sent;
+    - {"ack": n, "success": b} says that UMAPI has answered for all of action n;
+    - {"complete": true} says that every action of the run is in the log.
+    The log is forced to disk before each batch is sent, so an action is always logged before it
+    can take effect.  The log is removed at the end of a run whose actions were all answered.
+    """
+
+    def __init__(self, path, org_id, logger):
+        """
+        :type path: str
+        :type org_id: str
+        :type logger: logging.Logger
+        """
+        self.path = path
+        self.org_id = org_id
+        self.logger = logger
+        self.file = None
+        self.next_seq = 1
+        # for each action with parts that haven't been answered: [parts outstanding, all succeeded so far]
+        self.outstanding = {}
+        self.complete = False
+        self.lock = threading.RLock()
+
+    def is_open(self):
+        return self.file is not None
+
+    def read_pending(self):
+        """
+        Read the log left by the last run, if there is one.
+        :rtype: (list(dict), bool) the actions it logged but didn't see answered, in order,
+            and whether it logged all its actions; or (None, False) if there is no log
+        """
+        if not os.path.isfile(self.path):
+            return None, False
+        planned = {}
+        sent = set()
+        complete = False
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except (IOError, OSError) as e:
+            raise AssertionException("Unable to read write-ahead log '%s': %s" % (self.path, e))
+        for line_number, line in enumerate(lines, 1):
+            try:
+                content = json.loads(line)
+            except ValueError:
+                if line_number == len(lines):
+                    # the last line was cut short by the crash, and so was never acted on
+                    break
+                raise AssertionException("Line %d of write-ahead log '%s' is not valid" % (line_number, self.path))
+            if line_number == 1:
+                if content.get('version') != WAL_VERSION or content.get('org_id') != self.org_id:
+                    raise AssertionException("Write-ahead log '%s' was written for a different org or version" %
+                                             self.path)
+            elif 'seq' in content:
+                planned[content.pop('seq')] = content
+            elif 'sent' in content:
+                sent.update(content['sent'])
+            elif 'ack' in content:
+                planned.pop(content['ack'], None)
+            elif content.get('complete'):
+                complete = True
+        pending = [planned[seq] for seq in sorted(planned)]
+        self.logger.info('Write-ahead log %s has %d unanswered actions (%d of them sent)%s', self.path,
+                         len(pending), len(sent.intersection(planned)), '' if complete else
+                         ', and the run that wrote it did not finish planning')
+        return pending, complete
+
+    def open(self):
+        """
+        Start a new log, replacing any left by the last run.
+        """
+        if os.path.isfile(self.path):
+            self.logger.warning('Replacing the write-ahead log of an unfinished run: %s', self.path)
+        try:
+            self.file = open(self.path, 'w')
+        except (IOError, OSError) as e:
+            raise AssertionException("Unable to write write-ahead log '%s': %s" % (self.path, e))
+        self.write({'version': WAL_VERSION, 'org_id': self.org_id})
+        self.sync()
+
+    def write(self, content):
+        self.file.write(json.dumps(content, separators=(',', ':')))
+        self.file.write('\n')
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def add(self, content):
+        """
+        :type content: dict a plan entry
+        :rtype: int the sequence number of the action
+        """
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            entry = dict(content)
+            entry['seq'] = seq
+            self.write(entry)
+            return seq
+
+    def add_commands(self, commands):
+        """
+        :type commands: user_sync.connector.connector_umapi.Commands
+        :rtype: int
+        """
+        return self.add(commands.to_dict())
+
+    def add_group(self, group_name):
+        """
+        :type group_name: str
+        :rtype: int
+        """
+        return self.add({'create_group': group_name})
+
+    def mark_sent(self, seqs):
+        """
+        Note that a batch is about to be sent, and make sure it and every action before it are on disk.
+        :type seqs: list(int)
+        """
+        with self.lock:
+            if seqs:
+                self.write({'sent': seqs})
+            self.sync()
+
+    def track(self, seq, callback=None):
+        """
+        Wrap the callback for one part of an action (an action's commands may be sent in several parts),
+        so the action is marked answered once all its parts have been.
+        :type seq: int
+        :type callback: callable(dict)
+        :rtype: callable(dict)
+        """
+        with self.lock:
+            self.outstanding.setdefault(seq, [0, True])[0] += 1
+
+        def ack_and_call(result):
+            with self.lock:
+                state = self.outstanding[seq]
+                state[0] -= 1
+                state[1] = state[1] and result['is_success']
+                if state[0] == 0:
+                    del self.outstanding[seq]
+                    self.write({'ack': seq, 'success': state[1]})
+            if callable(callback):
+                callback(result)
+
+        return ack_and_call
+
+    def ack(self, seq, is_success):
+        """
+        Mark an action as answered (or as never to be sent).
+        :type seq: int
+        :type is_success: bool
+        """
+        with self.lock:
+            self.write({'ack': seq, 'success': is_success})
+
+    def mark_complete(self):
+        with self.lock:
+            if not self.complete:
+                self.complete = True
+                self.write({'complete': True})
+                self.sync()
+
+    def close(self):
+        """
+        Close the log, and remove it if every action of the run was answered.
+        """
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+            if self.complete and not self.outstanding:
+                os.remove(self.path)
+
+
+def resume_actions(umapi_connectors, logger):
+    """
+    Start the write-ahead log of each connector, first sending the actions that the last run logged
+    but didn't see answered.
+    :type umapi_connectors: user_sync.engine.umapi.UmapiConnectors
+    :type logger: logging.Logger
+    :rtype: bool whether the last run logged all of its actions, so there's nothing more to do
+    """
+    all_complete = True
+    pending_by_connector = []
+    for connector in umapi_connectors.connectors:
+        if connector.write_ahead_log is None:
+            raise AssertionException('Cannot resume: %s has no write_ahead_log configured' % connector.name)
+        pending, complete = connector.write_ahead_log.read_pending()
+        all_complete = all_complete and complete
+        pending_by_connector.append((connector, pending or []))
+    # replay the secondary orgs first, and send each org's actions before moving on, as the engine does,
+    # in case the primary org's actions delete user accounts
+    primary_connector = umapi_connectors.get_primary_connector()
+    pending_by_connector.sort(key=lambda connector_pending: connector_pending[0] is primary_connector)
+    for connector, pending in pending_by_connector:
+        connector.write_ahead_log.open()
+        for content in pending:
+            try:
+                connector.send_plan_entry(content)
+            except (KeyError, TypeError, ValueError) as e:
+                raise AssertionException("Write-ahead log '%s' has bad commands: %s" %
+                                         (connector.write_ahead_log.path, e))
+        # send what we've resumed now, without marking the new log complete
+        connector.get_action_manager().flush()
+    if all_complete:
+        logger.info('Resumed all the unfinished actions of the last run')
+    else:
+        logger.info('The last run did not finish planning its actions, so a full sync is needed')
+    return all_complete
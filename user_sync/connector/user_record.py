@@ -0,0 +1,200 @@
+# Copyright (c) 2016-2020 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+from collections.abc import MutableMapping
+
+from user_sync.helper import normalize_string
+
+
+class UserRecord(MutableMapping):
+    """
+    A user record that behaves like a dict, but keeps its well-known attributes in slots.
+    A dict per user costs several hundred bytes more than a slotted object, which adds up
+    when we hold hundreds of thousands of users.  Keys that aren't well-known fields are
+    kept in an overflow dict, which is only created when needed.  A field that has never
+    been set is missing, just as it would be from a dict.
+    Subclasses list their fields in __slots__.
+    The normalized forms of the fields that we compare users on are computed when first
+    needed (normally when the user's key is made, as the user is read) and kept until one
+    of those fields is changed.
+    """
+
+    __slots__ = ('_extra', '_normalized')
+
+    # fields whose values repeat across many users (e.g. domain or country), and are worth interning
+    interned_fields = frozenset()
+
+    # fields whose normalized values are kept
+    normalized_fields = ('email', 'username', 'domain')
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self._normalized = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.__slots__:
+            if key in self.interned_fields and type(value) is str:
+                value = sys.intern(value)
+            if key in self.normalized_fields:
+                self._normalized = None
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.__slots__:
+            if key in self.normalized_fields:
+                self._normalized = None
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self.__slots__:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self, key, default=None):
+        if key in self.__slots__:
+            return getattr(self, key, default)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    def get_normalized(self, key):
+        """
+        The normalized value of one of the normalized_fields (see normalized_value)
+        :type key: str
+        """
+        normalized = self._normalized
+        if normalized is None:
+            normalized = self._normalized = tuple(normalize_field(field, self.get(field))
+                                                  for field in self.normalized_fields)
+        return normalized[self.normalized_fields.index(key)]
+
+    def copy(self):
+        """
+        A shallow copy, like dict.copy()
+        """
+        return type(self)(self)
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class DirectoryUser(UserRecord):
+    """
+    A user read from a directory connector
+    """
+    __slots__ = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+                 'uid', 'member_groups', 'source_attributes')
+
+    interned_fields = frozenset(['identity_type', 'domain', 'country'])
+
+
+class UmapiUser(UserRecord):
+    """
+    A user read from a UMAPI organization
+    """
+    __slots__ = ('email', 'status', 'username', 'domain', 'firstname', 'lastname', 'country', 'type', 'groups')
+
+    interned_fields = frozenset(['status', 'domain', 'country', 'type'])
+
+    normalized_fields = ('email', 'username', 'domain', 'groups')
+
+    # the fields the sync engine reads, which are all that a lean record keeps
+    lean_fields = ('email', 'username', 'domain', 'firstname', 'lastname', 'country', 'type', 'groups')
+
+    @classmethod
+    def create_lean(cls, user):
+        """
+        A record of just the lean_fields of a user, leaving out everything else the server sent
+        :type user: dict
+        """
+        record = cls()
+        for key in cls.lean_fields:
+            if key in user:
+                record[key] = user[key]
+        return record
+
+    def __setitem__(self, key, value):
+        if key == 'groups' and value is not None:
+            # group names repeat across many users, so share one copy of each
+            value = [sys.intern(g) if type(g) is str else g for g in value]
+        super(UmapiUser, self).__setitem__(key, value)
+
+
+def normalize_field(key, value):
+    """
+    Normalize the value of a user field: a string is stripped and lowercased, and a list of groups
+    becomes a frozenset of normalized group names.  Normalized strings that are unchanged are
+    returned as is, so they don't take up any more memory.
+    :type key: str
+    """
+    if key == 'groups':
+        return frozenset(normalize_string(group) for group in value or ())
+    normalized = normalize_string(value)
+    return value if normalized == value else normalized
+
+
+def normalized_value(user, key):
+    """
+    The normalized value of a user field.  A UserRecord keeps the normalized values of its
+    normalized_fields, so they are only computed once; a user dict is normalized every time.
+    :type user: dict
+    :type key: str
+    """
+    if isinstance(user, UserRecord):
+        return user.get_normalized(key)
+    return normalize_field(key, user.get(key))
@@ -1,3 +1,12 @@
+import re
+from collections import namedtuple
+
+import six
+
+import user_sync.error
+import user_sync.identity_type
+from user_sync.helper import normalize_string
+
 GROUP_NAME_DELIMITER = '::'
 PRIMARY_TARGET_NAME = None
 
@@ -73,3 +82,254 @@ class AdobeGroup:
     @classmethod
     def iter_groups(cls):
         return cls.index_map.values()
+
+
+class UserKey(namedtuple('UserKey', ['id_type', 'username', 'domain'])):
+    """
+    The identity of a user: identity type, normalized username, and domain.
+    The domain part is empty if the username is an email address.
+    Keys are interned, so every structure that refers to a user shares one key object.
+    The string form is "id_type,username,domain", which is what we log and write to files.
+    """
+    __slots__ = ()
+
+    index_map = {}
+
+    # identity types as we normally get them, which don't need to be parsed again
+    known_id_types = frozenset([user_sync.identity_type.ADOBEID_IDENTITY_TYPE,
+                                user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
+                                user_sync.identity_type.FEDERATED_IDENTITY_TYPE])
+
+    def __str__(self):
+        return self.id_type + ',' + self.username + ',' + self.domain
+
+    def __repr__(self):
+        return repr(str(self))
+
+    @classmethod
+    def create(cls, id_type, username, domain, email=None, intern=True, normalized=False):
+        """
+        Construct the user key for a directory or adobe user.
+        If the parameters are invalid, None is returned.
+        :param id_type: (required) id_type of the user
+        :param username: (required) username of the user, can be his email
+        :param domain: (optional) domain of the user
+        :param email: (optional) email of the user
+        :param intern: (optional) whether to return the shared copy of the key
+        :param normalized: (optional) whether username, domain and email are already normalized
+        :rtype: UserKey
+        """
+        if id_type not in cls.known_id_types:
+            id_type = user_sync.identity_type.parse_identity_type(id_type)
+        if not normalized:
+            email = normalize_string(email) if email else None
+            username = normalize_string(username)
+            domain = normalize_string(domain)
+        username = username or email
+
+        if not id_type:
+            return None
+        if not username:
+            return None
+        if username.find('@') >= 0:
+            domain = ""
+        elif not domain:
+            return None
+        key = cls(id_type, username, domain)
+        return cls.index_map.setdefault(key, key) if intern else key
+
+
+class AdditionalGroupMatcher:
+    """
+    Resolves the directory groups a user is a member of to adobe groups, using the additional_groups rules.
+    Each rule is a dict with a 'source' regular expression and a 'target' AdobeGroup, whose name is the
+    substitution applied to a matching group name.  Every rule that matches a group applies to it.
+    When it can, the matcher combines the source patterns into a single alternation, so a group that
+    no rule matches is rejected with one regex call rather than one per rule.
+    """
+
+    # patterns that refer to their own groups by number can't be combined with other patterns
+    self_reference_pattern = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def __init__(self, rules):
+        """
+        :type rules: list(dict)
+        """
+        self.rules = rules
+        self.prefilter = self.compile_prefilter(rules)
+
+    @classmethod
+    def compile_prefilter(cls, rules):
+        if len(rules) < 2:
+            return None
+        sources = [rule['source'] for rule in rules]
+        flags = set(source.flags for source in sources)
+        if len(flags) > 1 or any(cls.self_reference_pattern.search(source.pattern) for source in sources):
+            return None
+        try:
+            return re.compile('|'.join('(?:%s)' % source.pattern for source in sources), flags.pop())
+        except re.error:
+            return None
+
+    def resolve(self, member_group):
+        """
+        :type member_group: str
+        :return: list of (umapi name, adobe group name) for each rule that matches the group
+        :rtype: list(tuple(str, str))
+        """
+        if self.prefilter is not None and not self.prefilter.match(member_group):
+            return []
+        targets = []
+        for rule in self.rules:
+            source = rule['source']
+            if not source.match(member_group):
+                continue
+            target = rule['target']
+            try:
+                rename_group = source.sub(target.get_group_name(), member_group)
+            except Exception as e:
+                raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
+            targets.append((target.get_umapi_name(), rename_group))
+        return targets
+
+
+class AdobeUserExclusions:
+    """
+    Decides which primary-org Adobe users are excluded from updates, and counts how many users each
+    exclusion rule catches.  Identity types and groups are checked first, since they are cheap.
+    The exclude_users patterns (compiled with \\A and \\Z markers, and case-insensitive) are
+    checked as exact usernames or "anything at a domain" suffixes when they are that simple,
+    and otherwise with one combined pattern whose matching alternative identifies the rule.
+    """
+
+    regex_special_characters = frozenset('.^$*+?{}[]\\|()')
+
+    def __init__(self, identity_types, groups, user_patterns):
+        """
+        :type identity_types: list(str)
+        :type groups: set(str) normalized group names
+        :type user_patterns: list(re.Pattern)
+        """
+        self.identity_types = frozenset(identity_types)
+        self.groups = groups
+        self.user_patterns = user_patterns
+        self.hit_counts = {}
+        self.rules = ['exclude_identity_types: ' + t for t in identity_types]
+        self.rules.extend('exclude_adobe_groups: ' + g for g in sorted(groups))
+        # exact usernames and domain suffixes, mapped to their rule
+        self.exact_usernames = {}
+        self.suffixes = {}
+        # (rule, pattern) for patterns that need a regex match
+        self.regex_rules = []
+        for pattern in user_patterns:
+            source = pattern.pattern
+            if source.startswith(r'\A') and source.endswith(r'\Z'):
+                source = source[2:-2]
+            rule = 'exclude_users: ' + source
+            self.rules.append(rule)
+            literal = self.literal_value(source)
+            if literal is not None:
+                self.exact_usernames.setdefault(literal.lower(), rule)
+                continue
+            if source.startswith('.*'):
+                literal = self.literal_value(source[2:])
+                if literal:
+                    self.suffixes.setdefault(literal.lower(), rule)
+                    continue
+            self.regex_rules.append((rule, pattern))
+        self.suffix_tuple = tuple(self.suffixes)
+        self.combined_pattern, self.rule_by_group_name = self.combine_patterns(self.regex_rules)
+
+    @classmethod
+    def literal_value(cls, source):
+        """
+        If the regular expression only matches one string, return that string, else None.
+        :type source: str
+        :rtype: str
+        """
+        chars = []
+        escaped = False
+        for c in source:
+            if escaped:
+                if c.isalnum():
+                    # character classes like \\d, or other special escapes
+                    return None
+                chars.append(c)
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c in cls.regex_special_characters:
+                return None
+            else:
+                chars.append(c)
+        return None if escaped else ''.join(chars)
+
+    @staticmethod
+    def combine_patterns(regex_rules):
+        if len(regex_rules) < 2:
+            return None, None
+        sources = [pattern.pattern for _, pattern in regex_rules]
+        flags = set(pattern.flags for _, pattern in regex_rules)
+        if len(flags) > 1 or any(AdditionalGroupMatcher.self_reference_pattern.search(s) for s in sources):
+            return None, None
+        rule_by_group_name = {}
+        alternatives = []
+        for i, (rule, _) in enumerate(regex_rules):
+            name = '_exclude_%d' % i
+            rule_by_group_name[name] = rule
+            alternatives.append('(?P<%s>%s)' % (name, sources[i]))
+        try:
+            return re.compile('|'.join(alternatives), flags.pop()), rule_by_group_name
+        except re.error:
+            return None, None
+
+    def match(self, identity_type, username, groups):
+        """
+        Find the rule that excludes a user, if any, and count the hit.
+        :type identity_type: str
+        :type username: str normalized username
+        :type groups: set(str) normalized group names
+        :return: the kind of rule that matched ('type', 'group' or 'name'), or None
+        :rtype: str
+        """
+        if identity_type in self.identity_types:
+            self.count('exclude_identity_types: ' + identity_type)
+            return 'type'
+        excluded_groups = groups & self.groups
+        if excluded_groups:
+            for group in excluded_groups:
+                self.count('exclude_adobe_groups: ' + group)
+            return 'group'
+        rule = self.match_username(username)
+        if rule is not None:
+            self.count(rule)
+            return 'name'
+        return None
+
+    def match_username(self, username):
+        lower_username = username.lower()
+        rule = self.exact_usernames.get(lower_username)
+        if rule is not None:
+            return rule
+        if self.suffix_tuple and lower_username.endswith(self.suffix_tuple):
+            for suffix, rule in six.iteritems(self.suffixes):
+                if lower_username.endswith(suffix):
+                    return rule
+        if self.combined_pattern is not None:
+            m = self.combined_pattern.match(username)
+            return self.rule_by_group_name[m.lastgroup] if m else None
+        for rule, pattern in self.regex_rules:
+            if pattern.match(username):
+                return rule
+        return None
+
+    def count(self, rule):
+        self.hit_counts[rule] = self.hit_counts.get(rule, 0) + 1
+
+    def get_hit_counts(self):
+        """
+        :return: (rule, count) for every rule, in configuration order
+        :rtype: list(tuple(str, int))
+        """
+        return [(rule, self.hit_counts.get(rule, 0)) for rule in self.rules]
+
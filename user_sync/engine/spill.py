@@ -0,0 +1,101 @@
+import heapq
+import pickle
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+
+class SortedSpill(object):
+    """
+    Collects (key, value) records and gives them back sorted by key, while holding at most
+    run_size records in memory.  Whenever the buffer fills up, it is sorted and written to a
+    temporary file as a "run"; reading merges the runs.  Records with equal keys come back
+    in the order they were added.  Keys must be orderable, and values must be picklable.
+    """
+
+    sort_key = itemgetter(0, 1)
+
+    def __init__(self, run_size, name='spill'):
+        """
+        :type run_size: int
+        :type name: str used in the names of the temporary files
+        """
+        self.run_size = run_size
+        self.name = name
+        self.buffer = []
+        self.run_files = []
+        self.count = 0
+
+    def add(self, key, value):
+        # the sequence number keeps equal keys in order, and means values are never compared
+        self.buffer.append((key, self.count, value))
+        self.count += 1
+        if len(self.buffer) >= self.run_size:
+            self.write_run()
+
+    def write_run(self):
+        self.buffer.sort(key=self.sort_key)
+        run_file = tempfile.TemporaryFile(prefix='user-sync-' + self.name + '-')
+        for record in self.buffer:
+            pickle.dump(record, run_file, pickle.HIGHEST_PROTOCOL)
+        self.run_files.append(run_file)
+        self.buffer = []
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+        Yield the (key, value) records in key order.
+        """
+        self.buffer.sort(key=self.sort_key)
+        runs = [self.read_run(run_file) for run_file in self.run_files]
+        runs.append(iter(self.buffer))
+        # the sequence numbers are unique, so the records are ordered without comparing values
+        for key, _, value in heapq.merge(*runs):
+            yield key, value
+
+    @staticmethod
+    def read_run(run_file):
+        run_file.seek(0)
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
+
+    def close(self):
+        for run_file in self.run_files:
+            run_file.close()
+        self.run_files = []
+        self.buffer = []
+
+
+def merge_join(left, right):
+    """
+    Join two streams of (key, value) records that are sorted by key.  For each distinct key,
+    yield (key, left_values, right_values), where either list of values may be empty.
+    :type left: iterable(tuple)
+    :type right: iterable(tuple)
+    """
+    left_groups = groupby(left, key=itemgetter(0))
+    right_groups = groupby(right, key=itemgetter(0))
+    left_key, left_values = next_group(left_groups)
+    right_key, right_values = next_group(right_groups)
+    while left_values is not None or right_values is not None:
+        if right_values is None or (left_values is not None and left_key < right_key):
+            yield left_key, left_values, []
+            left_key, left_values = next_group(left_groups)
+        elif left_values is None or right_key < left_key:
+            yield right_key, [], right_values
+            right_key, right_values = next_group(right_groups)
+        else:
+            yield left_key, left_values, right_values
+            left_key, left_values = next_group(left_groups)
+            right_key, right_values = next_group(right_groups)
+
+
+def next_group(groups):
+    for key, records in groups:
+        return key, [value for _, value in records]
+    return None, None
@@ -0,0 +1,269 @@
+import atexit
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+import six
+from six.moves.collections_abc import MutableMapping
+
+import user_sync.error
+from .common import UserKey
+
+
+class UserStoreDatabase(object):
+    """
+    A scratch sqlite database that holds the user stores that grew too large for memory.
+    It is only needed for the length of a run, so it is written without journaling or syncing,
+    never committed, and removed when it's closed.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :type directory: str where to put the database file (the system temporary directory if None)
+        """
+        self.directory = directory
+        self.path = None
+        self.connection = None
+        self.table_count = 0
+        self.lock = threading.RLock()
+
+    def create_table(self, name):
+        """
+        :type name: str
+        :rtype: str the name of the new table
+        """
+        with self.lock:
+            if self.connection is None:
+                self.open()
+            self.table_count += 1
+            table = 'store_%d' % self.table_count
+            self.connection.execute('CREATE TABLE %s (key TEXT PRIMARY KEY, value BLOB)' % table)
+            return table
+
+    def open(self):
+        try:
+            fd, self.path = tempfile.mkstemp(prefix='user-sync-', suffix='.db', dir=self.directory)
+            os.close(fd)
+            # the connection is shared by the threads that sync secondary umapis, under our lock
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode = OFF')
+            self.connection.execute('PRAGMA synchronous = OFF')
+            # don't leave the file behind if the run fails
+            atexit.register(self.close)
+        except (OSError, sqlite3.Error) as e:
+            raise user_sync.error.AssertionException('Unable to create user store database in %s: %s' %
+                                                     (self.directory or tempfile.gettempdir(), e))
+
+    def execute(self, statement, parameters=()):
+        return self.connection.execute(statement, parameters)
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            if self.path is not None:
+                os.remove(self.path)
+                self.path = None
+
+
+class UserStore(MutableMapping):
+    """
+    A map from user keys (or email addresses) to users, or other per-user values.  It is a dict until it
+    holds more than max_memory_users entries; then its entries move to a table in the store database,
+    with the cache_size most recently used ones kept in memory.
+    As with a dict, values can be changed in place: a changed value is written back when it leaves the
+    cache.  But two stores never share a value once it has been on disk.
+    """
+
+    # separates the parts of a user key in the database
+    key_separator = '\x1f'
+
+    def __init__(self, database, name, max_memory_users=None, cache_size=10000):
+        """
+        :type database: UserStoreDatabase
+        :type name: str used in log messages
+        :type max_memory_users: int the size at which to move to disk (None to stay in memory)
+        :type cache_size: int
+        """
+        self.database = database
+        self.name = name
+        self.max_memory_users = max_memory_users
+        self.cache_size = cache_size
+        # all the entries while in memory, then the most recently used ones (in order of use)
+        self.entries = {}
+        # the database table, once on disk, and the pickled form of values read from it
+        self.table = None
+        self.pickled_by_key = {}
+        self.cache_hits = 0
+        self.disk_reads = 0
+        self.disk_writes = 0
+
+    def is_on_disk(self):
+        return self.table is not None
+
+    def __getitem__(self, key):
+        with self.database.lock:
+            if key in self.entries:
+                if self.table is not None:
+                    self.cache_hits += 1
+                    self.entries[key] = self.entries.pop(key)
+                return self.entries[key]
+            if self.table is None:
+                raise KeyError(key)
+            row = self.database.execute('SELECT value FROM %s WHERE key = ?' % self.table,
+                                        (self.encode_key(key),)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            self.disk_reads += 1
+            value = pickle.loads(row[0])
+            self.cache(key, value, row[0])
+            return value
+
+    def __setitem__(self, key, value):
+        with self.database.lock:
+            if self.table is None:
+                self.entries[key] = value
+                if self.max_memory_users and len(self.entries) > self.max_memory_users:
+                    self.move_to_disk()
+            else:
+                self.entries.pop(key, None)
+                self.cache(key, value, None)
+
+    def __delitem__(self, key):
+        with self.database.lock:
+            if self.table is None:
+                del self.entries[key]
+                return
+            in_cache = key in self.entries
+            self.entries.pop(key, None)
+            self.pickled_by_key.pop(key, None)
+            cursor = self.database.execute('DELETE FROM %s WHERE key = ?' % self.table, (self.encode_key(key),))
+            if not in_cache and cursor.rowcount == 0:
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        with self.database.lock:
+            if key in self.entries:
+                return True
+            if self.table is None:
+                return False
+            return self.database.execute('SELECT 1 FROM %s WHERE key = ?' % self.table,
+                                         (self.encode_key(key),)).fetchone() is not None
+
+    def __iter__(self):
+        if self.table is None:
+            return iter(self.entries)
+        return self.iter_disk_keys()
+
+    def iter_disk_keys(self):
+        # keys are read in batches, so the caller can look up values (and so evict them) as we go
+        self.flush()
+        last_rowid = 0
+        while True:
+            with self.database.lock:
+                rows = self.database.execute('SELECT rowid, key FROM %s WHERE rowid > ? ORDER BY rowid LIMIT 1000' %
+                                             self.table, (last_rowid,)).fetchall()
+            if not rows:
+                return
+            for last_rowid, key in rows:
+                yield self.decode_key(key)
+
+    def __len__(self):
+        with self.database.lock:
+            if self.table is None:
+                return len(self.entries)
+            self.flush()
+            return self.database.execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def cache(self, key, value, pickled):
+        self.entries[key] = value
+        if pickled is not None:
+            self.pickled_by_key[key] = pickled
+        while len(self.entries) > self.cache_size:
+            key, value = self.entries.popitem(last=False)
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            # values that haven't changed since they were read don't need writing
+            if self.pickled_by_key.pop(key, None) != pickled:
+                self.write(key, pickled)
+
+    def write(self, key, pickled):
+        self.disk_writes += 1
+        encoded_key = self.encode_key(key)
+        # update in place, rather than replace, so the row keeps its place in iteration order
+        cursor = self.database.execute('UPDATE %s SET value = ? WHERE key = ?' % self.table, (pickled, encoded_key))
+        if cursor.rowcount == 0:
+            self.database.execute('INSERT INTO %s (key, value) VALUES (?, ?)' % self.table, (encoded_key, pickled))
+
+    def flush(self):
+        """
+        Write every value in the cache, so the table is complete.  The values stay cached.
+        """
+        with self.database.lock:
+            for key, value in six.iteritems(self.entries):
+                pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                if self.pickled_by_key.get(key) != pickled:
+                    self.write(key, pickled)
+                    self.pickled_by_key[key] = pickled
+
+    def move_to_disk(self):
+        self.table = self.database.create_table(self.name)
+        entries, self.entries = self.entries, OrderedDict()
+        for key, value in six.iteritems(entries):
+            self.write(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.disk_writes = 0
+
+    def encode_key(self, key):
+        if isinstance(key, UserKey):
+            return self.key_separator.join(key)
+        return key
+
+    def decode_key(self, encoded_key):
+        if self.key_separator in encoded_key:
+            return UserKey(*encoded_key.split(self.key_separator))
+        return encoded_key
+
+    def describe(self):
+        if self.table is None:
+            return '%s: %d entries in memory' % (self.name, len(self.entries))
+        return '%s: %d entries on disk, %d cache hits, %d disk reads, %d disk writes' % (
+            self.name, len(self), self.cache_hits, self.disk_reads, self.disk_writes)
+
+
+class UserStoreFactory(object):
+    """
+    Makes the user stores for a run, which share one database.
+    """
+
+    def __init__(self, max_memory_users=None, cache_size=10000, directory=None):
+        """
+        :type max_memory_users: int (None to keep every store in memory)
+        :type cache_size: int
+        :type directory: str
+        """
+        self.max_memory_users = max_memory_users
+        self.cache_size = cache_size
+        self.database = UserStoreDatabase(directory)
+        self.stores = []
+
+    def create(self, name):
+        """
+        :type name: str
+        :rtype: MutableMapping
+        """
+        if not self.max_memory_users:
+            return {}
+        store = UserStore(self.database, name, self.max_memory_users, self.cache_size)
+        self.stores.append(store)
+        return store
+
+    def log_statistics(self, logger):
+        for store in self.stores:
+            if store.is_on_disk():
+                logger.debug('User store %s', store.describe())
+
+    def close(self):
+        self.database.close()
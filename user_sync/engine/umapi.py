@@ -20,16 +20,22 @@
 # SOFTWARE.
 
 import logging
+import marshal
 import six
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from itertools import chain
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import user_sync.connector.connector_umapi
 import user_sync.error
 import user_sync.identity_type
-from user_sync.helper import normalize_string, CSVAdapter, JobStats
+from user_sync.connector.user_record import normalized_value
+from user_sync.helper import normalize_string, BackgroundIterator, CSVAdapter, JobStats
 
-from .common import AdobeGroup, PRIMARY_TARGET_NAME
+from .common import AdditionalGroupMatcher, AdobeGroup, AdobeUserExclusions, UserKey, PRIMARY_TARGET_NAME
+from .spill import SortedSpill, merge_join
+from .store import UserStoreFactory
 
 
 class RuleProcessor(object):
@@ -38,8 +44,13 @@ class RuleProcessor(object):
     default_options = {
         'adobe_group_filter': None,
         'after_mapping_hook': None,
+        'after_mapping_hook_batch_size': 1000,
+        'after_mapping_hook_processes': 1,
+        'batch_after_mapping_hook': None,
         'default_country_code': None,
         'delete_strays': False,
+        'diff_engine': 'memory',
+        'diff_run_size': 100000,
         'directory_group_filter': None,
         'disentitle_strays': False,
         'exclude_groups': [],
@@ -51,12 +62,17 @@ class RuleProcessor(object):
         'process_groups': False,
         'max_adobe_only_users': 200,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
+        'prefetch_umapi_users': False,
         'remove_strays': False,
+        'secondary_org_workers': 1,
         'strategy': 'sync',
         'stray_list_input_path': None,
         'stray_list_output_path': None,
         'test_mode': False,
         'update_user_info': False,
+        'user_store_cache_size': 10000,
+        'user_store_directory': None,
+        'user_store_max_memory_users': None,
         'username_filter_regex': None,
     }
 
@@ -67,10 +83,17 @@ class RuleProcessor(object):
         options = dict(self.default_options)
         options.update(caller_options)
         self.options = options
-        self.directory_user_by_user_key = {}
-        self.filtered_directory_user_by_user_key = {}
+        # the large maps of users are moved to disk if they grow past the configured size
+        self.user_stores = UserStoreFactory(options['user_store_max_memory_users'], options['user_store_cache_size'],
+                                            options['user_store_directory'])
+        self.directory_user_by_user_key = self.user_stores.create('directory_users')
+        # only the keys of the selected users: a store on disk holds its own copy of each value,
+        # so keeping the users here too would leave two copies that can drift apart
+        self.selected_directory_user_keys = self.user_stores.create('selected_directory_user_keys')
         self.umapi_info_by_name = {}
-        self.adobeid_user_by_email = {}
+        self.adobeid_user_by_email = self.user_stores.create('adobeid_users')
+        # umapi users being read in the background while the directory loads, by umapi name
+        self.prefetched_umapi_users = {}
         # counters for action summary log
         self.action_summary = {
             # these are in alphabetical order!  Always add new ones that way!
@@ -91,6 +114,8 @@ class RuleProcessor(object):
         self.exclude_groups = self.normalize_groups(options['exclude_groups'])
         self.exclude_identity_types = options['exclude_identity_types']
         self.exclude_users = options['exclude_users']
+        self.adobe_user_exclusions = AdobeUserExclusions(self.exclude_identity_types, self.exclude_groups,
+                                                         self.exclude_users)
 
         # There's a big difference between how we handle the primary umapi,
         # and how we handle secondary umapis.  We care about all the (non-excluded)
@@ -105,13 +130,25 @@ class RuleProcessor(object):
         # out which existing users were created in the secondaries only.  Finally,
         # we keep track of user keys that we have updated in any umapi, so that
         # we can correctly report their count.
+        # Secondary umapis may be processed concurrently, once the primary is done, so
+        # the counters, sets and maps that they update are guarded by a lock, and each
+        # of them works on its own copy of a directory user it needs to change.
         self.primary_user_count = 0
         self.included_user_keys = set()
         self.excluded_user_count = 0
+        self.counter_lock = threading.Lock()
         self.primary_users_created = set()
         self.secondary_users_created = set()
         self.updated_user_keys = set()
 
+        # with the merge diff engine, directory users are spilled (with their desired primary groups)
+        # to sorted runs on disk as they are mapped, rather than kept in the maps of users.  Keys are
+        # not interned, since that would keep one for every user.
+        self.directory_spill = None
+        self.directory_user_count = 0
+        self.selected_directory_user_count = 0
+        self.intern_user_keys = not self.will_merge_diff()
+
         # stray key input path comes in, stray_list_output_path goes out
         self.stray_key_map = {}
         if options['stray_list_input_path']:
@@ -152,9 +189,30 @@ class RuleProcessor(object):
             'hook_storage': None,
         }
 
+        # in/out variables for batch after-mapping-hook code
+        self.batch_after_mapping_hook_scope = {
+            # in: list of mapped users, each a dict with the same source_attributes, source_groups,
+            # target_attributes and target_groups entries as the per-user hook scope
+            # out: the same list, with the target entries of each user potentially changed by hook code
+            'users': None,
+            # make logging available to hook code
+            'logger': logger,
+            # for exclusive use by hook code; persists across calls
+            'hook_storage': None,
+        }
+
+        # additional group rules, and the adobe groups they resolve each directory group to
+        self.additional_group_matcher = AdditionalGroupMatcher(options.get('additional_groups') or [])
+        self.additional_group_targets = {}
+
+        # worker processes for the per-user after-mapping-hook, if it runs in parallel
+        self.hook_pool = None
+        self.marshaled_hook = None
+        self.pending_hook_chunks = None
+
         # map of username to email address for users that have an email-type username that
         # differs from the user's email address
-        self.email_override = {}  # type: dict[str, str]
+        self.email_override = self.user_stores.create('email_overrides')  # type: dict[str, str]
 
         if logger.isEnabledFor(logging.DEBUG):
             options_to_report = options.copy()
@@ -172,30 +230,92 @@ class RuleProcessor(object):
         """
         logger = self.logger
 
-        self.prepare_umapi_infos()
-
-        if directory_connector is not None:
-            load_directory_stats = JobStats("Load from Directory", divider="-")
-            load_directory_stats.log_start(logger)
-            self.read_desired_user_groups(directory_groups, directory_connector)
-            load_directory_stats.log_end(logger)
-
-        for umapi_info in self.umapi_info_by_name.values():
-            self.validate_and_log_additional_groups(umapi_info)
-
-        umapi_stats = JobStats('Push to UMAPI' if self.push_umapi else 'Sync with UMAPI', divider="-")
-        umapi_stats.log_start(logger)
-        if directory_connector is not None:
-            # note: push mode is not supported because if it is, we won't have a list of groups
-            # that exist in the console.  we don't want to attempt to create groups that already exist
-            if self.options.get('process_groups') and not self.push_umapi and self.options.get('auto_create'):
-                self.create_umapi_groups(umapi_connectors)
-            self.sync_umapi_users(umapi_connectors)
-        if self.will_process_strays:
-            self.process_strays(umapi_connectors)
-        umapi_connectors.execute_actions()
-        umapi_stats.log_end(logger)
-        self.log_action_summary(umapi_connectors)
+        try:
+            self.prepare_umapi_infos()
+            if self.will_merge_diff():
+                self.validate_merge_diff(umapi_connectors)
+
+            if directory_connector is not None and self.will_run_hook_in_pool():
+                # the workers are forked before the prefetch threads start, so they can't
+                # inherit a lock that one of those threads holds
+                self.start_after_mapping_hook_pool()
+            if directory_connector is not None and self.will_prefetch_umapi_users():
+                self.start_umapi_user_prefetch(umapi_connectors)
+            if directory_connector is not None:
+                load_directory_stats = JobStats("Load from Directory", divider="-")
+                load_directory_stats.log_start(logger)
+                self.read_desired_user_groups(directory_groups, directory_connector)
+                load_directory_stats.log_end(logger)
+
+            for umapi_info in self.umapi_info_by_name.values():
+                self.validate_and_log_additional_groups(umapi_info)
+
+            umapi_stats = JobStats('Push to UMAPI' if self.push_umapi else 'Sync with UMAPI', divider="-")
+            umapi_stats.log_start(logger)
+            if directory_connector is not None:
+                # note: push mode is not supported because if it is, we won't have a list of groups
+                # that exist in the console.  we don't want to attempt to create groups that already exist
+                if self.options.get('process_groups') and not self.push_umapi and self.options.get('auto_create'):
+                    self.create_umapi_groups(umapi_connectors)
+                self.sync_umapi_users(umapi_connectors)
+                self.stop_umapi_user_prefetch()
+            if self.will_process_strays:
+                self.process_strays(umapi_connectors)
+            umapi_connectors.execute_actions()
+            umapi_connectors.save_snapshots()
+            umapi_stats.log_end(logger)
+            self.log_action_summary(umapi_connectors)
+            self.user_stores.log_statistics(logger)
+        finally:
+            # if the run fails part way, don't leave the background reads paging the umapis,
+            # or the users we set aside on disk
+            self.stop_umapi_user_prefetch()
+            self.close_after_mapping_hook_pool()
+            if self.directory_spill is not None:
+                self.directory_spill.close()
+                self.directory_spill = None
+            self.user_stores.close()
+
+    def validate_merge_diff(self, umapi_connectors):
+        """
+        The merge diff engine only handles the primary umapi, read in full, in sync mode.
+        :type umapi_connectors: UmapiConnectors
+        """
+        if self.push_umapi:
+            problem = 'the push strategy'
+        elif self.options['adobe_group_filter'] is not None:
+            problem = 'an Adobe group filter'
+        elif umapi_connectors.get_secondary_connectors():
+            problem = 'secondary umapi connectors'
+        else:
+            return
+        raise user_sync.error.AssertionException('The merge diff engine cannot be used with ' + problem)
+
+    def will_prefetch_umapi_users(self):
+        # the adobe group filter reads users group by group, so there's nothing to prefetch
+        return (self.options['prefetch_umapi_users'] and not self.push_umapi and
+                self.options['adobe_group_filter'] is None)
+
+    def start_umapi_user_prefetch(self, umapi_connectors):
+        """
+        Start reading the users of each umapi we are going to sync in the background,
+        so the umapi reads overlap with the directory load.  Secondary umapis are only
+        read if they already have mapped groups.
+        :type umapi_connectors: UmapiConnectors
+        """
+        connectors = [(PRIMARY_TARGET_NAME, umapi_connectors.get_primary_connector())]
+        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+            if len(self.get_umapi_info(umapi_name).get_mapped_groups()) > 0:
+                connectors.append((umapi_name, umapi_connector))
+        for umapi_name, umapi_connector in connectors:
+            self.logger.debug('Prefetching users from %s', umapi_connector.name)
+            self.prefetched_umapi_users[umapi_name] = BackgroundIterator(umapi_connector.iter_users(),
+                                                                         name='prefetch-' + umapi_connector.name)
+
+    def stop_umapi_user_prefetch(self):
+        for umapi_users in six.itervalues(self.prefetched_umapi_users):
+            umapi_users.stop()
+        self.prefetched_umapi_users = {}
 
     def validate_and_log_additional_groups(self, umapi_info):
         """
@@ -220,8 +340,12 @@ class RuleProcessor(object):
         """
         logger = self.logger
         # find the total number of directory users and selected/filtered users
-        self.action_summary['directory_users_read'] = len(self.directory_user_by_user_key)
-        self.action_summary['directory_users_selected'] = len(self.filtered_directory_user_by_user_key)
+        if self.will_merge_diff():
+            self.action_summary['directory_users_read'] = self.directory_user_count
+            self.action_summary['directory_users_selected'] = self.selected_directory_user_count
+        else:
+            self.action_summary['directory_users_read'] = len(self.directory_user_by_user_key)
+            self.action_summary['directory_users_selected'] = len(self.selected_directory_user_keys)
         # find the total number of adobe users and excluded users
         self.action_summary['primary_users_read'] = self.primary_user_count
         self.action_summary['excluded_user_count'] = self.excluded_user_count
@@ -314,6 +438,11 @@ class RuleProcessor(object):
             sent, errors = umapi_connector.get_action_manager().get_statistics()
             description = (umapi_summary_format % (spacer, name)).rjust(pad, ' ')
             logger.info('  %s: (%s, %s, %s)', description, sent, sent - errors, errors)
+        if not self.push_umapi and self.adobe_user_exclusions.rules:
+            # rules that never match are candidates for removal from the configuration
+            logger.info('  Adobe users excluded by each exclusion rule:')
+            for rule, count in self.adobe_user_exclusions.get_hit_counts():
+                logger.info('    %s: %s', rule, count)
         logger.info('------------------------------------------------------------------------------------')
 
     def is_primary_org(self, umapi_info):
@@ -325,13 +454,18 @@ class RuleProcessor(object):
     def will_process_groups(self):
         return self.options['process_groups']
 
+    def will_merge_diff(self):
+        return self.options['diff_engine'] == 'merge'
+
     def will_exclude_unmapped_users(self):
         return self.options['exclude_unmapped_users']
 
     def get_umapi_info(self, umapi_name):
         umapi_info = self.umapi_info_by_name.get(umapi_name)
         if umapi_info is None:
-            self.umapi_info_by_name[umapi_name] = umapi_info = UmapiTargetInfo(umapi_name)
+            store_name = 'umapi_users' if umapi_name is None else 'umapi_users.' + umapi_name
+            umapi_user_store = self.user_stores.create(store_name)
+            self.umapi_info_by_name[umapi_name] = umapi_info = UmapiTargetInfo(umapi_name, umapi_user_store)
         return umapi_info
 
     def prepare_umapi_infos(self):
@@ -356,6 +490,9 @@ class RuleProcessor(object):
         extended_attributes = options.get('extended_attributes')
 
         directory_user_by_user_key = self.directory_user_by_user_key
+        merge_diff = self.will_merge_diff()
+        if merge_diff:
+            self.directory_spill = SortedSpill(options['diff_run_size'], name='directory')
 
         directory_groups = set(six.iterkeys(mappings)) if self.will_process_groups() else set()
         if directory_group_filter is not None:
@@ -364,84 +501,224 @@ class RuleProcessor(object):
                                                                     extended_attributes=extended_attributes,
                                                                     all_users=directory_group_filter is None)
 
-        for directory_user in directory_users:
-            user_key = self.get_directory_user_key(directory_user)
-            if not user_key:
-                self.logger.warning("Ignoring directory user with empty user key: %s", directory_user)
-                continue
-            directory_user_by_user_key[user_key] = directory_user
+        # with a batch hook, or a per-user hook run in worker processes, mapped users
+        # are collected into chunks that are passed to the hook together
+        batch_size = 0
+        if options['batch_after_mapping_hook'] is not None:
+            batch_size = options['after_mapping_hook_batch_size']
+        elif self.will_run_hook_in_pool():
+            batch_size = options['after_mapping_hook_batch_size']
+            if self.hook_pool is None:
+                self.start_after_mapping_hook_pool()
+        mapped_users = []
+        try:
+            for directory_user in directory_users:
+                user_key = self.get_directory_user_key(directory_user)
+                if not user_key:
+                    self.logger.warning("Ignoring directory user with empty user key: %s", directory_user)
+                    continue
+                if merge_diff:
+                    self.directory_user_count += 1
+                else:
+                    directory_user_by_user_key[user_key] = directory_user
 
-            if not self.is_directory_user_in_groups(directory_user, directory_group_filter):
-                continue
-            if not self.is_selected_user_key(user_key):
-                continue
+                if not self.is_directory_user_in_groups(directory_user, directory_group_filter) or \
+                        not self.is_selected_user_key(user_key):
+                    if merge_diff:
+                        # unselected users are spilled too, since their adobe accounts are updated from them
+                        self.directory_spill.add(user_key, (directory_user, None))
+                    continue
 
-            self.filtered_directory_user_by_user_key[user_key] = directory_user
-            self.get_umapi_info(PRIMARY_TARGET_NAME).add_desired_group_for(user_key, None)
-
-            # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
-            self.after_mapping_hook_scope['source_groups'] = set()
-            self.after_mapping_hook_scope['target_groups'] = set()
-            for group in directory_user['groups']:
-                self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
-                adobe_groups = mappings.get(group)
-                if adobe_groups is not None:
-                    for adobe_group in adobe_groups:
-                        self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
-
-            # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
-            if options['after_mapping_hook'] is not None:
-                self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
-
-                target_attributes = dict()
-                target_attributes['email'] = directory_user.get('email')
-                target_attributes['username'] = directory_user.get('username')
-                target_attributes['domain'] = directory_user.get('domain')
-                target_attributes['firstname'] = directory_user.get('firstname')
-                target_attributes['lastname'] = directory_user.get('lastname')
-                target_attributes['country'] = directory_user.get('country')
-                self.after_mapping_hook_scope['target_attributes'] = target_attributes
-
-                # invoke the customer's hook code
-                self.log_after_mapping_hook_scope(before_call=True)
-                exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
-                self.log_after_mapping_hook_scope(after_call=True)
-
-                # copy modified attributes back to the user object
-                directory_user.update(self.after_mapping_hook_scope['target_attributes'])
-
-            for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
-                target_group = AdobeGroup.lookup(target_group_qualified_name)
-                if target_group is not None:
-                    umapi_info = self.get_umapi_info(target_group.get_umapi_name())
-                    umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
-                else:
-                    self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
-
-            additional_groups = self.options.get('additional_groups', [])
-            member_groups = directory_user.get('member_groups', [])
-            for member_group in member_groups:
-                for group_rule in additional_groups:
-                    source = group_rule['source']
-                    target = group_rule['target']
-                    target_name = target.get_group_name()
-                    umapi_info = self.get_umapi_info(target.get_umapi_name())
-                    if not group_rule['source'].match(member_group):
-                        continue
-                    try:
-                        rename_group = source.sub(target_name, member_group)
-                    except Exception as e:
-                        raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
-                    umapi_info.add_mapped_group(rename_group)
-                    umapi_info.add_additional_group(rename_group, member_group)
-                    umapi_info.add_desired_group_for(user_key, rename_group)
-
-        self.logger.debug('Total directory users after filtering: %d', len(self.filtered_directory_user_by_user_key))
+                if merge_diff:
+                    self.selected_directory_user_count += 1
+                self.get_umapi_info(PRIMARY_TARGET_NAME).add_desired_group_for(user_key, None)
+
+                # the target groups will be used whether or not there's customer hook code
+                source_groups = set()
+                target_groups = set()
+                for group in directory_user['groups']:
+                    source_groups.add(group)  # this is a directory group name
+                    adobe_groups = mappings.get(group)
+                    if adobe_groups is not None:
+                        for adobe_group in adobe_groups:
+                            target_groups.add(adobe_group.get_qualified_name())
+
+                if batch_size:
+                    mapped_users.append((user_key, directory_user, source_groups, target_groups))
+                    if len(mapped_users) >= batch_size:
+                        self.process_mapped_users(mapped_users)
+                        mapped_users = []
+                    continue
+
+                # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
+                self.after_mapping_hook_scope['source_groups'] = source_groups
+                self.after_mapping_hook_scope['target_groups'] = target_groups
+                if options['after_mapping_hook'] is not None:
+                    self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
+                    self.after_mapping_hook_scope['target_attributes'] = self.get_target_attributes(directory_user)
+
+                    # invoke the customer's hook code
+                    self.log_after_mapping_hook_scope(before_call=True)
+                    exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
+                    self.log_after_mapping_hook_scope(after_call=True)
+
+                    # copy modified attributes back to the user object
+                    directory_user.update(self.after_mapping_hook_scope['target_attributes'])
+
+                self.add_desired_groups_for_user(user_key, directory_user,
+                                                 self.after_mapping_hook_scope['target_groups'])
+
+            if mapped_users:
+                self.process_mapped_users(mapped_users)
+            self.finish_after_mapping_hook_pool()
+        finally:
+            # on an error, the workers are stopped without waiting for the chunks still queued
+            self.close_after_mapping_hook_pool()
+
+        self.logger.debug('Total directory users after filtering: %d',
+                          self.selected_directory_user_count if merge_diff
+                          else len(self.selected_directory_user_keys))
         if self.logger.isEnabledFor(logging.DEBUG):
-            self.logger.debug('Group work list: %s', dict([(umapi_name, umapi_info.get_desired_groups_by_user_key())
+            self.logger.debug('Group work list: %s', dict([(umapi_name, umapi_info.describe_desired_groups())
                                                            for umapi_name, umapi_info
                                                            in six.iteritems(self.umapi_info_by_name)]))
 
+    @staticmethod
+    def get_target_attributes(directory_user):
+        """
+        The attributes of a directory user that an after-mapping hook can change
+        :type directory_user: dict
+        :rtype: dict
+        """
+        return {
+            'email': directory_user.get('email'),
+            'username': directory_user.get('username'),
+            'domain': directory_user.get('domain'),
+            'firstname': directory_user.get('firstname'),
+            'lastname': directory_user.get('lastname'),
+            'country': directory_user.get('country'),
+        }
+
+    def will_run_hook_in_pool(self):
+        return (self.options['batch_after_mapping_hook'] is None and self.options['after_mapping_hook'] is not None
+                and self.options['after_mapping_hook_processes'] > 1)
+
+    def start_after_mapping_hook_pool(self):
+        processes = self.options['after_mapping_hook_processes']
+        self.logger.debug('Running after-mapping hook in %d worker processes', processes)
+        self.hook_pool = ProcessPoolExecutor(max_workers=processes)
+        # the pool starts its workers with the first task, so give it one now, while this is
+        # the only thread that could be holding a lock the workers would inherit
+        self.hook_pool.submit(int).result()
+        # code objects can't be pickled, but they can be marshaled
+        self.marshaled_hook = marshal.dumps(self.options['after_mapping_hook'])
+        self.pending_hook_chunks = deque()
+
+    def finish_after_mapping_hook_pool(self):
+        if self.hook_pool is None:
+            return
+        try:
+            while self.pending_hook_chunks:
+                self.apply_hook_chunk_result(*self.pending_hook_chunks.popleft())
+        finally:
+            self.close_after_mapping_hook_pool()
+
+    def close_after_mapping_hook_pool(self):
+        if self.hook_pool is None:
+            return
+        while self.pending_hook_chunks:
+            self.pending_hook_chunks.popleft()[1].cancel()
+        self.hook_pool.shutdown()
+        self.hook_pool = None
+
+    def apply_hook_chunk_result(self, mapped_users, future):
+        for (user_key, directory_user, _, _), (target_attributes, target_groups) in zip(mapped_users, future.result()):
+            directory_user.update(target_attributes)
+            self.add_desired_groups_for_user(user_key, directory_user, target_groups)
+
+    def process_mapped_users(self, mapped_users):
+        """
+        Run the after-mapping hook on a chunk of mapped users, then record their desired groups.
+        When the per-user hook runs in worker processes, the chunk is queued to the workers, and the
+        results of earlier chunks are applied (in order) to keep a bounded number of chunks in flight.
+        :param mapped_users: list of (user_key, directory_user, source_groups, target_groups) tuples
+        """
+        if self.hook_pool is not None:
+            chunk = [(directory_user['source_attributes'], source_groups,
+                      self.get_target_attributes(directory_user), target_groups)
+                     for _, directory_user, source_groups, target_groups in mapped_users]
+            future = self.hook_pool.submit(run_after_mapping_hook_chunk, self.marshaled_hook, chunk)
+            self.pending_hook_chunks.append((mapped_users, future))
+            while len(self.pending_hook_chunks) > 2 * self.options['after_mapping_hook_processes']:
+                self.apply_hook_chunk_result(*self.pending_hook_chunks.popleft())
+            return
+        batch = [{
+            'source_attributes': directory_user['source_attributes'].copy(),
+            'source_groups': source_groups,
+            'target_attributes': self.get_target_attributes(directory_user),
+            'target_groups': target_groups,
+        } for _, directory_user, source_groups, target_groups in mapped_users]
+        scope = self.batch_after_mapping_hook_scope
+        scope['users'] = batch
+        self.logger.debug('Calling batch after-mapping hook for %d users', len(batch))
+        exec(self.options['batch_after_mapping_hook'], scope)
+        batch, scope['users'] = scope['users'], None
+        if batch is None or len(batch) != len(mapped_users):
+            raise user_sync.error.AssertionException('The batch after-mapping hook must not add or remove users')
+        for (user_key, directory_user, _, _), mapped_user in zip(mapped_users, batch):
+            directory_user.update(mapped_user['target_attributes'])
+            self.add_desired_groups_for_user(user_key, directory_user, mapped_user['target_groups'])
+
+    def add_desired_groups_for_user(self, user_key, directory_user, target_groups):
+        """
+        Record the adobe groups a mapped directory user should be in: the target groups from
+        the mappings (and hook), and the groups from any matching additional group rules.
+        :type user_key: UserKey
+        :type directory_user: dict
+        :type target_groups: set(str)
+        """
+        for target_group_qualified_name in target_groups:
+            target_group = AdobeGroup.lookup(target_group_qualified_name)
+            if target_group is not None:
+                umapi_info = self.get_umapi_info(target_group.get_umapi_name())
+                umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
+            else:
+                self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
+
+        member_groups = directory_user.get('member_groups', [])
+        for member_group in member_groups:
+            targets = self.additional_group_targets.get(member_group)
+            if targets is None:
+                targets = self.resolve_additional_groups(member_group)
+            for umapi_info, rename_group in targets:
+                umapi_info.add_desired_group_for(user_key, rename_group)
+
+        if self.directory_spill is not None:
+            # the user's groups are final, so they go to disk along with the user
+            desired_groups = self.get_umapi_info(PRIMARY_TARGET_NAME).pop_desired_groups(user_key)
+            self.directory_spill.add(user_key, (directory_user, desired_groups))
+        else:
+            # the user is stored again now that any hook is done with it, since a disk-backed store
+            # may have written it out before the hook changed it
+            self.directory_user_by_user_key[user_key] = directory_user
+            self.selected_directory_user_keys[user_key] = True
+
+    def resolve_additional_groups(self, member_group):
+        """
+        Find the adobe groups that the additional group rules map a directory group to, and register
+        them as mapped groups.  Many users share the same groups, so the result is kept for the run.
+        :type member_group: str
+        :rtype: list(tuple(UmapiTargetInfo, str))
+        """
+        targets = []
+        for umapi_name, rename_group in self.additional_group_matcher.resolve(member_group):
+            umapi_info = self.get_umapi_info(umapi_name)
+            umapi_info.add_mapped_group(rename_group)
+            umapi_info.add_additional_group(rename_group, member_group)
+            targets.append((umapi_info, rename_group))
+        self.additional_group_targets[member_group] = targets
+        return targets
+
     def is_directory_user_in_groups(self, directory_user, groups):
         """
         :type directory_user: dict
@@ -476,33 +753,73 @@ class RuleProcessor(object):
         umapi_info, umapi_connector = self.get_umapi_info(PRIMARY_TARGET_NAME), umapi_connectors.get_primary_connector()
         if self.push_umapi:
             primary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
+        elif self.will_merge_diff():
+            primary_adds_by_user_key = None
         else:
             primary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+        if primary_adds_by_user_key is None:
+            primary_adds = self.merge_umapi_users_for_connector(umapi_info, umapi_connector)
+        else:
+            primary_adds = ((user_key, group_bits, None)
+                            for user_key, group_bits in six.iteritems(primary_adds_by_user_key))
         # save groups for new users
-        for user_key, groups_to_add in six.iteritems(primary_adds_by_user_key):
+        for user_key, group_bits, directory_user in primary_adds:
+            groups_to_add = umapi_info.get_group_names(group_bits)
             if exclude_unmapped_users and not groups_to_add:
                 # If user is not part of any group and ignore outcast is enabled. Do not create user.
                 continue
             # We always create every user in the primary umapi, because it's believed to own the directories.
-            self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
+            self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector, directory_user)
 
         # then sync the secondary connectors
-        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
-            umapi_info = self.get_umapi_info(umapi_name)
-            if len(umapi_info.get_mapped_groups()) == 0:
-                continue
-            self.logger.debug('%sing users to secondary umapi %s...', verb, umapi_name)
-            if self.push_umapi:
-                secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
-            else:
-                secondary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
-            for user_key, groups_to_add in six.iteritems(secondary_adds_by_user_key):
-                # We only create users who have group mappings in the secondary umapi
-                if groups_to_add:
-                    if user_key not in self.primary_users_created:
-                        # We pushed an existing user to a secondary in order to update his groups
+        secondary_connectors = [(umapi_name, umapi_connector) for umapi_name, umapi_connector
+                                in six.iteritems(umapi_connectors.get_secondary_connectors())
+                                if len(self.get_umapi_info(umapi_name).get_mapped_groups()) > 0]
+        self.for_each_secondary(self.sync_secondary_umapi_users, secondary_connectors, verb)
+
+    def sync_secondary_umapi_users(self, umapi_name, umapi_connector, verb):
+        """
+        Sync the directory users to one secondary umapi.  This only relies on state that
+        is final once the primary umapi has been synced, so it can run alongside other secondaries.
+        :type umapi_name: str
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :type verb: str
+        """
+        umapi_info = self.get_umapi_info(umapi_name)
+        self.logger.debug('%sing users to secondary umapi %s...', verb, umapi_name)
+        if self.push_umapi:
+            secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
+        else:
+            secondary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+        for user_key, group_bits in six.iteritems(secondary_adds_by_user_key):
+            # We only create users who have group mappings in the secondary umapi
+            if group_bits:
+                groups_to_add = umapi_info.get_group_names(group_bits)
+                if user_key not in self.primary_users_created:
+                    # We pushed an existing user to a secondary in order to update his groups
+                    with self.counter_lock:
                         self.updated_user_keys.add(user_key)
-                    self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
+                self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
+
+    def for_each_secondary(self, function, secondary_connectors, *args):
+        """
+        Call function(umapi_name, umapi_connector, *args) for each of the given secondary connectors,
+        using up to secondary_org_workers threads.  Each connector is only used by one thread.
+        Any exception raised by the function is re-raised here.
+        :type function: callable
+        :type secondary_connectors: list(tuple(str, user_sync.connector.connector_umapi.UmapiConnector))
+        """
+        max_workers = min(self.options['secondary_org_workers'], len(secondary_connectors))
+        if max_workers <= 1:
+            for umapi_name, umapi_connector in secondary_connectors:
+                function(umapi_name, umapi_connector, *args)
+            return
+        self.logger.debug('Processing %d secondary umapis with %d workers', len(secondary_connectors), max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(function, umapi_name, umapi_connector, *args)
+                       for umapi_name, umapi_connector in secondary_connectors]
+            for future in futures:
+                future.result()
 
     def create_umapi_groups(self, umapi_connectors):
         """
@@ -520,27 +837,35 @@ class RuleProcessor(object):
                 continue
             umapi_info = self.umapi_info_by_name[umapi_name]
             mapped_groups = umapi_info.get_non_normalize_mapped_groups()
+            org_name = umapi_name if umapi_name else 'primary org'
 
-            # pull all user groups from console
-            on_adobe_groups = [normalize_string(g['groupName']) for g in umapi_connector.get_groups()]
-
-            # verify if group exist and create
+            # pull all user groups from console (once for each org), and find the ones to create
+            group_catalog = umapi_connector.get_group_catalog()
+            missing_groups = []
+            missing_names = set()
             for mapped_group in mapped_groups:
-                if normalize_string(mapped_group) in on_adobe_groups:
+                normalized_name = normalize_string(mapped_group)
+                if group_catalog.contains(mapped_group) or normalized_name in missing_names:
                     continue
-                self.logger.info("Auto create user-group enabled: Creating '{}' on '{}'".format(
-                    mapped_group, umapi_name if umapi_name else 'primary org'))
-                try:
-                    # create group
-                    res = umapi_connector.create_group(mapped_group)
-                    self.action_summary['adobe_user_groups_created'] += 1
-                except Exception as e:
-                    self.logger.critical("Unable to create %s user group: '{}' on '{}' (error: {})".format(
-                        mapped_group, umapi_name if umapi_name else 'primary org', e))
+                missing_names.add(normalized_name)
+                missing_groups.append(mapped_group)
+                self.logger.info("Auto create user-group enabled: Creating '{}' on '{}'".format(mapped_group, org_name))
+            if not missing_groups:
+                continue
+
+            # create them in batches
+            try:
+                errors_by_group = umapi_connector.create_groups(missing_groups)
+            except Exception as e:
+                errors_by_group = {mapped_group: e for mapped_group in missing_groups}
+            self.action_summary['adobe_user_groups_created'] += len(missing_groups) - len(errors_by_group)
+            for mapped_group, errors in six.iteritems(errors_by_group):
+                self.logger.critical("Unable to create user group: '{}' on '{}' (error: {})".format(
+                    mapped_group, org_name, errors))
 
     def is_selected_user_key(self, user_key):
         """
-        :type user_key: str
+        :type user_key: UserKey
         """
         username_filter_regex = self.options['username_filter_regex']
         if username_filter_regex is not None:
@@ -561,11 +886,12 @@ class RuleProcessor(object):
         :param user_key: user_key (str) from a user in that connector
         :param removed_groups: a set of adobe_groups to be removed from the user in that umapi
         """
-        if user_key is None:
-            if umapi_name not in self.stray_key_map:
-                self.stray_key_map[umapi_name] = {}
-        else:
-            self.stray_key_map[umapi_name][user_key] = removed_groups
+        with self.counter_lock:
+            if user_key is None:
+                if umapi_name not in self.stray_key_map:
+                    self.stray_key_map[umapi_name] = {}
+            else:
+                self.stray_key_map[umapi_name][user_key] = removed_groups
 
     def process_strays(self, umapi_connectors):
         """
@@ -579,11 +905,7 @@ class RuleProcessor(object):
             self.write_stray_key_map()
         if self.will_manage_strays:
             max_missing_option = self.options['max_adobe_only_users']
-            if isinstance(max_missing_option, str) and '%' in max_missing_option:
-                percent = float(max_missing_option.strip('%')) / 100
-                max_missing = int((self.primary_user_count - self.excluded_user_count) * percent)
-            else:
-                max_missing = max_missing_option
+            max_missing = self.get_max_adobe_only_users(self.primary_user_count - self.excluded_user_count)
             if stray_count > max_missing:
                 self.logger.critical('Unable to process Adobe-only users, as their count (%s) is larger '
                                      'than the max_adobe_only_users setting (%s)', stray_count, max_missing_option)
@@ -592,6 +914,58 @@ class RuleProcessor(object):
             self.logger.debug("Processing Adobe-only users...")
             self.manage_strays(umapi_connectors)
 
+    def get_max_adobe_only_users(self, adobe_user_count):
+        """
+        The largest number of Adobe-only users that we will process, which may be a percentage
+        of the (non-excluded) users in the primary umapi.
+        :type adobe_user_count: int
+        :rtype: int
+        """
+        max_missing_option = self.options['max_adobe_only_users']
+        if self.is_max_adobe_only_users_percentage():
+            percent = float(max_missing_option.strip('%')) / 100
+            return int(adobe_user_count * percent)
+        return max_missing_option
+
+    def is_max_adobe_only_users_percentage(self):
+        max_missing_option = self.options['max_adobe_only_users']
+        return isinstance(max_missing_option, str) and '%' in max_missing_option
+
+    def will_check_strays_early(self, umapi_info):
+        """
+        Whether to check the count of Adobe-only users against max_adobe_only_users while the primary
+        umapi is being read, so that a run that would refuse to process them stops without reading the rest.
+        That's not done when there's a stray list to write, since the list should be complete.
+        """
+        return (self.is_primary_org(umapi_info) and self.will_process_strays and self.will_manage_strays and
+                not self.stray_list_output_path)
+
+    def check_strays_early(self, umapi_connector):
+        """
+        Stop the run if there are already more Adobe-only users than max_adobe_only_users can allow.
+        For a percentage, the limit is computed as if all the users not yet read are included users,
+        using the count of users that UMAPI said the query would return.
+        Stopping doesn't undo the updates of users matched so far: every full batch of them has
+        already been sent to UMAPI, and only the partial batch still queued is dropped.
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        """
+        stray_count = len(self.get_stray_keys())
+        if self.is_max_adobe_only_users_percentage():
+            if self.options['adobe_group_filter'] is not None:
+                # the user count is for one group at a time, so gives no bound
+                return
+            user_count = umapi_connector.get_user_count()
+            if user_count is None:
+                return
+            max_missing = self.get_max_adobe_only_users(max(user_count, self.primary_user_count) -
+                                                        self.excluded_user_count)
+        else:
+            max_missing = self.options['max_adobe_only_users']
+        if stray_count > max_missing:
+            raise user_sync.error.AssertionException(
+                'Stopping, as the count of Adobe-only users (%s) is already larger than the max_adobe_only_users '
+                'setting (%s) allows' % (stray_count, self.options['max_adobe_only_users']))
+
     def manage_strays(self, umapi_connectors):
         """
         Manage strays.  This doesn't require having loaded users from the umapi.
@@ -621,8 +995,7 @@ class RuleProcessor(object):
                 username = self.email_override[username]
             return user_sync.connector.connector_umapi.Commands(identity_type=id_type, username=username, domain=domain)
 
-        # do the secondary umapis first, in case we are deleting user accounts from the primary umapi at the end
-        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+        def manage_secondary_strays(umapi_name, umapi_connector):
             secondary_strays = self.get_stray_keys(umapi_name)
             for user_key in primary_strays:
                 if user_key in secondary_strays:
@@ -647,9 +1020,13 @@ class RuleProcessor(object):
                         # haven't done anything, don't send commands
                         continue
                     umapi_connector.send_commands(commands)
-            # make sure the commands for each umapi are executed before moving to the next
+            # make sure the commands for each umapi are executed before moving on
             umapi_connector.get_action_manager().flush()
 
+        # do the secondary umapis first, in case we are deleting user accounts from the primary umapi at the end
+        secondary_connectors = list(six.iteritems(umapi_connectors.get_secondary_connectors()))
+        self.for_each_secondary(manage_secondary_strays, secondary_connectors)
+
         # finish with the primary umapi
         primary_connector = umapi_connectors.get_primary_connector()
         for user_key in primary_strays:
@@ -708,14 +1085,14 @@ class RuleProcessor(object):
         # check to see if AdobeID exist for FederatedID/EnterpriseID user. Skip user if same email exist.
         if ((identity_type == user_sync.identity_type.FEDERATED_IDENTITY_TYPE or
              identity_type == user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE) and
-                self.is_adobeID_email_exist(directory_user['email'])):
+                self.is_adobeID_email_exist(normalized_value(directory_user, 'email'))):
             self.logger.warning("Skipping user creation for: %s - AdobeID already exists with %s",
                                 self.get_directory_user_key(directory_user), directory_user['email'])
             return None
 
         if (identity_type == user_sync.identity_type.FEDERATED_IDENTITY_TYPE and directory_user['username'] and
                 '@' in directory_user['username'] and
-                normalize_string(directory_user['email']) != normalize_string(directory_user['username'])):
+                normalized_value(directory_user, 'email') != normalized_value(directory_user, 'username')):
             update_username = directory_user['username']
             directory_user['username'] = directory_user['email']
 
@@ -747,7 +1124,7 @@ class RuleProcessor(object):
             commands.update_user({"email": directory_user['email'], "username": update_username})
         return commands
 
-    def create_umapi_user(self, user_key, groups_to_add, umapi_info, umapi_connector):
+    def create_umapi_user(self, user_key, groups_to_add, umapi_info, umapi_connector, directory_user=None):
         """
         Add the user to the org on the receiving end of the given umapi connector.
         If the connector is the primary connector, we ask to update the user's attributes because
@@ -756,12 +1133,18 @@ class RuleProcessor(object):
         If groups_to_add is specified, and we are managing groups, we give the user those groups.
         If we are pushing, we also remove the user from any mapped groups not in groups_to_add.
         (This way, when we push blindly, we manage the entire set of mapped groups.)
-        :type user_key: str
+        :type user_key: UserKey
         :type groups_to_add: set
         :type umapi_info: UmapiTargetInfo
         :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :type directory_user: dict # if not given, the user is looked up by key
         """
-        directory_user = self.directory_user_by_user_key[user_key]
+        if directory_user is None:
+            directory_user = self.directory_user_by_user_key[user_key]
+            if not self.is_primary_org(umapi_info):
+                # other secondaries may be using this record at the same time, and making the
+                # commands can change it
+                directory_user = directory_user.copy()
         commands = self.create_umapi_commands_for_directory_user(directory_user, self.will_update_user_info(umapi_info),
                                                                  umapi_connector.trusted)
         if not commands:
@@ -773,7 +1156,8 @@ class RuleProcessor(object):
             commands.add_groups(groups_to_add)
         if umapi_connector.trusted:
             self.logger.info('Adding user to umapi %s with user key: %s', umapi_connector.name, user_key)
-            self.secondary_users_created.add(user_key)
+            with self.counter_lock:
+                self.secondary_users_created.add(user_key)
         else:
             self.logger.info('Creating user with user key: %s', user_key)
             self.primary_users_created.add(user_key)
@@ -781,22 +1165,24 @@ class RuleProcessor(object):
 
     def update_umapi_user(self, umapi_info, user_key, umapi_connector,
                           attributes_to_update=None, groups_to_add=None, groups_to_remove=None,
-                          umapi_user=None):
+                          umapi_user=None, directory_user=None):
         # Note that the user may exist only in the directory, only in the umapi, or both at this point.
         # When we are updating an Adobe user who has been removed from the directory, we have to be careful to use
         # data from the umapi_user parameter and not try to get information from the directory.
         """
         Send the action to update aspects of an adobe user, like info and groups
         :type umapi_info: UmapiTargetInfo
-        :type user_key: str
+        :type user_key: UserKey
         :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
         :type attributes_to_update: dict
         :type groups_to_add: set(str)
         :type groups_to_remove: set(str)
         :type umapi_user: dict # with type, username, domain, and email entries
+        :type directory_user: dict # if not given, the user is looked up by key
         """
         if attributes_to_update or groups_to_add or groups_to_remove:
-            self.updated_user_keys.add(user_key)
+            with self.counter_lock:
+                self.updated_user_keys.add(user_key)
         if attributes_to_update:
             self.logger.info('Updating info for user key: %s changes: %s', user_key, attributes_to_update)
         if groups_to_add or groups_to_remove:
@@ -807,8 +1193,12 @@ class RuleProcessor(object):
                 self.logger.info('Managing groups in %s for user key: %s added: %s removed: %s',
                                  umapi_info.get_name(), user_key, groups_to_add, groups_to_remove)
 
-        if user_key in self.directory_user_by_user_key:
-            directory_user = self.directory_user_by_user_key[user_key]
+        if directory_user is None:
+            directory_user = self.directory_user_by_user_key.get(user_key)
+            if directory_user is not None and not self.is_primary_org(umapi_info):
+                # the record is shared with the other secondaries, and may be changed below
+                directory_user = directory_user.copy()
+        if directory_user is not None:
             identity_type = self.get_identity_type_from_directory_user(directory_user)
         else:
             directory_user = umapi_user
@@ -816,7 +1206,8 @@ class RuleProcessor(object):
 
         # if user has email-type username and it is different from email address, then we need to
         # override the username with email address
-        if '@' in directory_user['username'] and normalize_string(directory_user['email']) != normalize_string(directory_user['username']):
+        if '@' in directory_user['username'] and \
+                normalized_value(directory_user, 'email') != normalized_value(directory_user, 'username'):
             if groups_to_add or groups_to_remove or attributes_to_update:
                 directory_user['username'] = directory_user['email']
             if attributes_to_update and 'email' in attributes_to_update:
@@ -826,7 +1217,8 @@ class RuleProcessor(object):
 
         # if email based username on umapi is differ than email on umapi and need to update email, then we need to
         # override the username with email address
-        if '@' in umapi_user['username'] and normalize_string(umapi_user['username']) != normalize_string(umapi_user['email']):
+        if '@' in umapi_user['username'] and \
+                normalized_value(umapi_user, 'username') != normalized_value(umapi_user, 'email'):
             if attributes_to_update and 'email' in attributes_to_update:
                 directory_user['email'] = umapi_user['email']
                 directory_user['username'] = umapi_user['email']
@@ -844,13 +1236,15 @@ class RuleProcessor(object):
         It is called with a particular organization that it should manage groups against.
         It returns a map from user keys to adobe groups:
             the keys are the user keys of all the selected directory users that don't exist in the target umapi;
-            the value for each key is the set of adobe groups in this umapi that the created user should be put into.
+            the value for each key is the bitset (see UmapiTargetInfo) of adobe groups in this umapi that the
+            created user should be put into.
         The use of this return value by the caller is to create the user and add him to the right groups.
         :type umapi_info: UmapiTargetInfo
         :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
         :rtype: map(string, set)
         """
-        filtered_directory_user_by_user_key = self.filtered_directory_user_by_user_key
+        directory_user_by_user_key = self.directory_user_by_user_key
+        selected_directory_user_keys = self.selected_directory_user_keys
 
         # the way we construct the return value is to start with a map from all directory users
         # to their groups in this umapi, make a copy, and pop off any adobe users we find.
@@ -858,11 +1252,6 @@ class RuleProcessor(object):
         user_to_group_map = umapi_info.get_desired_groups_by_user_key()
         user_to_group_map = {} if user_to_group_map is None else user_to_group_map.copy()
 
-        # compute all static options before looping over users
-        in_primary_org = self.is_primary_org(umapi_info)
-        update_user_info = self.will_update_user_info(umapi_info)
-        process_groups = self.will_process_groups()
-
         # prepare the strays map if we are going to be processing them
         if self.will_process_strays:
             self.add_stray(umapi_info.get_name(), None)
@@ -870,7 +1259,7 @@ class RuleProcessor(object):
         if self.options['adobe_group_filter'] is not None:
             umapi_users = self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
         else:
-            umapi_users = umapi_connector.iter_users()
+            umapi_users = self.iter_umapi_users_for_connector(umapi_info, umapi_connector)
         # Walk all the adobe users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
         for umapi_user in umapi_users:
@@ -885,55 +1274,160 @@ class RuleProcessor(object):
                 self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
                 continue
             umapi_info.add_umapi_user(user_key, umapi_user)
-            attribute_differences = {}
-            current_groups = self.normalize_groups(umapi_user.get('groups'))
-            groups_to_add = set()
-            groups_to_remove = set()
 
             # If this adobe user matches any directory user, pop them out of the
             # map because we know they don't need to be created.
             # Also, keep track of the mapped groups for the directory user
             # so we can update the adobe user's groups as needed.
-            desired_groups = user_to_group_map.pop(user_key, None) or set()
+            desired_group_bits = user_to_group_map.pop(user_key, 0)
 
-            # check for excluded users
-            if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
-                continue
-
-            self.map_email_override(umapi_user)
-
-            directory_user = filtered_directory_user_by_user_key.get(user_key)
-            if directory_user is None:
-                # There's no selected directory user matching this adobe user
-                # so we mark this adobe user as a stray, and we mark him
-                # for removal from any mapped groups.
-                if self.exclude_strays:
-                    self.logger.debug("Excluding Adobe-only user: %s", user_key)
-                    self.excluded_user_count += 1
-                elif self.will_process_strays:
-                    self.logger.debug("Found Adobe-only user: %s", user_key)
-                    self.add_stray(umapi_info.get_name(), user_key,
-                                   None if not process_groups else current_groups & umapi_info.get_mapped_groups())
-            else:
-                # There is a selected directory user who matches this adobe user,
-                # so mark any changed umapi attributes,
-                # and mark him for addition and removal of the appropriate mapped groups
-                if update_user_info or process_groups:
-                    self.logger.debug("Adobe user matched on customer side: %s", user_key)
-                if update_user_info:
-                    attribute_differences = self.get_user_attribute_difference(directory_user, umapi_user)
-                if process_groups:
-                    groups_to_add = desired_groups - current_groups
-                    groups_to_remove = (current_groups - desired_groups) & umapi_info.get_mapped_groups()
-
-            # Finally, execute the attribute and group adjustments
-            self.update_umapi_user(umapi_info, user_key, umapi_connector,
-                                   attribute_differences, groups_to_add, groups_to_remove, umapi_user)
+            selected_directory_user = (directory_user_by_user_key.get(user_key)
+                                       if user_key in selected_directory_user_keys else None)
+            self.sync_umapi_user(umapi_info, umapi_connector, user_key, umapi_user,
+                                 selected_directory_user, desired_group_bits)
 
         # mark the umapi's adobe users as processed and return the remaining ones in the map
         umapi_info.set_umapi_users_loaded()
         return user_to_group_map
 
+    def merge_umapi_users_for_connector(self, umapi_info, umapi_connector):
+        """
+        The merge diff engine's version of update_umapi_users_for_connector, for the primary umapi.
+        The adobe users are spilled to sorted runs, just as the directory users were, and the two sorted
+        streams are joined on user key, so neither side is held in memory.  Directory users who have no
+        adobe account are spilled once more, and only returned when the join is complete, because whether
+        they can be created depends on the Adobe ID users found in the whole org.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :rtype: iterable(tuple(UserKey, int, dict)) # key, group bits and directory user of each user to create
+        """
+        run_size = self.options['diff_run_size']
+        if self.will_process_strays:
+            self.add_stray(umapi_info.get_name(), None)
+
+        directory_spill, self.directory_spill = self.directory_spill, None
+        if directory_spill is None:
+            directory_spill = SortedSpill(run_size, name='directory')
+        umapi_spill = SortedSpill(run_size, name='adobe')
+        create_spill = SortedSpill(run_size, name='create')
+        try:
+            for umapi_user in self.iter_umapi_users_for_connector(umapi_info, umapi_connector):
+                self.filter_adobeID_user(umapi_user)
+                user_key = self.get_umapi_user_key(umapi_user)
+                if not user_key:
+                    self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
+                    continue
+                umapi_spill.add(user_key, umapi_user)
+            self.logger.debug('Merging %d directory users with %d adobe users', len(directory_spill), len(umapi_spill))
+
+            for user_key, directory_records, umapi_users in merge_join(directory_spill, umapi_spill):
+                # of several records with the same key, the last selected one counts, with all their groups
+                selected_records = [record for record in directory_records if record[1] is not None]
+                if selected_records:
+                    directory_user = selected_records[-1][0]
+                    desired_groups = 0
+                    for _, group_bits in selected_records:
+                        desired_groups |= group_bits
+                elif directory_records:
+                    directory_user, desired_groups = directory_records[-1][0], None
+                else:
+                    directory_user = desired_groups = None
+                if not umapi_users:
+                    if desired_groups is not None:
+                        create_spill.add(user_key, (desired_groups, directory_user))
+                    continue
+                for umapi_user in umapi_users[1:]:
+                    self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
+                self.sync_umapi_user(umapi_info, umapi_connector, user_key, umapi_users[0],
+                                     directory_user if desired_groups is not None else None,
+                                     desired_groups or 0, directory_user)
+        except BaseException:
+            create_spill.close()
+            raise
+        finally:
+            directory_spill.close()
+            umapi_spill.close()
+        umapi_info.set_umapi_users_loaded()
+        return self.iter_spilled_creates(create_spill)
+
+    @staticmethod
+    def iter_spilled_creates(create_spill):
+        try:
+            for user_key, (desired_groups, directory_user) in create_spill:
+                yield user_key, desired_groups, directory_user
+        finally:
+            create_spill.close()
+
+    def iter_umapi_users_for_connector(self, umapi_info, umapi_connector):
+        """
+        The adobe users of a umapi: prefetched if we started reading them early, else read now.
+        """
+        umapi_users = self.prefetched_umapi_users.pop(umapi_info.get_name(), None)
+        if umapi_users is None:
+            umapi_users = umapi_connector.iter_users()
+        return umapi_users
+
+    def sync_umapi_user(self, umapi_info, umapi_connector, user_key, umapi_user, selected_directory_user,
+                        desired_group_bits, directory_user=None):
+        """
+        Process one adobe user: unless it's excluded, either update it to match the selected directory user
+        with the same key, or (if there isn't one) record it as a stray.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :type user_key: UserKey
+        :type umapi_user: dict
+        :type selected_directory_user: dict
+        :type desired_group_bits: int # the bitset of the adobe groups the user should have
+        :type directory_user: dict # the directory user with this key, whether selected or not, if known
+        """
+        in_primary_org = self.is_primary_org(umapi_info)
+        update_user_info = self.will_update_user_info(umapi_info)
+        process_groups = self.will_process_groups()
+        attribute_differences = {}
+        current_groups = normalized_value(umapi_user, 'groups')
+        groups_to_add = set()
+        groups_to_remove = set()
+
+        # check for excluded users
+        if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
+            return
+
+        self.map_email_override(umapi_user)
+
+        if selected_directory_user is None:
+            # There's no selected directory user matching this adobe user
+            # so we mark this adobe user as a stray, and we mark him
+            # for removal from any mapped groups.
+            if self.exclude_strays:
+                self.logger.debug("Excluding Adobe-only user: %s", user_key)
+                with self.counter_lock:
+                    self.excluded_user_count += 1
+            elif self.will_process_strays:
+                self.logger.debug("Found Adobe-only user: %s", user_key)
+                self.add_stray(umapi_info.get_name(), user_key,
+                               None if not process_groups else umapi_info.get_group_names(
+                                   umapi_info.get_group_bits(current_groups) & umapi_info.get_mapped_group_bits()))
+                if self.will_check_strays_early(umapi_info):
+                    self.check_strays_early(umapi_connector)
+        else:
+            # There is a selected directory user who matches this adobe user,
+            # so mark any changed umapi attributes,
+            # and mark him for addition and removal of the appropriate mapped groups
+            if update_user_info or process_groups:
+                self.logger.debug("Adobe user matched on customer side: %s", user_key)
+            if update_user_info:
+                attribute_differences = self.get_user_attribute_difference(selected_directory_user, umapi_user)
+            if process_groups:
+                # only groups we know of matter here, so the others are left out of the user's bitset
+                current_group_bits = umapi_info.get_group_bits(current_groups)
+                groups_to_add = umapi_info.get_group_names(desired_group_bits & ~current_group_bits)
+                groups_to_remove = umapi_info.get_group_names(current_group_bits & ~desired_group_bits &
+                                                              umapi_info.get_mapped_group_bits())
+
+        # Finally, execute the attribute and group adjustments
+        self.update_umapi_user(umapi_info, user_key, umapi_connector,
+                               attribute_differences, groups_to_add, groups_to_remove, umapi_user, directory_user)
+
     def map_email_override(self, umapi_user):
         """
         for users with email-type usernames that don't match the email address, we need to add some
@@ -944,7 +1438,8 @@ class RuleProcessor(object):
         email = umapi_user.get('email', '')
         username = umapi_user.get('username', '')
         if '@' in username and username != email:
-            self.email_override[username] = email
+            with self.counter_lock:
+                self.email_override[username] = email
 
     @staticmethod
     def get_umapi_user_in_groups(umapi_info, umapi_connector, groups):
@@ -959,20 +1454,14 @@ class RuleProcessor(object):
             self.primary_user_count += 1
             # in the primary umapi, we actually check the exclusion conditions
             identity_type, username, domain = self.parse_user_key(user_key)
-            if identity_type in self.exclude_identity_types:
-                self.logger.debug("Excluding adobe user (due to type): %s", user_key)
+            reason = self.adobe_user_exclusions.match(identity_type, username, current_groups)
+            if reason is not None:
+                self.logger.debug("Excluding adobe user (due to %s): %s", reason, user_key)
                 self.excluded_user_count += 1
                 return True
-            if len(current_groups & self.exclude_groups) > 0:
-                self.logger.debug("Excluding adobe user (due to group): %s", user_key)
-                self.excluded_user_count += 1
-                return True
-            for re_ in self.exclude_users:
-                if re_.match(username):
-                    self.logger.debug("Excluding adobe user (due to name): %s", user_key)
-                    self.excluded_user_count += 1
-                    return True
-            self.included_user_keys.add(user_key)
+            if not self.will_merge_diff():
+                # included users are only needed to match secondary umapi users, which aren't merged
+                self.included_user_keys.add(user_key)
             return False
         else:
             # in all other umapis, we exclude every user that
@@ -982,7 +1471,9 @@ class RuleProcessor(object):
     def filter_adobeID_user(self, umapi_user):
         id_type = self.get_identity_type_from_umapi_user(umapi_user)
         if id_type == user_sync.identity_type.ADOBEID_IDENTITY_TYPE:
-            self.adobeid_user_by_email[normalize_string(umapi_user['email'])] = umapi_user
+            # we only need to know the user is there, so don't keep another reference to the record
+            with self.counter_lock:
+                self.adobeid_user_by_email[normalized_value(umapi_user, 'email')] = True
 
     def is_adobeID_email_exist(self, email):
         return bool(self.adobeid_user_by_email.get(normalize_string(email)))
@@ -1007,7 +1498,7 @@ class RuleProcessor(object):
         for key, value in six.iteritems(attributes):
             umapi_value = umapi_user.get(key)
             if key == 'email':
-                diff = normalize_string(value) != normalize_string(umapi_value)
+                diff = normalized_value(directory_user, 'email') != normalized_value(umapi_user, 'email')
             else:
                 diff = value != umapi_value
             if diff:
@@ -1020,7 +1511,9 @@ class RuleProcessor(object):
         :type directory_user: dict
         """
         id_type = self.get_identity_type_from_directory_user(directory_user)
-        return self.get_user_key(id_type, directory_user['username'], directory_user['domain'], directory_user['email'])
+        return UserKey.create(id_type, normalized_value(directory_user, 'username'),
+                              normalized_value(directory_user, 'domain'), normalized_value(directory_user, 'email'),
+                              intern=self.intern_user_keys, normalized=True)
 
     def get_umapi_user_key(self, umapi_user):
         """
@@ -1028,49 +1521,40 @@ class RuleProcessor(object):
         :type umapi_user: dict
         """
         id_type = self.get_identity_type_from_umapi_user(umapi_user)
+        email = normalized_value(umapi_user, 'email')
         if id_type == user_sync.identity_type.ADOBEID_IDENTITY_TYPE:
-            return self.get_user_key(id_type, '', '', umapi_user['email'])
+            return UserKey.create(id_type, '', '', email, intern=self.intern_user_keys, normalized=True)
         else:
-            return self.get_user_key(id_type, umapi_user['username'], umapi_user['domain'], umapi_user['email'])
+            return UserKey.create(id_type, normalized_value(umapi_user, 'username'),
+                                  normalized_value(umapi_user, 'domain'), email,
+                                  intern=self.intern_user_keys, normalized=True)
 
     def get_user_key(self, id_type, username, domain, email=None):
         """
         Construct the user key for a directory or adobe user.
-        The user key is the stringification of the tuple (id_type, username, domain)
-        but the domain part is left empty if the username is an email address.
+        The user key is the tuple (id_type, username, domain), interned unless the merge
+        diff engine is in use, but the domain part is left empty if the username is an email address.
         If the parameters are invalid, None is returned.
         :param username: (required) username of the user, can be his email
         :param domain: (optional) domain of the user
         :param email: (optional) email of the user
         :param id_type: (required) id_type of the user
-        :return: string "id_type,username,domain" (or None)
-        :rtype: str
+        :return: UserKey (or None)
+        :rtype: UserKey
         """
-        id_type = user_sync.identity_type.parse_identity_type(id_type)
-        email = normalize_string(email) if email else None
-        username = normalize_string(username) or email
-        domain = normalize_string(domain)
-
-        if not id_type:
-            return None
-        if not username:
-            return None
-        if username.find('@') >= 0:
-            domain = ""
-        elif not domain:
-            return None
-        return six.text_type(id_type) + u',' + six.text_type(username) + u',' + six.text_type(domain)
+        return UserKey.create(id_type, username, domain, email, intern=self.intern_user_keys)
 
     def parse_user_key(self, user_key):
         """
         Returns the identity_type, username, and domain for the user.
         The domain part is empty except if the username is not an email address.
+        :type user_key: UserKey
         :rtype: tuple
         """
-        return user_key.split(',')
+        return user_key
 
     def get_username_from_user_key(self, user_key):
-        return self.parse_user_key(user_key)[1]
+        return user_key.username
 
     def read_stray_key_map(self, file_path, delimiter=None):
         """
@@ -1159,6 +1643,35 @@ class RuleProcessor(object):
             self.logger.debug('Hook storage, %s: %s', when, self.after_mapping_hook_scope['hook_storage'])
 
 
+# state of the per-user after-mapping-hook in a worker process
+_worker_hook_state = {'marshaled_hook': None, 'hook': None, 'scope': None}
+
+
+def run_after_mapping_hook_chunk(marshaled_hook, chunk):
+    """
+    Run the per-user after-mapping hook in a worker process, over a chunk of mapped users.
+    Each worker has its own hook_storage, which persists across the chunks it runs.
+    :param marshaled_hook: the compiled hook code, marshaled
+    :param chunk: list of (source_attributes, source_groups, target_attributes, target_groups) tuples
+    :return: list of (target_attributes, target_groups) tuples, in the order of the chunk
+    """
+    state = _worker_hook_state
+    if state['marshaled_hook'] != marshaled_hook:
+        state['marshaled_hook'] = marshaled_hook
+        state['hook'] = marshal.loads(marshaled_hook)
+        state['scope'] = {'logger': logging.getLogger('processor'), 'hook_storage': None}
+    hook, scope = state['hook'], state['scope']
+    results = []
+    for source_attributes, source_groups, target_attributes, target_groups in chunk:
+        scope['source_attributes'] = source_attributes
+        scope['source_groups'] = source_groups
+        scope['target_attributes'] = target_attributes
+        scope['target_groups'] = target_groups
+        exec(hook, scope)
+        results.append((scope['target_attributes'], scope['target_groups']))
+    return results
+
+
 class UmapiConnectors(object):
     def __init__(self, primary_connector, secondary_connectors):
         """
@@ -1179,6 +1692,9 @@ class UmapiConnectors(object):
         return self.secondary_connectors
 
     def execute_actions(self):
+        # every action of the run has been sent to the connectors by now
+        for connector in self.connectors:
+            connector.end_write_ahead_log()
         while True:
             had_work = False
             for connector in self.connectors:
@@ -1189,17 +1705,27 @@ class UmapiConnectors(object):
             if not had_work:
                 break
 
+    def save_snapshots(self):
+        for connector in self.connectors:
+            connector.save_snapshot()
+
 
 class UmapiTargetInfo(object):
-    def __init__(self, name):
+    def __init__(self, name, umapi_user_store=None):
         """
         :type name: str
+        :type umapi_user_store: MutableMapping to hold the umapi users (a dict if None)
         """
         self.name = name
         self.mapped_groups = set()
         self.non_normalize_mapped_groups = set()
+        # group names (normalized) are indexed, so that each user's desired groups can be held
+        # as a bitset: bit i of a bitset is set if the bitset includes group_names[i]
+        self.group_bit_by_name = {}
+        self.group_names = []
+        self.mapped_group_bits = 0
         self.desired_groups_by_user_key = {}
-        self.umapi_user_by_user_key = {}
+        self.umapi_user_by_user_key = {} if umapi_user_store is None else umapi_user_store
         self.umapi_users_loaded = False
         self.stray_by_user_key = {}
         self.groups_added_by_user_key = {}
@@ -1219,6 +1745,46 @@ class UmapiTargetInfo(object):
         normalized_group_name = normalize_string(group)
         self.mapped_groups.add(normalized_group_name)
         self.non_normalize_mapped_groups.add(group)
+        self.mapped_group_bits |= self.get_group_bit(normalized_group_name)
+
+    def get_group_bit(self, normalized_group_name):
+        """
+        The bit for a group, which is added to the index if needed.
+        :type normalized_group_name: str
+        :rtype: int
+        """
+        bit = self.group_bit_by_name.get(normalized_group_name)
+        if bit is None:
+            bit = self.group_bit_by_name[normalized_group_name] = 1 << len(self.group_names)
+            self.group_names.append(normalized_group_name)
+        return bit
+
+    def get_group_bits(self, normalized_group_names):
+        """
+        The bitset of the given groups, leaving out any that aren't in the index.
+        :type normalized_group_names: iterable(str)
+        :rtype: int
+        """
+        bits = 0
+        group_bit_by_name = self.group_bit_by_name
+        for group_name in normalized_group_names:
+            bits |= group_bit_by_name.get(group_name, 0)
+        return bits
+
+    def get_group_names(self, bits):
+        """
+        :type bits: int
+        :rtype: set(str)
+        """
+        group_names = set()
+        while bits:
+            lowest_bit = bits & -bits
+            group_names.add(self.group_names[lowest_bit.bit_length() - 1])
+            bits ^= lowest_bit
+        return group_names
+
+    def get_mapped_group_bits(self):
+        return self.mapped_group_bits
 
     def add_additional_group(self, rename_group, member_group):
         normalized_rename_group = normalize_string(rename_group)
@@ -1235,30 +1801,44 @@ class UmapiTargetInfo(object):
         return self.non_normalize_mapped_groups
 
     def get_desired_groups_by_user_key(self):
+        """
+        :return: the bitset of desired groups for each user
+        :rtype: dict(UserKey, int)
+        """
         return self.desired_groups_by_user_key
 
     def get_desired_groups(self, user_key):
         """
-        :type user_key: str
+        :type user_key: UserKey
+        :rtype: set(str)
         """
-        desired_groups = self.desired_groups_by_user_key.get(user_key)
-        return desired_groups
+        desired_group_bits = self.desired_groups_by_user_key.get(user_key)
+        return None if desired_group_bits is None else self.get_group_names(desired_group_bits)
+
+    def describe_desired_groups(self):
+        return {user_key: self.get_group_names(bits)
+                for user_key, bits in six.iteritems(self.desired_groups_by_user_key)}
 
     def add_desired_group_for(self, user_key, group):
         """
-        :type user_key: str
+        :type user_key: UserKey
         :type group: Optional(str)
         """
-        desired_groups = self.get_desired_groups(user_key)
-        if desired_groups is None:
-            self.desired_groups_by_user_key[user_key] = desired_groups = set()
+        desired_group_bits = self.desired_groups_by_user_key.get(user_key, 0)
         if group is not None:
-            normalized_group_name = normalize_string(group)
-            desired_groups.add(normalized_group_name)
+            desired_group_bits |= self.get_group_bit(normalize_string(group))
+        self.desired_groups_by_user_key[user_key] = desired_group_bits
+
+    def pop_desired_groups(self, user_key):
+        """
+        :type user_key: UserKey
+        :rtype: int the bitset of desired groups
+        """
+        return self.desired_groups_by_user_key.pop(user_key, 0)
 
     def add_umapi_user(self, user_key, user):
         """
-        :type user_key: str
+        :type user_key: UserKey
         :type user: dict
         """
         self.umapi_user_by_user_key[user_key] = user
@@ -1268,7 +1848,7 @@ class UmapiTargetInfo(object):
 
     def get_umapi_user(self, user_key):
         """
-        :type user_key: str
+        :type user_key: UserKey
         """
         return self.umapi_user_by_user_key.get(user_key)
 
@@ -22,6 +22,9 @@ import csv
 import datetime
 import os
 import sys
+import threading
+
+from six.moves import queue
 
 import six
 
@@ -193,3 +196,47 @@ class JobStats:
         header = " End %s (Total time: %s) " % (self.name, rounded_time)
         line = self.create_divider(header)
         logger.info(line)
+
+
+class BackgroundIterator:
+    """
+    Iterates over an iterable in a background thread, buffering the items until they are consumed.
+    Iterating over this object yields the items in the original order; an exception raised
+    by the underlying iterable is re-raised to the consumer once the buffered items are used up.
+    """
+
+    _end = object()
+
+    def __init__(self, iterable, name=None):
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(iterable,), name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if self.stopped.is_set():
+                    break
+                self.queue.put((item, None))
+        except Exception as e:
+            self.queue.put((self._end, e))
+        else:
+            self.queue.put((self._end, None))
+
+    def __iter__(self):
+        while True:
+            item, error = self.queue.get()
+            if item is self._end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+
+    def stop(self):
+        """
+        Ask the background thread to stop reading.  Iteration ends after the items already read.
+        """
+        self.stopped.set()
+